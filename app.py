@@ -1,20 +1,71 @@
-from flask import Flask, render_template, g, request
+from flask import Flask, Request, render_template, g, request, session, send_file
 from turbo_flask import Turbo
 from werkzeug.datastructures import ImmutableMultiDict
 from werkzeug.utils import secure_filename
 import os
+import io
 import uuid
-import xml.dom.minidom as dom
+import threading
+from collections import OrderedDict
 
 import svgBlockLib
+import blkCache
+import blkStore
+import blkJobs
+import blkMetrics
 
-UPLOAD_FOLDER = 'uploads'
+CACHE_FOLDER = 'cache'
+CACHE_MAX_BYTES = 500*1024*1024
 ALLOWED_EXTENSIONS = {'txt', 'svg', 'xml'}
 
+#Uploads, previews and STLs are kept in a content addressed store. Files
+# unused for ARTIFACT_MAX_AGE seconds are removed, and the least recently used
+# once it's over ARTIFACT_MAX_BYTES.
+ARTIFACT_FOLDER = 'artifacts'
+ARTIFACT_MAX_BYTES = 1024*1024*1024
+ARTIFACT_MAX_AGE = 24*3600
+
+#Uploads are parsed in memory. Set SAVE_UPLOADS to also keep a copy in the
+# artifact store.
+SAVE_UPLOADS = False
+
+#Limits for uploads, anything over is rejected before any CAD work. Bigger
+# requests are refused by Flask before the body is read.
+MAX_UPLOAD_BYTES = 8*1024*1024
+MAX_PATHS = 5000
+MAX_SEGMENTS = 200000
+
+#Block creation runs in the background. JOB_WORKERS blocks are built at the
+# same time and at most JOB_QUEUE_DEPTH more can wait.
+JOB_WORKERS = 2
+JOB_QUEUE_DEPTH = 8
+
+#Seconds a block may take. Past that, coarser versions of the paths are
+# tried (see blkLibrary.buildBlockWithin), so a user always gets a block or an
+# error within about this time.
+JOB_BUDGET = 120
+
+#Oldest sessions are forgotten after this many
+MAX_USERS = 256
+
+#Level of detail of the 3D preview, see blkLibrary.lodFactor. The STL
+# download is always full detail.
+PREVIEW_LOD = 1
+
 #https://world.hey.com/georgespencer/using-turbo-flask-to-stream-progress-updates-to-users-without-more-javascript-81479750
 
+class uploadRequest(Request):
+    '''
+    Keeps uploaded files in memory instead of spooling big ones to a temp
+    file. Safe because MAX_CONTENT_LENGTH caps the size.
+    '''
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
+
 app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.request_class = uploadRequest
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
 turbo = Turbo(app)
 
 app.secret_key = 'BAD_SECRET_KEY'
@@ -22,19 +73,98 @@ app.secret_key = 'BAD_SECRET_KEY'
 alertTypes = ['alert-primary', 'alert-success', 'alert-warning', 'alert-danger']
 
 class userClass:
+    '''
+    State for one browser session. Each session gets its own blkLibrary so
+    uploads and settings from different users never mix.
+    '''
     def __init__(self):
         self.id = None
+        self.blk = None
+
+        #Last block that was built successfully, used for downloads
+        self.lastBlk = None
+        #Store keys of the binary glTF (3D preview) and STL of lastBlk. The
+        # STL is only made when it's downloaded.
+        self.lastGLB = None
+        self.lastSTL = None
 
     def createUUID(self):
-        id = uuid.uuid4()
+        id = str(uuid.uuid4())
         self.id = id
         return id
+
+    def newBlk(self):
+        '''
+        The session blkLibrary, reset for a new upload. Jobs build clones of
+        it, so resetting doesn't touch a build that is still running.
+        '''
+        if self.blk is not None:
+            return self.blk.reset()
+
+        self.blk = svgBlockLib.blkLibrary()
+        self.blk.cache = cache
+        self.blk.metrics = metrics
+        self.blk.store = store
+        self.blk.maxSVGBytes = MAX_UPLOAD_BYTES
+        self.blk.maxPaths = MAX_PATHS
+        self.blk.maxSegments = MAX_SEGMENTS
+        #Only the finished shape is kept, not every solid of every stage
+        self.blk.keepHistory = False
+        return self.blk
         
 
-user = userClass()
+users = OrderedDict()
+usersLock = threading.Lock()
+
+#Parsed SVGs and solids are shared by everyone
+cache = blkCache.blkCache(CACHE_FOLDER, CACHE_MAX_BYTES)
+
+#Files handed out to users, identical ones are only kept once
+store = blkStore.blkStore(ARTIFACT_FOLDER, ARTIFACT_MAX_BYTES, ARTIFACT_MAX_AGE)
+
+#Background block creation
+jobs = blkJobs.jobQueue(JOB_WORKERS, JOB_QUEUE_DEPTH)
+
+#Stage timings of all sessions, served on /metrics
+metrics = blkMetrics.blkMetrics()
+
+#Budgeted builds run in processes forked from a server that has cadquery
+# loaded, start it now instead of on the first job
+svgBlockLib.startBuildServer()
+
+
+def getUser():
+    '''
+    Returns the userClass for the current session, creating one if needed
+    '''
+    userId = session.get('userId')
+
+    with usersLock:
+        user = users.get(userId)
+        if user is None:
+            user = userClass()
+            user.createUUID()
+            user.newBlk()
+            users[user.id] = user
+            session['userId'] = user.id
+
+            while len(users) > MAX_USERS:
+                oldId, _ = users.popitem(last=False)
+                jobs.cancelSession(oldId)
+        else:
+            users.move_to_end(userId)
+
+    return user
+
+
+def pushAlert(userId, alertType, alertTitle, alertText):
+    #Must use app_context
+    with app.app_context(): 
+        g.alertType=alertType
+        g.alertTitle=alertTitle
+        g.alertText=alertText
+        turbo.push(turbo.append(render_template('_alerts.html'), 'divAlert'), to=userId)
 
-#Initalize Lib  
-blk = svgBlockLib.blkLibrary()
 
 @app.route('/testAlert')
 def testAlert():
@@ -51,14 +181,14 @@ def testAlert():
 
 @turbo.user_id
 def get_user_id():
-    return user.id
+    return session.get('userId')
 
 @app.route('/')
 def index():
     #Create a new ID when the page is loaded. 
     #Each time the page is refreshed, a new ID/User is created
-    user.createUUID()
-    get_user_id()
+    session.pop('userId', None)
+    getUser()
     return render_template('index.html')
 
 
@@ -68,49 +198,70 @@ def processUpload():
 
     if request.method == 'POST':
         
-        file = request.files['image_background']
-        
-        ## Need check to make sure file is an SVG
+        user = getUser()
 
-        #Save file using unique name
-        if file:
-            filename = str(uuid.uuid4()) + '.svg'
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+        #A new upload replaces whatever the session was working on
+        jobs.cancelSession(user.id)
 
-            #Read SVG and do inital parsing
-            blk.readSVGFromFile(app.config['UPLOAD_FOLDER'] + "/" + filename)
+        file = request.files.get('image_background')
+        if not file:
+            return uploadError(user.id, 'No file was uploaded.')
+        
+        extension = file.filename.rsplit('.', 1)[-1].lower() if '.' in file.filename else ''
+        if extension not in ALLOWED_EXTENSIONS:
+            return uploadError(user.id, 'Only SVG files can be uploaded.')
+        
+        data = file.read()
+        
+        #Read SVG and do inital parsing. Stops at the first limit passed.
+        blk = user.newBlk()
+        try:
+            blk.readSVGFromBytes(data)
             blk.parseSVG()
-            blk.estimateSVGSize()
+        except svgBlockLib.svgRejected as e:
+            #Nothing half parsed is left on the session
+            user.newBlk()
+            return uploadError(user.id, str(e))
+        
+        if blk.pathCount == 0:
+            user.newBlk()
+            return uploadError(user.id, 'SVG has no paths to make a block from.')
+        
+        #Same file uploaded again is only stored once
+        if SAVE_UPLOADS:
+            store.putData('svg', data)
+        
+        blk.estimateSVGSize()
 
-            #Check for elements that are not paths
-            nonSVGPathCounts = checkSVGForNonPaths(app.config['UPLOAD_FOLDER'] + "/" + filename)
+        #Elements that are not paths (counted while parsing)
+        nonSVGPathCounts = sum(blk.unsupportedElements.values())
 
-            g.pathCount = blk.pathCount
-            g.estimatedWidth = blk.estimatedWidth
-            g.estimatedHeight = blk.estimatedHeight
+        g.pathCount = blk.pathCount
+        g.estimatedWidth = blk.estimatedWidth
+        g.estimatedHeight = blk.estimatedHeight
 
-            #Use estimated width and height to set defaults
-            set3DDefaults()
-            g.scaleBy = blk.scaleBy
+        #Use estimated width and height to set defaults
+        #Should defulat values be pushed as g values as well?
+        blk.set3DDefaults()
+        g.scaleBy = blk.scaleBy
 
-            #Update div
-            #with app.app_context(): 
-            turbo.push(turbo.update(render_template('_svgStats.html'), 'uploadResultsText'), to=user.id)    
+        #Drop redundant segments now that the scale is known
+        g.segmentsBefore, g.segmentsAfter = blk.simplifyPaths()
 
+        #Ready the path data so the first preview is quick
+        blk.previewPathData()
 
-        #Must use app_context
-        with app.app_context(): 
-            g.alertType='success'
-            g.alertTitle='Image'
-            g.alertText='Image uploaded to server!'
-            turbo.push(turbo.append(render_template('_alerts.html'), 'divAlert'), to=user.id)
+        #Update div
+        #with app.app_context(): 
+        turbo.push(turbo.update(render_template('_svgStats.html'), 'uploadResultsText'), to=user.id)    
+
+
+        pushAlert(user.id, 'success', 'Image', 'Image uploaded to server!')
         
         if nonSVGPathCounts > 0:
-            with app.app_context(): 
-                g.alertType='warning'
-                g.alertTitle='Caution'
-                g.alertText='SVG Contains Non-Path elements. These elements will not be processed and may change the overall look of the SVG.'
-                turbo.push(turbo.append(render_template('_alerts.html'), 'divAlert'), to=user.id)
+            elementList = ', '.join('%s (%d)' % (tag, count) for tag, count in blk.unsupportedElements.items())
+            pushAlert(user.id, 'warning', 'Caution',
+                      'SVG Contains Non-Path elements: ' + elementList + '. These elements will not be processed and may change the overall look of the SVG.')
 
 
         #Update website values
@@ -122,130 +273,232 @@ def processUpload():
         return returnDict
 
 
-def set3DDefaults():
+def uploadError(userId, text):
+    pushAlert(userId, 'danger', 'Upload rejected!', text)
+    return {'status':'error', 'error': text}
+
+
+@app.errorhandler(413)
+def uploadTooLarge(e):
     '''
-    After SVG has been parsed, the known height/width can be used to make some
-    guesses on the rest of the values. This will hopefully get better over time.
-    
-    Should defulat values be pushed as g values as well?
-    '''
-
-    if max(blk.estimatedHeight, blk.estimatedWidth) < 100:
-        blk.neckHeight = 2
-        blk.setScale(1)
-        blk.feetCutOutPercentage = 0.08
-        blk.filletAmount = 0.02
-    elif max(blk.estimatedHeight, blk.estimatedWidth) < 1000:
-        blk.neckHeight = 20
-        blk.setScale(10)
-        blk.feetCutOutPercentage = 0.10
-        blk.filletAmount = 0.2
-    elif max(blk.estimatedHeight, blk.estimatedWidth) < 10000:
-        blk.neckHeight = 200
-        blk.setScale(100)
-        blk.feetCutOutPercentage = 0.12
-        blk.filletAmount = 2
-    else:
-        blk.neckHeight = 2000
-        blk.setScale(1000)
-        blk.feetCutOutPercentage = 0.14
-        blk.filletAmount = 20
+    Flask refuses requests over MAX_CONTENT_LENGTH before reading them
+    '''
+    user = getUser()
+    text = 'SVG is too large, the limit is %.0f MB.' % (MAX_UPLOAD_BYTES/2**20)
+    return uploadError(user.id, text), 413
+
+
+def setBlockParams(blk, values):
+    '''
+    Sets the slider values posted by the page on a blkLibrary
+    '''
+    #Add some buffer space around the 2D SVG
+    blk.neckHeight = float(values['webNeckHeight'])
+    blk.xLenAdj = float(values['xLenAdj'])
+    blk.yLenAdj = float(values['yLenAdj'])
+    blk.xhollowPercentage = float(values['xhollowPercentage'])
+    blk.yhollowPercentage = float(values['yhollowPercentage'])
+    blk.feetCutOutPercentage = float(values['feetCutOutPercentage'])
+    #Outer edges are filleted as part of the build, see buildFillet
+    blk.smoothEdges = bool(values['smoothEdges'])
+    blk.filletAmount = float(values['filletAmount'])
+
+
+@app.route('/processPreview', methods=['POST'])
+def processPreview():
+    '''
+    Returns the 2D preview SVG for the current slider values. No CAD work is
+    done, so this is called on every slider change. The block itself is only
+    built when the user hits Convert.
+    '''
+    user = getUser()
+
+    if user.blk is None or user.blk.paths is None:
+        return '', 204
+
+    #Path data is worked out once on the session blk and shared with the copy
+    user.blk.previewPathData()
+    blk = user.blk.clone()
+    setBlockParams(blk, request.json)
+
+    return app.response_class(blk.previewSVG(), mimetype='image/svg+xml')
 
 
 @app.route('/processBlockCreation', methods=['POST'])
 def processBlockCreation():
+    '''
+    Queues the block creation and returns the job id right away. Progress and
+    the result are pushed to the user over turbo.
+    '''
     print('Fn: processBlockCreation')
 
     if request.method == 'POST':
 
-        #Update user
-        with app.app_context(): 
-            g.alertType='warning'
-            g.alertTitle='Processing'
-            g.alertText='Crunching numbers... Drawing Lines...'
-            turbo.push(turbo.append(render_template('_alerts.html'), 'divAlert'), to=user.id)
-        
+        user = getUser()
+
+        if user.blk is None or user.blk.paths is None:
+            pushAlert(user.id, 'danger', 'Error!', 'Upload an SVG first!')
+            return {'status':'error'}
         
         print(request.json['webNeckHeight'])
         print(request.json['xLenAdj'])
         print(request.json['yLenAdj'])
 
-        #Add some buffer space around the 2D SVG
-        blk.neckHeight = float(request.json['webNeckHeight'])
-        blk.xLenAdj = float(request.json['xLenAdj'])
-        blk.yLenAdj = float(request.json['yLenAdj'])
-        blk.xhollowPercentage = float(request.json['xhollowPercentage'])
-        blk.yhollowPercentage = float(request.json['yhollowPercentage'])
-        blk.feetCutOutPercentage = float(request.json['feetCutOutPercentage'])
+        #Each job gets its own copy so a running build is never changed under it
+        blk = user.blk.clone()
+        setBlockParams(blk, request.json)
 
+        userId = user.id
         try:
-            #Do the actual translation from 2D to 3D
-            blk.translate2Dto3D()
-            blk.buildBoundingBox()
-
-            #Calculate heights and Width and extrude
-            blk.doMath()
-            blk.buildBody()
-
-            #Set hollow amount and hollow body
-            #blk.xhollowPercentage = 0.8
-            #blk.yhollowPercentage = 0.8
-            blk.hollowBody()
-            blk.createAndCutPyramid()
-
-            #Cut Feet and Fillet
-            blk.cutFeet()
-            #blk.smoothOuterEdges()
-
-            #Create SVG
-            svgResultFilename = blk.exportSVG(folder='static/',
-                        projectionDir=(0.5, 0.5, 0.5),
-                        strokeColor=(0,0,0),
-                        strokeWidth=2.2,
-                        hiddenColor=(94,94,94)
-                        )
-        
-            #Update user
-            with app.app_context(): 
-                g.alertType='success'
-                g.alertTitle='Success!'
-                g.alertText='SVG Block has been created!'
-                turbo.push(turbo.append(render_template('_alerts.html'), 'divAlert'), to=user.id)
-            
+            job = jobs.submit(userId, lambda job: runBlockJob(job, blk, userId))
+        except blkJobs.queueFull:
+            pushAlert(userId, 'danger', 'Busy!', 'Too many blocks are being created. Try again in a minute.')
+            return {'status':'busy'}
+
+        #Update user
+        pushAlert(userId, 'warning', 'Processing', 'Crunching numbers... Drawing Lines...')
+
+        returnDict = {'status':'queued',
+                      'jobId': job.id,
+                      }
+        return returnDict
+
+
+def runBlockJob(job, blk, userId):
+    '''
+    Runs on a job worker. Builds the block and pushes progress and results
+    to the user.
+    '''
+
+    def progress(stage):
+        #Raises jobCancelled if a newer job replaced this one
+        job.setStage(stage)
+        with app.app_context():
+            g.jobStage = stage
+            turbo.push(turbo.update(render_template('_jobProgress.html'), 'jobProgress'), to=userId)
 
-            #Set name and push update
-            g.svgResultFilename = svgResultFilename
-            turbo.push(turbo.update(render_template('_svgResult2D.html'), 'result2D'), to=user.id)
+    blk.progress = progress
 
-            returnDict = {'status':'success'}
-            return returnDict
+    try:
+        #Translate 2D to 3D and build the body. Checks the cache first.
+        quality = blk.buildBlockWithin(JOB_BUDGET)
 
-        except:
-            #Update user
-            with app.app_context(): 
-                g.alertType='danger'
-                g.alertTitle='Error!'
-                g.alertText='SVG Block could not be created!'
-                turbo.push(turbo.append(render_template('_alerts.html'), 'divAlert'), to=user.id)
+        #Mesh for the three.js preview. Much cheaper than exportSVG's HLR.
+        progress('exportGLB')
+        glb = blk.glbToBuffer(lod=PREVIEW_LOD).getvalue()
+        job.checkCancelled()
 
-            returnDict = {'status':'error'}
-            return returnDict
-                
+    except blkJobs.jobCancelled:
+        print('Job cancelled:', job.id)
+        metrics.countJob('cancelled')
+        raise
 
-def checkSVGForNonPaths(svgfile):
+    except svgBlockLib.buildTimeout:
+        metrics.countJob('timeout')
+        pushAlert(userId, 'danger', 'Error!', 'SVG Block could not be created within %d seconds, even with simplified curves. Try an SVG with fewer or simpler paths.' % JOB_BUDGET)
+        raise
+
+    except Exception:
+        metrics.countJob('error')
+        #Update user
+        pushAlert(userId, 'danger', 'Error!', 'SVG Block could not be created! ' + blkMetrics.formatBreakdown(blk.stageLog))
+        raise
+
+    metrics.countJob('done')
+
+    #Keep it around for the STL download
+    user = users.get(userId)
+    if user is not None:
+        user.lastBlk = blk
+        user.lastGLB = store.putData('glb', glb)
+        user.lastSTL = None
+        #Hand the stage results back so the next slider change only rebuilds
+        # the stages it affects. Skipped if a new SVG was uploaded meanwhile.
+        if user.blk.pathsVersion == blk.pathsVersion:
+            user.blk.stageMemo = blk.stageMemo
+            user.blk.qualityFloor = blk.qualityFloor
+
+    #Update user
+    pushAlert(userId, 'success', 'Success!', 'SVG Block has been created! ' + blkMetrics.formatBreakdown(blk.stageLog))
+    if quality != svgBlockLib.QUALITY_LEVELS[0][0]:
+        pushAlert(userId, 'warning', 'Simplified',
+                  "The full block took too long, this one was built at '%s' quality with simplified curves." % quality)
+
+    #Set name and push update
+    with app.app_context():
+        g.jobStage = 'done'
+        turbo.push(turbo.update(render_template('_jobProgress.html'), 'jobProgress'), to=userId)
+        #Job id keeps the browser from using an older cached model
+        g.glbUrl = '/preview3D.glb?job=' + job.id
+        turbo.push(turbo.update(render_template('_result3D.html'), 'result3D'), to=userId)
+
+    return {'glbBytes': len(glb), 'quality': quality, 'stages': blk.stageLog}
+
+
+@app.route('/jobStatus/<jobId>')
+def jobStatus(jobId):
+    job = jobs.get(jobId)
+
+    if job is None or job.sessionId != session.get('userId'):
+        return {'status':'unknown', 'jobId': jobId}
+
+    return job.toDict()
+
+
+@app.route('/preview3D.glb')
+def preview3D():
     '''
-    Generated using Ollama & Codellama model. Not very well though
+    Binary glTF of the last block built in this session, loaded by the
+    three.js viewer on the page.
     '''
+    user = getUser()
+    if user.lastBlk is None:
+        return {'status':'error'}, 404
+
+    fileName = store.path(user.lastGLB, 'glb') if user.lastGLB else None
+    if fileName is None:
+        #Evicted from the store, make it again
+        user.lastGLB = store.write('glb', lambda f: user.lastBlk.exportGLB(f, lod=PREVIEW_LOD))
+        fileName = store.path(user.lastGLB, 'glb')
+
+    return send_file(fileName,
+                     mimetype='model/gltf-binary',
+                     download_name='pressBlock.glb')
 
-    # Load an SVG file
-    svg = dom.parse(svgfile)
 
-    # Get all elements in the SVG document that are not paths
-    elements = svg.getElementsByTagName('*')
-    count = 0
-    for element in elements:
-        if element.tagName != 'path':
-            count = count + 1
+@app.route('/metrics')
+def metricsRoute():
+    '''
+    Stage timings, memory, jobs and cache in the Prometheus text format
+    '''
+    for key, value in cache.stats().items():
+        metrics.setGauge('cache_' + key, 'blkCache ' + key, value)
+    for key, value in store.stats().items():
+        metrics.setGauge('store_' + key, 'blkStore ' + key, value)
+    metrics.setGauge('jobs_pending', 'Block jobs queued or running', jobs.pendingCount())
+    metrics.setGauge('users', 'Sessions kept in memory', len(users))
+
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/downloadSTL')
+def downloadSTL():
+    '''
+    Sends the STL of the last block built in this session. It's written to
+    the store on the first download, later ones are served from there.
+    '''
+    print('Fn: downloadSTL')
+
+    user = getUser()
+    if user.lastBlk is None:
+        return {'status':'error'}, 404
 
-    return count
+    fileName = store.path(user.lastSTL, 'stl') if user.lastSTL else None
+    if fileName is None:
+        user.lastSTL = store.write('stl', user.lastBlk.exportSTL)
+        fileName = store.path(user.lastSTL, 'stl')
 
+    return send_file(fileName,
+                     mimetype='model/stl',
+                     as_attachment=True,
+                     download_name='pressBlock.stl')
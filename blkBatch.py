@@ -0,0 +1,282 @@
+'''
+Batch conversion of SVGs to STL blocks from the command line.
+
+    python blkBatch.py svgs/ more/*.svg --out blocks/ --params params.json
+
+Every SVG is sized with blkLibrary.set3DDefaults, then the values from the
+parameter file (a JSON object of blkLibrary attributes, e.g.
+{"xLenAdj": 1.1, "feetCutOutPercentage": 0.1}) are applied on top. Files are
+spread over a process pool.
+
+For each SVG <name>.stl and a preview <name>.svg are written to the output
+folder, along with manifest.jsonl: one line per finished file with its status,
+timings per stage and the error if it failed.
+
+Runs can be resumed. Outputs are written under a temp name and renamed when
+complete, and files that the manifest lists as done with the same parameters
+are skipped, so a crashed run only redoes what was unfinished.
+'''
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+#Parameters the parameter file may set
+PARAM_NAMES = ('neckHeight', 'neckBuffer', 'overallTypeHeight', 'scaleBy',
+               'xLenAdj', 'yLenAdj', 'xhollowPercentage', 'yhollowPercentage',
+               'feetCutOutPercentage', 'filletAmount', 'simplifyTolerance',
+               'stlLinearTolerance', 'stlAngularTolerance', 'skipPathNumber', 'smoothEdges')
+
+MANIFEST = 'manifest.jsonl'
+
+#A file that takes its worker process down this many times is given up on
+MAX_CRASHES = 2
+
+
+def findSVGs(inputs):
+    '''
+    Expands directories (all .svg files in them, recursively) and globs into
+    a sorted list of unique SVG files
+    '''
+    files = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, dirs, names in os.walk(item):
+                files.update(os.path.join(root, name) for name in names
+                             if name.lower().endswith('.svg'))
+        else:
+            matches = glob.glob(item, recursive=True)
+            files.update(match for match in matches if os.path.isfile(match))
+    return sorted(os.path.abspath(fileName) for fileName in files)
+
+
+def outputNames(svgFiles):
+    '''
+    Maps each SVG to an output name. Files with the same name in different
+    folders get a short hash of their path added.
+    '''
+    stems = {}
+    for fileName in svgFiles:
+        stem = os.path.splitext(os.path.basename(fileName))[0]
+        stems.setdefault(stem, []).append(fileName)
+
+    names = {}
+    for stem, fileNames in stems.items():
+        for fileName in fileNames:
+            if len(fileNames) == 1:
+                names[fileName] = stem
+            else:
+                names[fileName] = stem + '-' + hashlib.sha1(fileName.encode()).hexdigest()[:8]
+    return names
+
+
+def paramsKey(params, preview):
+    '''Identifies the settings a file was built with, for resuming'''
+    data = json.dumps({'params': params, 'preview': preview}, sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+
+def readManifest(folder):
+    '''
+    Returns input file -> last manifest record. A half written last line
+    (from a crash) is ignored.
+    '''
+    records = {}
+    try:
+        with open(os.path.join(folder, MANIFEST)) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                records[record['svg']] = record
+    except OSError:
+        pass
+    return records
+
+
+def writeAtomic(fileName, write):
+    '''Calls write(f) on a temp file and renames it to fileName when done'''
+    tempName = fileName + '.%d.tmp' % os.getpid()
+    with open(tempName, 'wb') as f:
+        write(f)
+    os.replace(tempName, fileName)
+
+
+def convertFile(task):
+    '''
+    Converts one SVG. Runs in a worker process, returns the manifest record.
+    '''
+    import svgBlockLib
+
+    record = {'svg': task['svg'], 'key': task['key'], 'stl': task['stl'],
+              'preview': task['preview']}
+    start = time.perf_counter()
+    blk = svgBlockLib.blkLibrary()
+
+    try:
+        blk.readSVGFromFile(task['svg'])
+        blk.parseSVG()
+        blk.estimateSVGSize()
+        blk.set3DDefaults()
+
+        for name, value in task['params'].items():
+            if name == 'scaleBy':
+                blk.setScale(value)
+            else:
+                setattr(blk, name, value)
+
+        blk.simplifyPaths()
+        blk.buildBlock()
+
+        writeAtomic(task['stl'], lambda f: blk.exportSTL(f))
+
+        if task['previewMode'] == 'hlr':
+            #Export picks the format from the extension
+            tempName = task['preview'] + '.%d.tmp.svg' % os.getpid()
+            blk.exportSVG(svgName=tempName)
+            os.replace(tempName, task['preview'])
+        elif task['previewMode'] == '2d':
+            svg = blk.previewSVG().encode()
+            writeAtomic(task['preview'], lambda f: f.write(svg))
+
+        record['status'] = 'done'
+        record['paths'] = blk.pathCount
+        record['segments'] = blk.segmentCount()
+        record['scaleBy'] = blk.scaleBy
+    except Exception as e:
+        record['status'] = 'error'
+        record['error'] = '%s: %s' % (type(e).__name__, e)
+        record['traceback'] = traceback.format_exc()
+
+    record['seconds'] = round(time.perf_counter() - start, 4)
+    record['stages'] = {}
+    for stageRecord in blk.stageLog:
+        stage = stageRecord['stage']
+        record['stages'][stage] = round(record['stages'].get(stage, 0) + stageRecord['seconds'], 4)
+    record['peakRSS'] = max((stageRecord['peakRSS'] for stageRecord in blk.stageLog), default=0)
+
+    return record
+
+
+def runBatch(tasks, workers, manifest, maxTasksPerChild=None):
+    '''
+    Runs the tasks over a process pool and appends a manifest line as each one
+    finishes. At most 2*workers tasks are in flight. If a worker process dies
+    (e.g. OCCT crashes), the pool is restarted and the tasks that were in
+    flight are tried again; a task that crashes MAX_CRASHES times is recorded
+    as crashed.
+    '''
+    pending = list(tasks)
+    crashes = {}
+    counts = {'done': 0, 'error': 0, 'crashed': 0}
+    total = len(tasks)
+
+    def finish(record):
+        manifest.write(json.dumps(record) + '\n')
+        manifest.flush()
+        counts[record['status']] += 1
+        print('[%d/%d] %-7s %7.2fs  %s%s' % (sum(counts.values()), total, record['status'],
+              record.get('seconds', 0), os.path.basename(record['svg']),
+              '  ' + record['error'] if 'error' in record else ''))
+
+    while pending:
+        kwargs = {'max_tasks_per_child': maxTasksPerChild} if maxTasksPerChild else {}
+        with ProcessPoolExecutor(max_workers=workers, **kwargs) as pool:
+            inFlight = {}
+            try:
+                while pending or inFlight:
+                    while pending and len(inFlight) < 2*workers:
+                        task = pending.pop(0)
+                        inFlight[pool.submit(convertFile, task)] = task
+
+                    done, _ = wait(inFlight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        finish(future.result())
+                        del inFlight[future]
+            except BrokenProcessPool:
+                retry = []
+                for future, task in inFlight.items():
+                    #Some may have finished before the pool broke
+                    if future.done() and not future.cancelled() and future.exception() is None:
+                        finish(future.result())
+                        continue
+                    crashes[task['svg']] = crashes.get(task['svg'], 0) + 1
+                    if crashes[task['svg']] >= MAX_CRASHES:
+                        finish({'svg': task['svg'], 'key': task['key'], 'status': 'crashed',
+                                'error': 'Worker process died'})
+                    else:
+                        retry.append(task)
+                pending[:0] = retry
+                print('Worker process died, restarting the pool')
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert SVGs to STL press blocks')
+    parser.add_argument('inputs', nargs='+', help='SVG files, folders or globs')
+    parser.add_argument('--out', default='blocks', help='Output folder')
+    parser.add_argument('--params', help='JSON file of blkLibrary parameters to apply to every file')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Worker processes')
+    parser.add_argument('--preview', choices=('hlr', '2d', 'none'), default='hlr',
+                        help='Preview SVG: hidden line 3D view, fast 2D view or none')
+    parser.add_argument('--max-tasks-per-child', type=int, default=50,
+                        help='Restart each worker after this many files to keep memory in check')
+    parser.add_argument('--force', action='store_true', help='Rebuild files that are already done')
+    args = parser.parse_args()
+
+    params = {}
+    if args.params:
+        with open(args.params) as f:
+            params = json.load(f)
+        unknown = set(params) - set(PARAM_NAMES)
+        if unknown:
+            parser.error('Unknown parameters: ' + ', '.join(sorted(unknown)))
+
+    svgFiles = findSVGs(args.inputs)
+    if not svgFiles:
+        parser.error('No SVG files found')
+
+    os.makedirs(args.out, exist_ok=True)
+    key = paramsKey(params, args.preview)
+    previous = {} if args.force else readManifest(args.out)
+    names = outputNames(svgFiles)
+
+    tasks = []
+    skipped = 0
+    for fileName in svgFiles:
+        stl = os.path.join(os.path.abspath(args.out), names[fileName] + '.stl')
+        preview = os.path.join(os.path.abspath(args.out), names[fileName] + '.svg')
+
+        record = previous.get(fileName)
+        if (record is not None and record['status'] == 'done' and record['key'] == key
+                and os.path.exists(stl) and (args.preview == 'none' or os.path.exists(preview))):
+            skipped += 1
+            continue
+
+        tasks.append({'svg': fileName, 'stl': stl, 'preview': preview,
+                      'previewMode': args.preview, 'params': params, 'key': key})
+
+    print('%d SVGs, %d already done, %d to convert on %d workers'
+          % (len(svgFiles), skipped, len(tasks), args.workers))
+
+    start = time.perf_counter()
+    with open(os.path.join(args.out, MANIFEST), 'a') as manifest:
+        counts = runBatch(tasks, args.workers, manifest, args.max_tasks_per_child)
+
+    print('Done in %.1fs: %d converted, %d failed, %d crashed, %d skipped'
+          % (time.perf_counter() - start, counts['done'], counts['error'], counts['crashed'], skipped))
+
+    return 1 if counts['error'] or counts['crashed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,369 @@
+'''
+Stage level benchmark for blkLibrary.
+
+Generates synthetic SVGs with a set number of paths and mix of
+Line/Quadratic/Cubic/Arc segments, optionally with nested holes (and islands
+in the holes) and overlapping shapes. Each blkLibrary stage is then run and
+timed on its own, along with the peak RSS after the stage and what the stage
+produced (faces, edges, triangles, bytes).
+
+Every case runs in a fresh process, so peak RSS isn't carried over from the
+case before it. Results are written as JSON so runs of different commits can
+be compared:
+
+    python blkBench.py --out before.json
+    (change things)
+    python blkBench.py --out after.json --compare before.json
+
+--memory runs a memory check instead: one case is built hundreds of times in
+a row in one process, reusing a single blkLibrary through reset() like the
+app does, and the RSS is sampled after every build. It fails (exit code 1) if
+the median RSS of the last builds is more than --max-growth MB above the
+median of the builds right after the warm up.
+
+    python blkBench.py --memory 300 --out memory.json
+'''
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from math import sin, cos, pi, hypot
+import multiprocessing
+
+#Default corpus: name, paths, segment mix (weights), holes, overlap
+DEFAULT_CASES = (
+    ('lines-25', 25, {'L': 1}, 0.0, 0.0),
+    ('mixed-25', 25, {'L': 1, 'Q': 1, 'C': 1, 'A': 1}, 0.0, 0.0),
+    ('mixed-100', 100, {'L': 1, 'Q': 1, 'C': 1, 'A': 1}, 0.0, 0.0),
+    ('holes-100', 100, {'L': 1, 'Q': 1, 'C': 1, 'A': 1}, 0.5, 0.0),
+    ('overlap-100', 100, {'L': 1, 'Q': 1, 'C': 1, 'A': 1}, 0.0, 0.5),
+    ('curves-200', 200, {'Q': 1, 'C': 2, 'A': 1}, 0.25, 0.25),
+)
+
+#Cut stages with blkLibrary.singleCut set and not set
+CUT_STAGES = {True: ('buildCutter', 'buildFillet', 'applyCutter'),
+              False: ('hollowBody', 'createAndCutPyramid', 'cutFeet', 'filletEdges')}
+
+#Every stage of either mode, in order. A case runs the ones of its mode.
+STAGES = (('parseSVG', 'estimateSVGSize', 'translate2Dto3D', 'buildBoundingBox', 'doMath', 'buildBody')
+          + CUT_STAGES[False] + CUT_STAGES[True] + ('exportSVG', 'exportSTL'))
+
+
+def ringPathd(cx, cy, radius, sides, mix, rng, reverse=False):
+    '''
+    Closed subpath around a regular polygon. Each side is a Line, Quadratic,
+    Cubic or Arc picked from mix. Curves bulge a little to the right of the
+    direction of travel, which is outwards for the outer ring and into the
+    hole for reversed rings, so rings never cross each other.
+    '''
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+
+    angles = [2*pi*i/sides for i in range(sides)]
+    if reverse:
+        angles = angles[::-1]
+    points = [(cx + radius*cos(a), cy + radius*sin(a)) for a in angles]
+
+    d = ['M%.4f %.4f' % points[0]]
+    for i in range(sides):
+        (x0, y0), (x1, y1) = points[i], points[(i + 1) % sides]
+        chord = hypot(x1 - x0, y1 - y0)
+        #Right hand normal of the side, scaled to a small bulge
+        nx, ny = (y1 - y0)/chord, -(x1 - x0)/chord
+        bulge = 0.12*chord
+
+        kind = rng.choices(kinds, weights)[0]
+        if kind == 'L':
+            d.append('L%.4f %.4f' % (x1, y1))
+        elif kind == 'Q':
+            d.append('Q%.4f %.4f %.4f %.4f' % ((x0 + x1)/2 + nx*bulge, (y0 + y1)/2 + ny*bulge, x1, y1))
+        elif kind == 'C':
+            d.append('C%.4f %.4f %.4f %.4f %.4f %.4f' % (
+                x0 + (x1 - x0)/3 + nx*bulge, y0 + (y1 - y0)/3 + ny*bulge,
+                x0 + 2*(x1 - x0)/3 + nx*bulge, y0 + 2*(y1 - y0)/3 + ny*bulge,
+                x1, y1))
+        else:
+            #Small arc, sweep 1 has its centre on the left so it bulges right
+            d.append('A%.4f %.4f 0 0 1 %.4f %.4f' % (chord, chord, x1, y1))
+    d.append('Z')
+    return ' '.join(d)
+
+
+def makeSVG(paths, mix, holes=0.0, overlap=0.0, seed=0):
+    '''
+    Returns an SVG string with paths shapes laid out on a grid.
+
+    holes is the fraction of shapes with a hole, half of those also get an
+    island inside the hole. overlap grows the shapes past their grid cell so
+    neighbours overlap (0 keeps them apart).
+    '''
+    rng = random.Random(seed)
+
+    columns = max(1, int(round(paths ** 0.5)))
+    cell = 100.0
+    rows = (paths + columns - 1) // columns
+
+    out = ['<svg xmlns="http://www.w3.org/2000/svg" width="%g" height="%g">'
+           % (columns*cell, rows*cell)]
+    for i in range(paths):
+        cx = (i % columns + 0.5)*cell + rng.uniform(-5, 5)
+        cy = (i // columns + 0.5)*cell + rng.uniform(-5, 5)
+        radius = cell*0.4*(1 + overlap)
+        sides = rng.randint(6, 12)
+
+        d = [ringPathd(cx, cy, radius, sides, mix, rng)]
+        if rng.random() < holes:
+            d.append(ringPathd(cx, cy, radius*0.5, sides, mix, rng, reverse=True))
+            if rng.random() < 0.5:
+                d.append(ringPathd(cx, cy, radius*0.25, sides, mix, rng))
+        out.append('<path d="%s"/>' % ' '.join(d))
+    out.append('</svg>')
+    return '\n'.join(out)
+
+
+def shapeCounts(blk):
+    shape = blk.base.val()
+    return {'faces': len(shape.Faces()), 'edges': len(shape.Edges())}
+
+
+def runCase(case):
+    '''
+    Runs every stage of one case and returns its results. Meant to run in its
+    own process.
+    '''
+    import svgBlockLib
+
+    folder = tempfile.mkdtemp(prefix='blkBench')
+    svgFile = os.path.join(folder, case['name'] + '.svg')
+    with open(svgFile, 'w') as f:
+        f.write(makeSVG(case['paths'], case['mix'], case['holes'], case['overlap'], case['seed']))
+
+    blk = svgBlockLib.blkLibrary()
+    blk.readSVGFromFile(svgFile)
+    blk.setScale(case['scaleBy'])
+    blk.singleCut = case['singleCut']
+    blk.smoothEdges = case['smooth']
+
+    stl = io.BytesIO()
+    calls = {
+        'exportSVG': lambda: blk.exportSVG(folder=folder + '/', svgName='result.svg'),
+        'exportSTL': lambda: blk.exportSTL(stl),
+    }
+
+    stages = {}
+    for stage in STAGES:
+        if stage in CUT_STAGES[not case['singleCut']]:
+            continue
+        start = time.perf_counter()
+        calls.get(stage, getattr(blk, stage))()
+        seconds = time.perf_counter() - start
+
+        result = {'seconds': round(seconds, 6), 'peakRSS': svgBlockLib.peakRSS()}
+        if stage in ('translate2Dto3D', 'buildBody', 'applyCutter') + CUT_STAGES[False]:
+            result.update(shapeCounts(blk))
+        elif stage == 'exportSVG':
+            result['bytes'] = os.path.getsize(os.path.join(folder, 'result.svg'))
+        elif stage == 'exportSTL':
+            result['bytes'] = len(stl.getvalue())
+            result['triangles'] = (len(stl.getvalue()) - 84)//50
+        stages[stage] = result
+
+    svgBytes = os.path.getsize(svgFile)
+    shutil.rmtree(folder, ignore_errors=True)
+
+    return {'name': case['name'],
+            'paths': case['paths'],
+            'segments': blk.segmentCount(),
+            'mix': case['mix'],
+            'holes': case['holes'],
+            'overlap': case['overlap'],
+            'singleCut': case['singleCut'],
+            'smooth': case['smooth'],
+            'svgBytes': svgBytes,
+            'stages': stages,
+            'totalSeconds': round(sum(stage['seconds'] for stage in stages.values()), 6),
+            }
+
+
+def runMemory(case, builds, every=10):
+    '''
+    Builds one case builds times with the same blkLibrary, reset between
+    builds. Returns the RSS after every build, printed every every builds.
+    Meant to run in its own process.
+    '''
+    import svgBlockLib
+
+    svg = makeSVG(case['paths'], case['mix'], case['holes'], case['overlap'], case['seed']).encode()
+
+    blk = svgBlockLib.blkLibrary()
+    blk.singleCut = case['singleCut']
+    blk.smoothEdges = case['smooth']
+    blk.keepHistory = case['keepHistory']
+
+    samples = []
+    for build in range(1, builds + 1):
+        with blk:
+            blk.readSVGFromBytes(svg)
+            blk.parseSVG()
+            blk.setScale(case['scaleBy'])
+            #A different block each time, so nothing is reused by accident
+            blk.xhollowPercentage = 0.7 + (build % 10)/100
+            blk.buildBlock()
+            blk.stlToBuffer()
+
+        samples.append({'builds': build, 'rss': svgBlockLib.currentRSS()})
+        if build % every == 0:
+            print('%5d builds  RSS %7.1f MB' % (build, samples[-1]['rss']/2**20), flush=True)
+    return samples
+
+
+def memoryGrowth(samples, warmUp=0.3, window=0.2):
+    '''
+    RSS growth in bytes between the first and the last window of samples
+    after the warm up (the first warmUp of the samples, where caches and
+    allocator pools fill). The RSS swings by some MB from one build to the
+    next, so the medians of the windows are compared, not single samples.
+    '''
+    samples = samples[min(int(len(samples)*warmUp), len(samples) - 1):]
+    size = max(1, int(len(samples)*window))
+    first = statistics.median(sample['rss'] for sample in samples[:size])
+    last = statistics.median(sample['rss'] for sample in samples[-size:])
+    return last - first
+
+
+def gitCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def runSuite(cases, repeat=1):
+    '''
+    Runs the cases, each in a fresh process. With repeat > 1 the fastest time
+    of each stage is kept (peak RSS and counts are from the first run).
+    '''
+    context = multiprocessing.get_context('spawn')
+    results = []
+
+    for case in cases:
+        runs = []
+        for _ in range(repeat):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                runs.append(pool.submit(runCase, case).result())
+
+        result = runs[0]
+        for stage, values in result['stages'].items():
+            values['seconds'] = min(run['stages'][stage]['seconds'] for run in runs)
+        result['totalSeconds'] = round(sum(v['seconds'] for v in result['stages'].values()), 6)
+
+        print('%-14s %6d paths %9.3fs  peak %6.0f MB' % (result['name'], result['paths'],
+              result['totalSeconds'], result['stages'][STAGES[-1]]['peakRSS']/2**20))
+        results.append(result)
+
+    import cadquery
+    return {'commit': gitCommit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'cadquery': cadquery.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'repeat': repeat,
+            'cases': results,
+            }
+
+
+def compareResults(old, new):
+    '''
+    Prints the time of each stage of new relative to old, for the cases both
+    have. Ratios above 1 are slower.
+    '''
+    oldCases = {case['name']: case for case in old['cases']}
+
+    print('\n%-14s %-20s %10s %10s %7s' % ('case', 'stage', 'old s', 'new s', 'ratio'))
+    for case in new['cases']:
+        before = oldCases.get(case['name'])
+        if before is None:
+            continue
+        for stage in STAGES + ('total',):
+            if stage == 'total':
+                a, b = before['totalSeconds'], case['totalSeconds']
+            elif stage in before['stages'] and stage in case['stages']:
+                a, b = before['stages'][stage]['seconds'], case['stages'][stage]['seconds']
+            else:
+                continue
+            print('%-14s %-20s %10.4f %10.4f %7.2f' % (case['name'], stage, a, b, b/a if a else float('nan')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the blkLibrary stages on synthetic SVGs')
+    parser.add_argument('--out', default='benchResults.json', help='JSON file to write')
+    parser.add_argument('--compare', help='Earlier results JSON to compare against')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per case, fastest is kept')
+    parser.add_argument('--paths', type=int, nargs='*',
+                        help='Run a single mix over these path counts instead of the default corpus')
+    parser.add_argument('--mix', default='L1,Q1,C1,A1',
+                        help='Segment weights for --paths, e.g. L2,C1,A1')
+    parser.add_argument('--holes', type=float, default=0.0, help='Fraction of shapes with holes (--paths)')
+    parser.add_argument('--overlap', type=float, default=0.0, help='Shape overlap (--paths)')
+    parser.add_argument('--scale', type=float, default=10, help='scaleBy for every case')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--separate-cuts', action='store_true',
+                        help='Cut the hollow, pyramid and feet one at a time (singleCut off)')
+    parser.add_argument('--smooth', action='store_true', help='Fillet the outer edges (smoothEdges)')
+    parser.add_argument('--memory', type=int, metavar='BUILDS',
+                        help='Memory check: build the first case this many times in one process')
+    parser.add_argument('--keep-history', action='store_true',
+                        help='Keep the workplane history in the memory check (keepHistory)')
+    parser.add_argument('--max-growth', type=float, default=32,
+                        help='MB the RSS may grow after the warm up in the memory check')
+    args = parser.parse_args()
+
+    if args.paths:
+        mix = {item[0].upper(): float(item[1:] or 1) for item in args.mix.split(',')}
+        cases = [('custom-%d' % paths, paths, mix, args.holes, args.overlap) for paths in args.paths]
+    else:
+        cases = DEFAULT_CASES
+
+    cases = [{'name': name, 'paths': paths, 'mix': mix, 'holes': holes, 'overlap': overlap,
+              'scaleBy': args.scale, 'seed': args.seed, 'singleCut': not args.separate_cuts,
+              'smooth': args.smooth}
+             for name, paths, mix, holes, overlap in cases]
+
+    if args.memory:
+        case = dict(cases[0], keepHistory=args.keep_history)
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            samples = pool.submit(runMemory, case, args.memory).result()
+
+        growth = memoryGrowth(samples)
+        with open(args.out, 'w') as f:
+            json.dump({'commit': gitCommit(), 'case': case, 'builds': args.memory,
+                       'samples': samples, 'growth': growth}, f, indent=2)
+        print('%s: median RSS grew %.1f MB after the warm up (limit %g MB)' % (case['name'], growth/2**20, args.max_growth))
+        sys.exit(0 if growth <= args.max_growth*2**20 else 1)
+
+    results = runSuite(cases, args.repeat)
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results written to', args.out)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compareResults(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
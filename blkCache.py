@@ -0,0 +1,263 @@
+'''
+Content-addressed on-disk cache for blkLibrary.
+
+Entries are keyed by a hash of the SVG bytes plus the geometry parameters
+that were used to build them. Each key can hold a few kinds of data:
+- npz: the parsed paths (blkPaths arrays)
+- svgattrs: the path attributes and fill-rules, the svg attributes (pickle)
+- neck: the extruded SVG solid (BREP)
+- body: the finished block (BREP)
+- meta: derived numbers that go along with the body (JSON)
+
+The cache is bounded by size. When it grows past maxBytes, the least
+recently used files are removed first. With maxAge set, files that haven't
+been used for that many seconds are removed as well.
+'''
+
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+import svgBlockLib
+from blkPaths import blkPaths
+
+#Temp files older than this (seconds) were left by a crash while writing,
+# scanFolder removes them. Younger ones may still be written by another process.
+TEMP_MAX_AGE = 3600
+
+
+class blkCache:
+
+    def __init__(self, folder='cache', maxBytes=500*1024*1024, maxAge=None):
+        self.folder = folder
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        #filename -> size, oldest first
+        self.index = OrderedDict()
+        #filename -> time of last use
+        self.lastUsed = {}
+        self.currentBytes = 0
+
+        self.lock = threading.Lock()
+
+        os.makedirs(self.folder, exist_ok=True)
+        self.scanFolder()
+        self.evict()
+
+
+    def scanFolder(self):
+        '''
+        Builds the LRU index from what is already on disk. Modification time
+        is used as the last access time. Temp files older than TEMP_MAX_AGE
+        are removed.
+        '''
+        now = time.time()
+        entries = []
+        for root, dirs, files in os.walk(self.folder):
+            for name in files:
+                fileName = os.path.join(root, name)
+                #Half written files, '.tmp.' keeps the real extension for writers that need it
+                if name.endswith('.tmp') or '.tmp.' in name:
+                    try:
+                        if now - os.stat(fileName).st_mtime > TEMP_MAX_AGE:
+                            os.remove(fileName)
+                    except OSError:
+                        #Finished or removed by its writer meanwhile
+                        pass
+                    continue
+                st = os.stat(fileName)
+                entries.append((st.st_mtime, fileName, st.st_size))
+
+        entries.sort()
+        self.index = OrderedDict((fileName, size) for _, fileName, size in entries)
+        self.lastUsed = {fileName: mtime for mtime, fileName, _ in entries}
+        self.currentBytes = sum(self.index.values())
+
+
+    @staticmethod
+    def hashBytes(data):
+        '''Returns the hex sha256 of some bytes'''
+        return hashlib.sha256(data).hexdigest()
+
+
+    @staticmethod
+    def makeKey(svgHash, params=None):
+        '''
+        Combines the SVG hash with a dict of geometry parameters. Parameters
+        are sorted so the order they were set in doesn't matter.
+        '''
+        if not params:
+            return svgHash
+
+        paramString = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256((svgHash + paramString).encode()).hexdigest()
+
+
+    def fileNameFor(self, key, kind):
+        #Fan out over sub folders to keep folder listings short
+        return os.path.join(self.folder, key[:2], key + '.' + kind)
+
+
+    def get(self, key, kind):
+        '''
+        Returns the stored bytes or None. Counts a hit or a miss.
+        '''
+        fileName = self.fileNameFor(key, kind)
+
+        try:
+            with open(fileName, 'rb') as f:
+                data = f.read()
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+        self.touch(fileName, len(data))
+
+        return data
+
+
+    def touch(self, fileName, size):
+        '''Marks a file as just used'''
+        with self.lock:
+            if fileName in self.index:
+                self.index.move_to_end(fileName)
+            else:
+                self.index[fileName] = size
+                self.currentBytes += size
+            self.lastUsed[fileName] = time.time()
+
+        #Keep the access time on disk for the next scanFolder
+        try:
+            os.utime(fileName)
+        except OSError:
+            pass
+
+
+    def put(self, key, kind, data):
+        '''
+        Stores bytes for a key. The file is written to a temp name first so
+        readers never see half a file. Evicts old entries if needed.
+        '''
+        fileName = self.fileNameFor(key, kind)
+        os.makedirs(os.path.dirname(fileName), exist_ok=True)
+
+        tempName = fileName + '.' + str(threading.get_ident()) + '.tmp'
+        with open(tempName, 'wb') as f:
+            f.write(data)
+        os.replace(tempName, fileName)
+
+        with self.lock:
+            self.currentBytes -= self.index.pop(fileName, 0)
+            self.index[fileName] = len(data)
+            self.lastUsed[fileName] = time.time()
+            self.currentBytes += len(data)
+
+        self.evict()
+
+
+    def evict(self):
+        '''
+        Removes the least recently used files until the cache fits in maxBytes,
+        and any that weren't used in the last maxAge seconds.
+        '''
+        oldest = None if self.maxAge is None else time.time() - self.maxAge
+
+        with self.lock:
+            while self.index:
+                fileName = next(iter(self.index))
+                if self.currentBytes <= self.maxBytes and (
+                        oldest is None or self.lastUsed.get(fileName, 0) >= oldest):
+                    break
+
+                size = self.index.pop(fileName)
+                self.lastUsed.pop(fileName, None)
+                self.currentBytes -= size
+                self.evictions += 1
+                try:
+                    os.remove(fileName)
+                except OSError:
+                    pass
+
+
+    def clear(self):
+        with self.lock:
+            for fileName in self.index:
+                try:
+                    os.remove(fileName)
+                except OSError:
+                    pass
+            self.index.clear()
+            self.lastUsed.clear()
+            self.currentBytes = 0
+
+
+    def stats(self):
+        '''
+        Returns hit/miss counters and the current size of the cache
+        '''
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self.index),
+                    'bytes': self.currentBytes,
+                    'maxBytes': self.maxBytes,
+                    }
+
+
+    def getShape(self, key, kind):
+        data = self.get(key, kind)
+        if data is None:
+            return None
+        return svgBlockLib.brepToShape(data)
+
+
+    def putShape(self, key, kind, shape):
+        self.put(key, kind, svgBlockLib.shapeToBrep(shape))
+
+
+    def getObject(self, key, kind):
+        '''Pickled python objects, e.g. the path attributes'''
+        data = self.get(key, kind)
+        if data is None:
+            return None
+        return pickle.loads(data)
+
+
+    def putObject(self, key, kind, obj):
+        self.put(key, kind, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+    def getPaths(self, key):
+        '''Parsed paths. The arrays point into the bytes read, no copy.'''
+        data = self.get(key, 'npz')
+        if data is None:
+            return None
+        return blkPaths.fromBytes(data)
+
+
+    def putPaths(self, key, paths):
+        self.put(key, 'npz', paths.toBytes())
+
+
+    def getMeta(self, key):
+        data = self.get(key, 'meta')
+        if data is None:
+            return None
+        return json.loads(data)
+
+
+    def putMeta(self, key, meta):
+        self.put(key, 'meta', json.dumps(meta).encode())
@@ -0,0 +1,165 @@
+'''
+Small background job queue for block creation.
+
+Jobs run on a bounded thread pool. Each session can only have one live job,
+submitting a new one cancels the older one. Running jobs are cancelled
+cooperatively: the job function calls setStage() between stages, which
+raises jobCancelled once cancel() has been called.
+'''
+
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class jobCancelled(Exception):
+    pass
+
+
+class queueFull(Exception):
+    pass
+
+
+class blkJob:
+
+    def __init__(self, sessionId, fn):
+        self.id = str(uuid.uuid4())
+        self.sessionId = sessionId
+        self.fn = fn
+
+        #queued, running, done, error or cancelled
+        self.status = 'queued'
+        self.stage = None
+        self.result = None
+        self.error = None
+
+        self.cancelEvent = threading.Event()
+        self.future = None
+
+
+    def cancel(self):
+        self.cancelEvent.set()
+        #Jobs that never started won't run at all
+        if self.future is not None and self.future.cancel():
+            self.status = 'cancelled'
+
+
+    def isCancelled(self):
+        return self.cancelEvent.is_set()
+
+
+    def checkCancelled(self):
+        if self.cancelEvent.is_set():
+            raise jobCancelled(self.id)
+
+
+    def setStage(self, stage):
+        '''
+        Called by the job between stages. Raises jobCancelled if the job
+        has been cancelled in the meantime.
+        '''
+        self.checkCancelled()
+        self.stage = stage
+
+
+    def isFinished(self):
+        return self.status in ('done', 'error', 'cancelled')
+
+
+    def toDict(self):
+        return {'jobId': self.id,
+                'status': self.status,
+                'stage': self.stage,
+                'error': self.error,
+                }
+
+
+class jobQueue:
+
+    def __init__(self, maxWorkers=2, maxQueued=8, keepFinished=256):
+        '''
+        maxWorkers jobs run at the same time. At most maxQueued more can wait
+        for a worker, after that submit raises queueFull.
+        '''
+        self.maxWorkers = maxWorkers
+        self.maxQueued = maxQueued
+        self.keepFinished = keepFinished
+
+        self.executor = ThreadPoolExecutor(max_workers=maxWorkers,
+                                           thread_name_prefix='blkJob')
+        self.lock = threading.Lock()
+
+        self.jobs = OrderedDict()
+        self.sessionJobs = {}
+
+
+    def pendingCount(self):
+        return sum(1 for job in self.jobs.values() if not job.isFinished())
+
+
+    def submit(self, sessionId, fn):
+        '''
+        Queues fn(job) for the session and returns the job. Any older job of
+        the same session is cancelled first.
+        '''
+        with self.lock:
+            older = self.sessionJobs.get(sessionId)
+            if older is not None and not older.isFinished():
+                older.cancel()
+
+            if self.pendingCount() >= self.maxWorkers + self.maxQueued:
+                raise queueFull()
+
+            job = blkJob(sessionId, fn)
+            self.jobs[job.id] = job
+            self.sessionJobs[sessionId] = job
+            self.dropFinished()
+
+            job.future = self.executor.submit(self.run, job)
+
+        return job
+
+
+    def run(self, job):
+        if job.isCancelled():
+            job.status = 'cancelled'
+            return
+
+        job.status = 'running'
+        try:
+            job.result = job.fn(job)
+            job.status = 'done'
+        except jobCancelled:
+            job.status = 'cancelled'
+        except Exception as e:
+            job.error = str(e)
+            job.status = 'error'
+
+
+    def get(self, jobId):
+        return self.jobs.get(jobId)
+
+
+    def cancelSession(self, sessionId):
+        with self.lock:
+            job = self.sessionJobs.get(sessionId)
+            if job is not None and not job.isFinished():
+                job.cancel()
+
+
+    def dropFinished(self):
+        #Only keep the last few finished jobs around for status lookups
+        finished = [jobId for jobId, job in self.jobs.items() if job.isFinished()]
+        for jobId in finished[:max(0, len(finished) - self.keepFinished)]:
+            job = self.jobs.pop(jobId)
+            if self.sessionJobs.get(job.sessionId) is job:
+                del self.sessionJobs[job.sessionId]
+
+
+    def shutdown(self):
+        with self.lock:
+            for job in self.jobs.values():
+                if not job.isFinished():
+                    job.cancel()
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,178 @@
+'''
+Stage metrics for blkLibrary, rendered in the Prometheus text format.
+
+blkLibrary records every stage it runs (see svgBlockLib.timedStage). When
+blk.metrics is set to a blkMetrics, the records are aggregated here into
+histograms per stage:
+- pressblock_stage_seconds: how long the stage took
+- pressblock_stage_segments: path segments the stage worked on
+- pressblock_stage_faces: faces of the solid after the stage
+
+along with the memory use after the last run of each stage, the peak memory
+of the process, job counts and the quality levels buildBlockWithin gave up
+on (pressblock_stage_errors_total). render() returns the text for a /metrics route.
+'''
+
+import threading
+
+from svgBlockLib import peakRSS
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+COUNT_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000)
+
+
+class histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+    def lines(self, name, labels):
+        '''Prometheus lines of the histogram, buckets are cumulative'''
+        out = []
+        for bound, count in zip(self.buckets, self.counts):
+            out.append('%s_bucket%s %d' % (name, formatLabels(labels, le=formatValue(bound)), count))
+        out.append('%s_bucket%s %d' % (name, formatLabels(labels, le='+Inf'), self.count))
+        out.append('%s_sum%s %s' % (name, formatLabels(labels), formatValue(self.sum)))
+        out.append('%s_count%s %d' % (name, formatLabels(labels), self.count))
+        return out
+
+
+def formatValue(value):
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def formatLabels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join('%s="%s"' % (key, value) for key, value in zip(labels, escaped)) + '}'
+
+
+class blkMetrics:
+
+    def __init__(self, prefix='pressblock'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+
+        #stage -> histogram
+        self.seconds = {}
+        self.segments = {}
+        self.faces = {}
+
+        #stage -> rss in bytes after the last run
+        self.rss = {}
+
+        #(stage, quality, error) -> count, records with an error
+        self.errors = {}
+
+        #status -> count
+        self.jobs = {}
+
+        #name -> (help, {labels tuple: value}), set from outside (e.g. cache stats)
+        self.gauges = {}
+
+
+    def record(self, record):
+        '''
+        Adds one stage record (a dict as made by blkLibrary.recordStage)
+        '''
+        stage = record['stage']
+        with self.lock:
+            self.seconds.setdefault(stage, histogram(SECONDS_BUCKETS)).observe(record['seconds'])
+            self.segments.setdefault(stage, histogram(COUNT_BUCKETS)).observe(record['segments'])
+            if record['faces']:
+                self.faces.setdefault(stage, histogram(COUNT_BUCKETS)).observe(record['faces'])
+            self.rss[stage] = record['rss']
+            if 'error' in record:
+                #Messages vary, only timeouts are told apart
+                error = 'timeout' if record['error'] == 'timeout' else 'failed'
+                key = (stage, record.get('quality', ''), error)
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+
+    def countJob(self, status):
+        with self.lock:
+            self.jobs[status] = self.jobs.get(status, 0) + 1
+
+
+    def setGauge(self, name, help, value, **labels):
+        with self.lock:
+            values = self.gauges.setdefault(name, (help, {}))[1]
+            values[tuple(sorted(labels.items()))] = value
+
+
+    def render(self):
+        '''
+        Returns all metrics in the Prometheus text format
+        '''
+        p = self.prefix
+        out = []
+
+        with self.lock:
+            for name, help, histograms in (
+                    ('stage_seconds', 'Time spent in each blkLibrary stage', self.seconds),
+                    ('stage_segments', 'Path segments worked on by each stage', self.segments),
+                    ('stage_faces', 'Faces of the solid after each stage', self.faces)):
+                out.append('# HELP %s_%s %s' % (p, name, help))
+                out.append('# TYPE %s_%s histogram' % (p, name))
+                for stage in sorted(histograms):
+                    out.extend(histograms[stage].lines('%s_%s' % (p, name), {'stage': stage}))
+
+            out.append('# HELP %s_stage_rss_bytes Resident memory after the last run of each stage' % p)
+            out.append('# TYPE %s_stage_rss_bytes gauge' % p)
+            for stage in sorted(self.rss):
+                out.append('%s_stage_rss_bytes%s %d' % (p, formatLabels({'stage': stage}), self.rss[stage]))
+
+            out.append('# HELP %s_stage_errors_total Stage runs that timed out or failed' % p)
+            out.append('# TYPE %s_stage_errors_total counter' % p)
+            for (stage, quality, error), count in sorted(self.errors.items()):
+                out.append('%s_stage_errors_total%s %d'
+                           % (p, formatLabels({'stage': stage, 'quality': quality, 'error': error}), count))
+
+            out.append('# HELP %s_jobs_total Block jobs by final status' % p)
+            out.append('# TYPE %s_jobs_total counter' % p)
+            for status in sorted(self.jobs):
+                out.append('%s_jobs_total%s %d' % (p, formatLabels({'status': status}), self.jobs[status]))
+
+            for name in sorted(self.gauges):
+                help, values = self.gauges[name]
+                out.append('# HELP %s_%s %s' % (p, name, help))
+                out.append('# TYPE %s_%s gauge' % (p, name))
+                for labels, value in sorted(values.items()):
+                    out.append('%s_%s%s %s' % (p, name, formatLabels(dict(labels)), formatValue(value)))
+
+        out.append('# HELP %s_process_peak_rss_bytes Peak resident memory of the process' % p)
+        out.append('# TYPE %s_process_peak_rss_bytes gauge' % p)
+        out.append('%s_process_peak_rss_bytes %d' % (p, peakRSS()))
+
+        return '\n'.join(out) + '\n'
+
+
+def formatBreakdown(stageLog, limit=6):
+    '''
+    Short text of where the time of a job went, slowest stages first. Used in
+    the alerts.
+    '''
+    stages = [record for record in stageLog if record['stage'] != 'buildBlock']
+    total = sum(record['seconds'] for record in stages)
+    slowest = sorted(stages, key=lambda record: record['seconds'], reverse=True)[:limit]
+
+    parts = ['%s %.2fs' % (record['stage'], record['seconds']) for record in slowest]
+    peak = max((record['peakRSS'] for record in stageLog), default=0)
+    return 'Took %.2fs (%s). Peak memory %d MB.' % (total, ', '.join(parts), peak // 2**20)
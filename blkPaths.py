@@ -0,0 +1,385 @@
+'''
+Compact storage for the parsed paths of an SVG.
+
+svgpathtools keeps every segment as its own Python object with complex
+fields, which adds up to tens of MB for a detailed SVG and is slow to pickle
+to workers and caches. blkPaths keeps a whole document in three arrays:
+
+- codes: one uint8 per segment (LINE, QUADRATIC, CUBIC, ARC)
+- points: float64 (n, 2), the points of all segments one after the other.
+  Lines have start, end. Quadratics start, control, end. Cubics start,
+  control1, control2, end. Arcs start, radius (rx, ry), (rotation in degrees,
+  large_arc + 2*sweep), end.
+- pathOffsets: path i is segments pathOffsets[i]:pathOffsets[i+1]
+
+paths[i] is a pathView that can be iterated like an svgpathtools Path
+(segments are made as needed). Slices and take() give new blkPaths.
+
+Saved as an uncompressed .npz. Reading it back (fromBytes, load) gives
+arrays that point into the bytes or the memory mapped file, nothing is
+copied. Those arrays are read only, a blkPaths is never changed in place.
+
+    paths = blkPaths.fromPaths(svgpathtools_paths)
+    data = paths.toBytes()
+    paths = blkPaths.fromBytes(data)
+'''
+
+import io
+import struct
+import zipfile
+
+import numpy as np
+import svgpathtools
+
+
+LINE, QUADRATIC, CUBIC, ARC = 0, 1, 2, 3
+
+#Points per segment, by code
+POINT_COUNTS = np.array([2, 3, 4, 4], dtype=np.int64)
+
+#Arrays saved in the .npz, the segment offsets are worked out again on load
+NPZ_ARRAYS = ('codes', 'points', 'pathOffsets')
+
+
+def segmentPoints(seg):
+    '''Code and points (complex) of one svgpathtools segment'''
+    if isinstance(seg, svgpathtools.CubicBezier):
+        return CUBIC, (seg.start, seg.control1, seg.control2, seg.end)
+    elif isinstance(seg, svgpathtools.QuadraticBezier):
+        return QUADRATIC, (seg.start, seg.control, seg.end)
+    elif isinstance(seg, svgpathtools.Arc):
+        flags = int(bool(seg.large_arc)) + 2*int(bool(seg.sweep))
+        return ARC, (seg.start, seg.radius, complex(seg.rotation, flags), seg.end)
+    return LINE, (seg.start, seg.end)
+
+
+def pathParts(path):
+    '''
+    codes (uint8) and points (float64, (n, 2)) of one svgpathtools path. Used
+    to convert each path as soon as it is parsed.
+    '''
+    codes = []
+    points = []
+    for seg in path:
+        code, segPoints = segmentPoints(seg)
+        codes.append(code)
+        points.extend(segPoints)
+    return (np.array(codes, dtype=np.uint8),
+            np.array(points, dtype=complex).view(np.float64).reshape(-1, 2))
+
+
+def npzArrays(zf, buf):
+    '''
+    Arrays of an open .npz (zipfile) as views into buf, which holds the
+    bytes of the whole zip. Members have to be stored, not compressed.
+    '''
+    arrays = {}
+    for info in zf.infolist():
+        name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+        if info.compress_type != zipfile.ZIP_STORED:
+            raise ValueError('%s is compressed, can only read stored .npz members' % info.filename)
+
+        #Local file header: 30 bytes, then the name and the extra field
+        nameLength, extraLength = struct.unpack('<HH', bytes(buf[info.header_offset + 26:info.header_offset + 30]))
+        start = info.header_offset + 30 + nameLength + extraLength
+
+        with zf.open(info) as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+            headerLength = f.tell()
+
+        if dtype.hasobject:
+            raise ValueError('%s holds Python objects' % info.filename)
+
+        count = int(np.prod(shape))
+        array = np.frombuffer(buf, dtype=dtype, count=count, offset=start + headerLength)
+        arrays[name] = array.reshape(shape, order='F' if fortran else 'C')
+    return arrays
+
+
+class blkPaths:
+
+    __slots__ = ('codes', 'points', 'pathOffsets', 'segmentOffsets')
+
+    def __init__(self, codes=None, points=None, pathOffsets=None):
+        '''
+        Empty if nothing is given. points is a float64 (n, 2) array (or
+        anything that reshapes to one).
+        '''
+        self.codes = np.zeros(0, dtype=np.uint8) if codes is None else np.asarray(codes, dtype=np.uint8)
+        self.points = (np.zeros((0, 2)) if points is None
+                       else np.asarray(points, dtype=np.float64).reshape(-1, 2))
+        self.pathOffsets = (np.zeros(1, dtype=np.int64) if pathOffsets is None
+                            else np.asarray(pathOffsets, dtype=np.int64))
+
+        #First point of each segment
+        self.segmentOffsets = np.zeros(len(self.codes) + 1, dtype=np.int64)
+        np.cumsum(POINT_COUNTS[self.codes], out=self.segmentOffsets[1:])
+
+        if self.segmentOffsets[-1] != len(self.points) or self.pathOffsets[-1] != len(self.codes):
+            raise ValueError('Path arrays do not match: %d segments need %d points, got %d'
+                             % (len(self.codes), self.segmentOffsets[-1], len(self.points)))
+
+
+    @classmethod
+    def fromPaths(cls, paths):
+        '''From svgpathtools paths (or anything that iterates segments)'''
+        return cls.fromParts([pathParts(path) for path in paths])
+
+
+    @classmethod
+    def fromParts(cls, parts):
+        '''From a list of (codes, points), one per path, see pathParts'''
+        if not parts:
+            return cls()
+        codes = [part[0] for part in parts]
+        pathOffsets = np.zeros(len(parts) + 1, dtype=np.int64)
+        np.cumsum([len(part) for part in codes], out=pathOffsets[1:])
+        return cls(np.concatenate(codes), np.concatenate([part[1] for part in parts]), pathOffsets)
+
+
+    @classmethod
+    def concatenate(cls, parts):
+        '''Joins several blkPaths into one, paths in order'''
+        parts = [part for part in parts if len(part)]
+        if not parts:
+            return cls()
+        if len(parts) == 1:
+            return parts[0]
+
+        pathOffsets = [parts[0].pathOffsets]
+        for part in parts[1:]:
+            pathOffsets.append(part.pathOffsets[1:] + pathOffsets[-1][-1])
+        return cls(np.concatenate([part.codes for part in parts]),
+                   np.concatenate([part.points for part in parts]),
+                   np.concatenate(pathOffsets))
+
+
+    def __len__(self):
+        return len(self.pathOffsets) - 1
+
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield pathView(self, i)
+
+
+    def __getitem__(self, index):
+        '''
+        A pathView for an int, a blkPaths for a slice. A plain slice shares
+        the arrays with this one.
+        '''
+        if isinstance(index, slice):
+            first, last, step = index.indices(len(self))
+            if step != 1:
+                return self.take(range(first, last, step))
+            last = max(first, last)
+            segmentStart, segmentEnd = self.pathOffsets[first], self.pathOffsets[last]
+            return blkPaths(self.codes[segmentStart:segmentEnd],
+                            self.points[self.segmentOffsets[segmentStart]:self.segmentOffsets[segmentEnd]],
+                            self.pathOffsets[first:last + 1] - segmentStart)
+
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('path index out of range')
+        return pathView(self, index)
+
+
+    def __reduce__(self):
+        #Plain arrays, also for the read only views of fromBytes and load
+        return (blkPaths, (np.ascontiguousarray(self.codes), np.ascontiguousarray(self.points),
+                           np.ascontiguousarray(self.pathOffsets)))
+
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.points.nbytes + self.pathOffsets.nbytes + self.segmentOffsets.nbytes
+
+
+    def complexPoints(self):
+        '''The points as a complex array (a view, not a copy)'''
+        return np.ascontiguousarray(self.points).view(np.complex128)[:, 0]
+
+
+    def segmentCount(self):
+        return len(self.codes)
+
+
+    def segmentCounts(self):
+        '''Segments per path'''
+        return np.diff(self.pathOffsets)
+
+
+    def segmentOwners(self):
+        '''Path index of every segment'''
+        return np.repeat(np.arange(len(self)), self.segmentCounts())
+
+
+    def segment(self, k):
+        '''Segment k (counted over the whole document) as an svgpathtools segment'''
+        code = int(self.codes[k])
+        p = self.complexPoints()[self.segmentOffsets[k]:self.segmentOffsets[k + 1]].tolist()
+        if code == LINE:
+            return svgpathtools.Line(p[0], p[1])
+        elif code == QUADRATIC:
+            return svgpathtools.QuadraticBezier(p[0], p[1], p[2])
+        elif code == CUBIC:
+            return svgpathtools.CubicBezier(p[0], p[1], p[2], p[3])
+        flags = int(p[2].imag)
+        return svgpathtools.Arc(p[0], p[1], p[2].real, bool(flags & 1), bool(flags & 2), p[3])
+
+
+    def take(self, indices):
+        '''New blkPaths with just the paths at indices, in that order'''
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+
+        #Segments of the kept paths, then their points
+        counts = self.segmentCounts()[indices]
+        segments = np.arange(counts.sum()) + np.repeat(self.pathOffsets[indices] - np.cumsum(counts) + counts, counts)
+
+        pointCounts = POINT_COUNTS[self.codes[segments]]
+        starts = self.segmentOffsets[segments]
+        points = np.arange(pointCounts.sum()) + np.repeat(starts - np.cumsum(pointCounts) + pointCounts, pointCounts)
+
+        pathOffsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(counts, out=pathOffsets[1:])
+        return blkPaths(self.codes[segments], self.points[points], pathOffsets)
+
+
+    def without(self, skip):
+        '''
+        Leaves out the path numbers in skip (e.g. skipPathNumber). Numbers
+        that don't exist are ignored. Returns self if nothing is left out.
+        '''
+        keep = np.ones(len(self), dtype=bool)
+        skip = [idx for idx in skip if 0 <= idx < len(self)]
+        if not skip:
+            return self
+        keep[skip] = False
+        return self.take(np.flatnonzero(keep))
+
+
+    def toPaths(self):
+        '''Back to a list of svgpathtools paths'''
+        return [path.toPath() for path in self]
+
+
+    def save(self, fileObj):
+        '''
+        Writes an uncompressed .npz to a file object or file name (numpy adds
+        .npz to names without it)
+        '''
+        np.savez(fileObj, codes=self.codes, points=self.points, pathOffsets=self.pathOffsets)
+
+
+    def toBytes(self):
+        buf = io.BytesIO()
+        self.save(buf)
+        return buf.getvalue()
+
+
+    @classmethod
+    def fromBytes(cls, data):
+        '''From the bytes of a .npz. The arrays are views into data.'''
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            arrays = npzArrays(zf, data)
+        return cls(*(arrays[name] for name in NPZ_ARRAYS))
+
+
+    @classmethod
+    def load(cls, fileName):
+        '''From a .npz file. The file is memory mapped, not read in.'''
+        buf = np.memmap(fileName, dtype=np.uint8, mode='r')
+        with zipfile.ZipFile(fileName) as zf:
+            arrays = npzArrays(zf, buf)
+        return cls(*(arrays[name] for name in NPZ_ARRAYS))
+
+
+class pathView:
+    '''
+    One path of a blkPaths. Iterates svgpathtools segments (made as needed),
+    the codes and points properties are views of the shared arrays.
+    '''
+
+    __slots__ = ('paths', 'index')
+
+    def __init__(self, paths, index):
+        self.paths = paths
+        self.index = index
+
+
+    def segmentRange(self):
+        return int(self.paths.pathOffsets[self.index]), int(self.paths.pathOffsets[self.index + 1])
+
+
+    def __len__(self):
+        first, last = self.segmentRange()
+        return last - first
+
+
+    def __iter__(self):
+        first, last = self.segmentRange()
+        for k in range(first, last):
+            yield self.paths.segment(k)
+
+
+    def __getitem__(self, k):
+        first, last = self.segmentRange()
+        if k < 0:
+            k += last - first
+        if not 0 <= k < last - first:
+            raise IndexError('segment index out of range')
+        return self.paths.segment(first + k)
+
+
+    @property
+    def codes(self):
+        first, last = self.segmentRange()
+        return self.paths.codes[first:last]
+
+
+    @property
+    def points(self):
+        first, last = self.segmentRange()
+        return self.paths.points[self.paths.segmentOffsets[first]:self.paths.segmentOffsets[last]]
+
+
+    def complexPoints(self):
+        first, last = self.segmentRange()
+        return self.paths.complexPoints()[self.paths.segmentOffsets[first]:self.paths.segmentOffsets[last]]
+
+
+    def toPath(self):
+        return svgpathtools.Path(*self)
+
+
+    def d(self):
+        '''SVG path data, straight from the arrays'''
+        parts = []
+        current = None
+        i = 0
+        points = self.complexPoints().tolist()
+        for code in self.codes.tolist():
+            p = points[i:i + POINT_COUNTS[code]]
+            i += POINT_COUNTS[code]
+
+            if p[0] != current:
+                parts.append('M %r,%r' % (p[0].real, p[0].imag))
+            if code == LINE:
+                parts.append('L %r,%r' % (p[1].real, p[1].imag))
+            elif code == QUADRATIC:
+                parts.append('Q %r,%r %r,%r' % (p[1].real, p[1].imag, p[2].real, p[2].imag))
+            elif code == CUBIC:
+                parts.append('C %r,%r %r,%r %r,%r' % (p[1].real, p[1].imag, p[2].real, p[2].imag,
+                                                      p[3].real, p[3].imag))
+            else:
+                flags = int(p[2].imag)
+                parts.append('A %r,%r %r %d,%d %r,%r' % (p[1].real, p[1].imag, p[2].real,
+                                                         flags & 1, flags >> 1, p[3].real, p[3].imag))
+            current = p[-1]
+        return ' '.join(parts)
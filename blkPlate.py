@@ -0,0 +1,279 @@
+'''
+Packs many blocks onto print bed plates and writes each plate as one STL.
+
+    plate = blkPlate.blkPlate(bedWidth=220, bedDepth=220)
+    plate.add(blk, copies=20)
+    plate.add(otherBlk)
+    for i in range(len(plate.pack())):
+        plate.exportSTL('plate-%d.stl' % (i + 1), i)
+
+Each different block is tessellated once and turned into STL records once.
+Copies are placed by offsetting those records, nothing is unioned in CAD, so
+a 50 copy plate costs one tessellation and 50 array additions.
+
+Footprints are packed with shelves, tallest first. Parts are turned 90
+degrees when that fits better. Whatever doesn't fit on a plate goes on the
+next one.
+
+Can also be run on STL files, e.g. the output of blkBatch:
+
+    python blkPlate.py blocks/a.stl blocks/b.stl:10 --bed 220x220 --out plate
+'''
+
+import argparse
+import json
+import sys
+
+import numpy as np
+
+import svgBlockLib
+
+
+class blkPlate:
+
+    def __init__(self, bedWidth=220, bedDepth=220, spacing=5, margin=5, allowRotate=True):
+        '''
+        Sizes are in printed millimetres. spacing is the gap between parts,
+        margin the gap to the edge of the bed.
+        '''
+        self.bedWidth = bedWidth
+        self.bedDepth = bedDepth
+        self.spacing = spacing
+        self.margin = margin
+        self.allowRotate = allowRotate
+
+        #key -> STL records moved so the part's lowest corner is at 0,0,0
+        self.parts = {}
+        #(key, rotated) -> records, filled in as needed
+        self.rotatedParts = {}
+
+        #One key per copy, in the order they were added
+        self.copies = []
+
+        self.plates = None
+
+
+    def add(self, blk, copies=1, axis='XYZ', key=None):
+        '''
+        Adds copies of a built block. Blocks with the same key are only
+        tessellated once. The default key is the SVG hash plus the geometry
+        parameters when known, otherwise the blkLibrary itself.
+        '''
+        if key is None:
+            key = blockKey(blk, axis)
+
+        if key not in self.parts:
+            vertices, triangles = blk.tessellate(axis)
+            self.addRecords(key, svgBlockLib.stlRecords(vertices, triangles))
+
+        self.copies.extend([key] * copies)
+        self.plates = None
+        return key
+
+
+    def addSTL(self, fileName, copies=1):
+        '''Adds copies of a binary STL file'''
+        if fileName not in self.parts:
+            self.addRecords(fileName, readSTLRecords(fileName))
+
+        self.copies.extend([fileName] * copies)
+        self.plates = None
+        return fileName
+
+
+    def addRecords(self, key, records):
+        low = records['vertices'].reshape(-1, 3).min(axis=0)
+        records['vertices'] -= low
+        self.parts[key] = records
+
+
+    def footprint(self, key):
+        high = self.parts[key]['vertices'].reshape(-1, 3).max(axis=0)
+        return float(high[0]), float(high[1])
+
+
+    def partRecords(self, key, rotated):
+        '''Records of a part, turned 90 degrees about Z if rotated'''
+        if not rotated:
+            return self.parts[key]
+
+        if (key, rotated) not in self.rotatedParts:
+            records = self.parts[key].copy()
+            for field in ('normal', 'vertices'):
+                x = records[field][..., 0].copy()
+                records[field][..., 0] = -records[field][..., 1]
+                records[field][..., 1] = x
+            #Back to the lowest corner at 0,0
+            records['vertices'][..., 0] += self.footprint(key)[1]
+            self.rotatedParts[(key, rotated)] = records
+
+        return self.rotatedParts[(key, rotated)]
+
+
+    def pack(self):
+        '''
+        Places all copies. Returns a list of plates, each a list of
+        (key, x, y, rotated) with x, y the lowest corner of the part.
+        Raises ValueError if a part is bigger than the bed.
+        '''
+        usableWidth = self.bedWidth - 2*self.margin
+        usableDepth = self.bedDepth - 2*self.margin
+
+        items = []
+        for key in self.copies:
+            width, depth = self.footprint(key)
+            rotated = False
+            #Long side along the shelf keeps the shelves low
+            if self.allowRotate and depth > width and depth <= usableWidth:
+                width, depth, rotated = depth, width, True
+            if width > usableWidth or depth > usableDepth:
+                if self.allowRotate and depth <= usableWidth and width <= usableDepth:
+                    width, depth, rotated = depth, width, not rotated
+                else:
+                    raise ValueError('Part %s (%.1f x %.1f mm) does not fit on the %g x %g mm bed'
+                                     % (key, width, depth, self.bedWidth, self.bedDepth))
+            items.append((depth, width, key, rotated))
+
+        #Tallest first, same parts stay together
+        items.sort(key=lambda item: (-item[0], -item[1], str(item[2])))
+
+        plates = []
+        #Per plate: list of shelves [y, depth, next free x]
+        shelves = []
+
+        for depth, width, key, rotated in items:
+            placed = False
+            for plate, plateShelves in zip(plates, shelves):
+                for shelf in plateShelves:
+                    if depth <= shelf[1] and shelf[2] + width <= usableWidth:
+                        plate.append((key, self.margin + shelf[2], self.margin + shelf[0], rotated))
+                        shelf[2] += width + self.spacing
+                        placed = True
+                        break
+                if placed:
+                    break
+
+                #New shelf on this plate
+                top = plateShelves[-1][0] + plateShelves[-1][1] + self.spacing
+                if top + depth <= usableDepth:
+                    plateShelves.append([top, depth, width + self.spacing])
+                    plate.append((key, self.margin, self.margin + top, rotated))
+                    placed = True
+                    break
+
+            if not placed:
+                plates.append([(key, self.margin, self.margin, rotated)])
+                shelves.append([[0, depth, width + self.spacing]])
+
+        self.plates = plates
+        return plates
+
+
+    def triangleCount(self, plateIndex=0):
+        plate = self.packed()[plateIndex]
+        return sum(len(self.parts[key]) for key, x, y, rotated in plate)
+
+
+    def packed(self):
+        if self.plates is None:
+            self.pack()
+        return self.plates
+
+
+    def writeSTL(self, fileObj, plateIndex=0):
+        '''
+        Writes one plate as a single binary STL. Each copy is the part's
+        records moved into place, written one copy at a time.
+        '''
+        plate = self.packed()[plateIndex]
+        svgBlockLib.writeSTLHeader(fileObj, self.triangleCount(plateIndex), b'pressBlock3D plate')
+
+        for key, x, y, rotated in plate:
+            records = self.partRecords(key, rotated).copy()
+            records['vertices'] += np.array([x, y, 0], dtype=np.float32)
+            fileObj.write(records.tobytes())
+
+
+    def exportSTL(self, stlName, plateIndex=0):
+        with open(stlName, 'wb') as f:
+            self.writeSTL(f, plateIndex)
+        return stlName
+
+
+    def layout(self):
+        '''
+        The placements as plain data (for a manifest or the UI)
+        '''
+        out = []
+        for plate in self.packed():
+            out.append([{'part': str(key), 'x': round(x, 3), 'y': round(y, 3),
+                         'rotated': rotated,
+                         'width': round(self.footprint(key)[1 if rotated else 0], 3),
+                         'depth': round(self.footprint(key)[0 if rotated else 1], 3)}
+                        for key, x, y, rotated in plate])
+        return out
+
+
+def blockKey(blk, axis='XYZ'):
+    '''
+    Key that is the same for blocks that come out the same. Falls back to the
+    blkLibrary itself when the SVG hash is not known (no cache).
+    '''
+    if blk.svgHash is None:
+        return blk
+
+    params = blk.geometryParams()
+    params.update({'axis': axis,
+                   'stlLinearTolerance': blk.stlLinearTolerance,
+                   'stlAngularTolerance': blk.stlAngularTolerance})
+    return blk.svgHash + json.dumps(params, sort_keys=True, default=str)
+
+
+def readSTLRecords(fileName):
+    '''Reads a binary STL into STL records'''
+    with open(fileName, 'rb') as f:
+        f.seek(80)
+        count = int(np.frombuffer(f.read(4), dtype='<u4')[0])
+        records = np.fromfile(f, dtype=svgBlockLib.STL_DTYPE, count=count)
+
+    if len(records) != count:
+        raise ValueError('%s is not a binary STL or is cut short' % fileName)
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack STL blocks onto print bed plates')
+    parser.add_argument('stls', nargs='+', help='STL files, add :N for N copies (a.stl:10)')
+    parser.add_argument('--bed', default='220x220', help='Bed width x depth in mm')
+    parser.add_argument('--spacing', type=float, default=5, help='Gap between parts in mm')
+    parser.add_argument('--margin', type=float, default=5, help='Gap to the bed edge in mm')
+    parser.add_argument('--no-rotate', action='store_true', help="Don't turn parts")
+    parser.add_argument('--out', default='plate', help='Output name, plates are <out>-1.stl, ...')
+    args = parser.parse_args()
+
+    bedWidth, bedDepth = (float(size) for size in args.bed.lower().split('x'))
+    plate = blkPlate(bedWidth, bedDepth, args.spacing, args.margin, not args.no_rotate)
+
+    for item in args.stls:
+        fileName, _, copies = item.rpartition(':')
+        if not fileName or not copies.isdigit():
+            fileName, copies = item, '1'
+        plate.addSTL(fileName, int(copies))
+
+    try:
+        plates = plate.pack()
+    except ValueError as e:
+        parser.error(str(e))
+
+    for i, parts in enumerate(plates):
+        stlName = plate.exportSTL('%s-%d.stl' % (args.out, i + 1), i)
+        print('%s: %d parts, %d triangles' % (stlName, len(parts), plate.triangleCount(i)))
+
+    with open(args.out + '.json', 'w') as f:
+        json.dump(plate.layout(), f, indent=2)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
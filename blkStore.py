@@ -0,0 +1,164 @@
+'''
+Content-addressed store for the files blkLibrary and the app write out:
+uploads, preview SVGs, STLs and GLBs.
+
+Files are keyed by the sha256 of their contents and kept as
+<folder>/<kind>/<key[:2]>/<key>.<kind>, so writing the same output twice only
+keeps one copy (counted as a dedup hit). Built on blkCache, so the store is
+bounded by size and age: least recently used files go first when it's over
+maxBytes, and files not used for maxAge seconds are removed.
+
+    store = blkStore.blkStore('artifacts')
+    key = store.putData('svg', data)
+    key = store.write('stl', blk.exportSTL)
+    fileName = store.path(key, 'stl')
+'''
+
+import hashlib
+import os
+import uuid
+
+from blkCache import blkCache
+
+
+class hashingFile:
+    '''
+    Wraps an open binary file and hashes everything written through it
+    '''
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.f.write(data)
+
+
+class blkStore(blkCache):
+
+    def __init__(self, folder='artifacts', maxBytes=1024*1024*1024, maxAge=24*3600):
+        self.dedupHits = 0
+        self.puts = 0
+        super().__init__(folder, maxBytes, maxAge)
+
+
+    def fileNameFor(self, key, kind):
+        #One folder per kind, then fan out like blkCache
+        return os.path.join(self.folder, kind, key[:2], key + '.' + kind)
+
+
+    def tempName(self, kind):
+        '''
+        A name in the store folder (so the rename is atomic) that scanFolder
+        skips. Ends in .kind for writers that pick the format from it.
+        '''
+        return os.path.join(self.folder, '%s.tmp.%s' % (uuid.uuid4().hex, kind))
+
+
+    def addFile(self, kind, key, tempName, size):
+        '''
+        Moves a finished temp file to its key. If the key is already stored
+        the temp file is dropped instead.
+        '''
+        fileName = self.fileNameFor(key, kind)
+
+        with self.lock:
+            self.puts += 1
+            exists = fileName in self.index and os.path.exists(fileName)
+            if exists:
+                self.dedupHits += 1
+
+        if exists:
+            os.remove(tempName)
+            self.touch(fileName, size)
+            return key
+
+        os.makedirs(os.path.dirname(fileName), exist_ok=True)
+        os.replace(tempName, fileName)
+        self.touch(fileName, size)
+        self.evict()
+        return key
+
+
+    def putData(self, kind, data):
+        '''Stores bytes, returns their key'''
+        key = self.hashBytes(data)
+
+        #Skip writing altogether when it's already there
+        fileName = self.fileNameFor(key, kind)
+        with self.lock:
+            known = fileName in self.index
+        if known and os.path.exists(fileName):
+            with self.lock:
+                self.puts += 1
+                self.dedupHits += 1
+            self.touch(fileName, len(data))
+            return key
+
+        tempName = self.tempName(kind)
+        with open(tempName, 'wb') as f:
+            f.write(data)
+        return self.addFile(kind, key, tempName, len(data))
+
+
+    def write(self, kind, writer):
+        '''
+        Calls writer(f) with a binary file-like object and stores what was
+        written, without holding it all in memory. Returns the key.
+        '''
+        tempName = self.tempName(kind)
+        try:
+            with open(tempName, 'wb') as f:
+                hashed = hashingFile(f)
+                writer(hashed)
+                size = f.tell()
+        except BaseException:
+            os.remove(tempName)
+            raise
+        return self.addFile(kind, hashed.hash.hexdigest(), tempName, size)
+
+
+    def writeNamed(self, kind, writer):
+        '''
+        For writers that need a file name rather than a file (e.g. cadquery's
+        exporters): writer(fileName) writes a temp file that is then hashed
+        and stored. Returns the key.
+        '''
+        tempName = self.tempName(kind)
+        try:
+            writer(tempName)
+            digest = hashlib.sha256()
+            with open(tempName, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024*1024), b''):
+                    digest.update(chunk)
+        except BaseException:
+            if os.path.exists(tempName):
+                os.remove(tempName)
+            raise
+        return self.addFile(kind, digest.hexdigest(), tempName, os.path.getsize(tempName))
+
+
+    def path(self, key, kind):
+        '''
+        Absolute file name of a stored file (Flask's send_file takes relative
+        names from the app folder), or None if it was never stored or has been
+        evicted. Counts as a use.
+        '''
+        fileName = self.fileNameFor(key, kind)
+        if not os.path.exists(fileName):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+        self.touch(fileName, os.path.getsize(fileName))
+        return os.path.abspath(fileName)
+
+
+    def stats(self):
+        stats = super().stats()
+        with self.lock:
+            stats['puts'] = self.puts
+            stats['dedupHits'] = self.dedupHits
+        return stats
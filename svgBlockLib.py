@@ -8,13 +8,127 @@ Uses code developed by Dov Grobgeld<dov.grobgeld@gmail.com>
 '''
 
 import svgpathtools
-from svgpathtools import svg2paths
+from svgpathtools import parse_path
+from svgpathtools.parser import parse_transform
+import xml.etree.ElementTree as ET
 import cadquery as cq
 from cadquery import exporters
+from cadquery.occ_impl.shapes import wiresToFaces
+from OCP.BRepTools import BRepTools
+from OCP.BRepMesh import BRepMesh_IncrementalMesh
+from OCP.BRep import BRep_Tool
+from OCP.TopLoc import TopLoc_Location
+from OCP.TopExp import TopExp_Explorer
+from OCP.TopAbs import TopAbs_FACE, TopAbs_REVERSED
+from OCP.TopoDS import TopoDS
 import numpy as np
-from math import sin, cos, sqrt, pi, acos, fmod, degrees
-from stl import mesh
+from math import sin, cos, sqrt, pi, degrees
 import uuid
+import io
+import re
+import copy
+import json
+import struct
+import os
+import sys
+import itertools
+import functools
+import time
+import threading
+try:
+    import resource
+except ImportError:
+    #Not available on Windows, peakRSS reports 0 there
+    resource = None
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import multiprocessing.forkserver
+
+from blkPaths import blkPaths, pathView, pathParts, POINT_COUNTS, LINE, QUADRATIC, CUBIC, ARC
+
+#Stages of buildBlock, in the order they run: the method, the parameters it
+# reads, the stages whose results it uses and the attributes it sets. A stage
+# only runs again when one of its parameters or upstream stages changed.
+# 'base' is stored as the shape on top of the stack.
+BLOCK_STAGES = (
+    ('translate2Dto3D', ('pathsVersion', 'neckHeight', 'skipPathNumber', 'singleExtrude', 'nestContours'),
+     (), ('base',)),
+    ('buildBoundingBox', ('xLenAdj', 'yLenAdj'),
+     ('translate2Dto3D',), ('width', 'height', 'centerX', 'centerY')),
+    ('doMath', ('scaleBy', 'overallTypeHeight', 'neckBuffer', 'filletAmount', 'neckHeight'),
+     (), ('scaledTypeHeight', 'scaledNeckBuffer', 'scaledFilletAmount', 'bodyHeight')),
+    ('buildBody', (),
+     ('buildBoundingBox', 'doMath'), ('base',)),
+    ('hollowBody', ('xhollowPercentage', 'yhollowPercentage'),
+     ('buildBody',), ('base', 'hollowDepth', 'xWallThickness', 'yWallThickness')),
+    ('createAndCutPyramid', (),
+     ('hollowBody',), ('base',)),
+    ('cutFeet', ('feetCutOutPercentage',),
+     ('createAndCutPyramid',), ('base',)),
+    ('filletEdges', ('smoothEdges',),
+     ('cutFeet', 'doMath'), ('base',)),
+)
+
+#Stages when singleCut is set: the hollow, pyramid and feet are worked out
+# from the numbers of buildBoundingBox and doMath, built as one simple cutter
+# solid and cut out of the body in a single boolean. Changing them only runs
+# the last two stages.
+SINGLE_CUT_STAGES = BLOCK_STAGES[:4] + (
+    ('buildCutter', ('xhollowPercentage', 'yhollowPercentage', 'feetCutOutPercentage'),
+     ('buildBoundingBox', 'doMath'), ('cutter', 'hollowDepth', 'xWallThickness', 'yWallThickness')),
+    ('buildFillet', ('smoothEdges', 'xhollowPercentage', 'yhollowPercentage'),
+     ('buildBoundingBox', 'doMath'), ('filletCutter', 'filletRadius')),
+    ('applyCutter', (),
+     ('buildBody', 'buildCutter', 'buildFillet'), ('base',)),
+)
+
+#Quality levels of buildBlockWithin, best first: name, simplifyPaths tolerance,
+# flattenPaths tolerance (both printed millimetres, None leaves the paths as
+# they are) and whether the outer edges may be filleted (smoothEdges or
+# smoothOuterEdges).
+QUALITY_LEVELS = (
+    ('full', None, None, True),
+    ('fine', 0.1, None, False),
+    ('coarse', 0.3, 0.2, False),
+    ('draft', 1.0, 0.5, False),
+)
+
+#Attributes blkLibrary.reset keeps: what the owner hooked up (cache, store,
+# metrics, limits) and the switches for how blocks are built
+RESET_KEEPS = ('cache', 'store', 'metrics', 'maxSVGBytes', 'maxPaths', 'maxSegments',
+               'singleExtrude', 'nestContours', 'singleCut', 'smoothEdges',
+               'parallel', 'maxWorkers', 'parallelMinPaths', 'keepHistory')
+
+#Bumped when ingestSVG makes different paths from the same SVG, it's part of
+# svgHash so nothing cached from the old paths is used
+INGEST_VERSION = 2
+
+#Same for simplifyPath, it's part of simplifiedWith so necks cached from
+# paths simplified the old way aren't used
+SIMPLIFY_VERSION = 2
+
+#Every new set of paths gets a new number, so stage results of one SVG are
+# never reused for another
+pathsVersions = itertools.count(1)
+
+def timedStage(method):
+    '''
+    Decorator for the stages of blkLibrary. Records how long the stage took,
+    the memory use after it, the path/segment counts and the faces of the
+    solid in blk.stageLog, and passes the record on to blk.metrics if set.
+    Drops the workplane history after the stage unless blk.keepHistory.
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = method(self, *args, **kwargs)
+            if not self.keepHistory:
+                self.dropHistory()
+            return result
+        finally:
+            self.recordStage(method.__name__, time.perf_counter() - start)
+    return wrapper
 
 class blkLibrary:
 
@@ -28,22 +142,116 @@ class blkLibrary:
         self.height = None
         
         self.svgPath = None
+        #Raw SVG when read from memory (readSVGFromBytes), used instead of svgPath
+        self.svgData = None
+        #blkPaths.blkPaths, set by parseSVG
         self.paths = None
         self.attributes = None
+        #'nonzero' or 'evenodd' per path, see ingestSVG
+        self.fillRules = None
+        self.svgAttributes = None
         self.pathCount = None
+        self.pathsVersion = None
+        
+        #Tag -> count of elements that can't be converted (text, image, etc.)
+        self.unsupportedElements = {}
+        
+        #Per path xmin, xmax, ymin, ymax. Set by estimateSVGSize
+        self.bboxes = None
         
         #List of path number to skip while parsing
         self.skipPathNumber = []
         
+        #Limits for untrusted SVGs, None for no limit. parseSVG raises
+        # svgRejected as soon as one is passed, before any CAD work.
+        self.maxSVGBytes = None
+        self.maxPaths = None
+        self.maxSegments = None
+        
+        #simplifyPaths tolerance in printed millimetres. simplifiedWith is
+        # (SIMPLIFY_VERSION, tolerance, scaleBy) that was actually applied
+        # (None if not simplified), the tolerance in SVG units depends on both.
+        self.simplifyTolerance = 0.01
+        self.simplifiedWith = None
+        self.segmentsBefore = None
+        self.segmentsAfter = None
+        
+        #(pathsVersion, path data) for previewSVG
+        self.previewPaths = None
+        
+        #Build all paths as one face set and extrude once. Set to False
+        # to use the old extrude-and-union per path loop.
+        self.singleExtrude = True
+        
+        #Work out which contours of a path are outsides and which are holes
+        # (see nestContours) and build one face per island. Set to False to
+        # take the first contour of each path as the outside and the rest as
+        # holes, like Face.makeFromWires does.
+        self.nestContours = True
+        
+        #Cut the hollow, pyramid and feet out in one go, see SINGLE_CUT_STAGES.
+        # Set to False to cut them one at a time, each found with selectors
+        # on the solid.
+        self.singleCut = True
+        self.cutter = None
+        
+        #Round the outer edges of the body by filletAmount, see buildFillet.
+        # Without singleCut smoothOuterEdges does it on the finished block
+        # (filletEdges), which is slow and can fail.
+        self.smoothEdges = False
+        self.filletCutter = None
+        self.filletRadius = 0
+        
+        #Spread the face building over a process pool. Only used for
+        # SVGs with at least parallelMinPaths paths. maxWorkers of None
+        # uses all cores.
+        self.parallel = False
+        self.maxWorkers = None
+        self.parallelMinPaths = 64
+        
+        #Optional blkCache.blkCache. When set, parsed paths, the neck solid and
+        # the finished body are looked up by svgHash + parameters first.
+        self.cache = None
+        self.svgHash = None
+        
+        #Optional blkStore.blkStore. When set, exports without a name are
+        # written to it instead of svgs/, stls/ and glbs/.
+        self.store = None
+        
+        #Optional callback, called with the stage name before each stage of
+        # buildBlock. Can raise to stop the build (used to cancel jobs).
+        self.progress = None
+        
+        #One record per stage that ran (see timedStage). metrics is an optional
+        # blkMetrics.blkMetrics that every record is also passed to.
+        self.stageLog = []
+        self.metrics = None
+        self.segmentCounts = None
+        
         #Need to rename this to self.blk in the future
-        self.base = cq.Workplane('XY').tag('workFace')
+        self.base = self.newBase()
+        
+        #Every stage chains workplanes onto base, and each keeps its parent
+        # (and the solids on it) alive. Set to False to keep only the current
+        # shape after each stage, see dropHistory.
+        self.keepHistory = True
+        
+        #Stage name -> (signature, outputs) of the last run of each stage in
+        # blockStages(). See runStages.
+        self.stageMemo = {}
         
         # https://www.pinterest.com/pin/63754150967869908/
         self.neckHeight = 2 #This is the SVG 3D height
         self.neckBuffer = 2 #This is a solid buffer between the neck and hollow cutout
         self.bodyHeight = 0 # Calculated later on
         self.constantTypeHeight = 23.31 #This shall never change
-        self.overallTypeHeight = 23.31  #This can change if scaleBy changes
+        self.overallTypeHeight = 23.31  #Printed millimetres, like neckBuffer and filletAmount
+        
+        #overallTypeHeight, neckBuffer and filletAmount times scaleBy (SVG
+        # units). Set by doMath, the inputs themselves are never changed.
+        self.scaledTypeHeight = None
+        self.scaledNeckBuffer = None
+        self.scaledFilletAmount = None
         
         self.scaleBy = 1
         
@@ -69,12 +277,101 @@ class blkLibrary:
         #Fillet Amount
         self.filletAmount = 1.2
         
+        #STL tessellation. Linear tolerance is in printed millimetres and gets
+        # multiplied by scaleBy, angular tolerance is in radians.
+        self.stlLinearTolerance = 0.01
+        self.stlAngularTolerance = 0.2
+        
+        #Each level of detail (lod) is meshed lodFactor times coarser than
+        # the one before it. lod 0 uses the STL tolerances.
+        self.lodFactor = 4
+        
+        #Name of the QUALITY_LEVELS entry buildBlockWithin delivered.
+        # qualityFloor is (pathsVersion, level index) of the best level that
+        # finished after better ones ran out of time, later builds of the same
+        # paths start there.
+        self.quality = None
+        self.qualityFloor = None
+        
+        
+    def clone(self):
+        '''
+        Returns a new blkLibrary with the same SVG data and parameters, but
+        with a fresh base. Used to give each job its own instance so builds
+        never share (or compound) state.
+        '''
+        new = blkLibrary()
+        for key, value in self.__dict__.items():
+            #The copy keeps its own stage records
+            if key in ('base', 'stageLog'):
+                continue
+            #Lists (skipPathNumber) are copied, paths and the cache are shared
+            if isinstance(value, (list, dict)):
+                value = copy.copy(value)
+            setattr(new, key, value)
+        return new
+        
+        
+    def reset(self):
+        '''
+        Puts the blkLibrary back to how it was created so it can take another
+        SVG: the SVG, paths, solids, stage results and records and every
+        parameter (including the scaled doMath values) go. What RESET_KEEPS
+        lists stays. Returns self.
+        '''
+        state = blkLibrary().__dict__
+        state.update({key: getattr(self, key) for key in RESET_KEEPS})
+        #One assignment, other threads never see it half reset
+        self.__dict__ = state
+        return self
+        
+        
+    def __enter__(self):
+        return self
+        
+        
+    def __exit__(self, excType, excValue, traceback):
+        #Let go of the SVG and solids, also when the build failed
+        self.reset()
+        return False
+        
+        
+    def dropHistory(self):
+        '''
+        Moves what is on base to a new workplane (see newBase), so the
+        workplanes chained before it and the solids they hold can be freed.
+        Tags other than workFace are lost.
+        '''
+        self.base = self.newBase().newObject(self.base.vals())
+        
+        
+    def newBase(self, shape=None):
+        '''
+        Returns an empty workplane tagged workFace, with shape on the stack if given
+        '''
+        base = cq.Workplane('XY').tag('workFace')
+        if shape is not None:
+            base = base.newObject([shape])
+        return base
+        
         
     def readSVGFromFile(self, fileName):
         '''
         Sets svgPath to the fileName. When calling parseSVG, svg2Paths can read in a file from disk
         '''
         self.svgPath = fileName
+        self.svgData = None
+        
+        
+    def readSVGFromBytes(self, data):
+        '''
+        Uses an SVG that is already in memory (e.g. an upload) so nothing has to
+        be written to disk. The cheap checks of checkSVGBytes are done right
+        away, raises svgRejected if the data is too big or not an SVG.
+        '''
+        checkSVGBytes(data, self.maxSVGBytes)
+        self.svgPath = None
+        self.svgData = data
         
         
     def setScale(self, scale):
@@ -100,19 +397,57 @@ class blkLibrary:
         self.scaleBy = scale
     
     
+    @timedStage
     def doMath(self):
         '''
         The idea is to read the SVG and add some default values to be used later on. Going to finish the code as-is and then come back to fill in the values here.
+        
+        Can be called more than once. The scaled values go to their own
+        attributes (scaledTypeHeight, etc.), so they don't compound.
         '''
-        self.overallTypeHeight = self.overallTypeHeight * self.scaleBy
+        self.scaledTypeHeight = self.overallTypeHeight * self.scaleBy
         #Neck Height must be set before converting SVG to 3D
         #self.neckHeight = self.neckHeight * self.scaleBy
-        self.neckBuffer = self.neckBuffer * self.scaleBy
-        self.filletAmount = self.filletAmount * self.scaleBy
+        self.scaledNeckBuffer = self.neckBuffer * self.scaleBy
+        self.scaledFilletAmount = self.filletAmount * self.scaleBy
+        
+        self.bodyHeight = self.scaledTypeHeight - self.neckHeight
+        
+        
+    def set3DDefaults(self):
+        '''
+        After SVG has been parsed, the known height/width can be used to make some
+        guesses on the rest of the values. This will hopefully get better over time.
         
-        self.bodyHeight = self.overallTypeHeight - self.neckHeight
+        Needs estimateSVGSize to have run. Used by the app and blkBatch.
+        '''
+        size = max(self.estimatedHeight, self.estimatedWidth)
+        
+        if size < 100:
+            self.neckHeight = 2
+            self.setScale(1)
+            self.feetCutOutPercentage = 0.08
+        elif size < 1000:
+            self.neckHeight = 20
+            self.setScale(10)
+            self.feetCutOutPercentage = 0.10
+        elif size < 10000:
+            self.neckHeight = 200
+            self.setScale(100)
+            self.feetCutOutPercentage = 0.12
+        else:
+            self.neckHeight = 2000
+            self.setScale(1000)
+            self.feetCutOutPercentage = 0.14
         
+        #Printed millimetres like overallTypeHeight, doMath scales it. It
+        # used to be set pre-scaled here and ended up scaled twice. Half a
+        # millimetre shows on a print, buildFillet makes it smaller for thin
+        # walls.
+        self.filletAmount = 0.5
         
+        
+    @timedStage
     def estimateSVGSize(self):
         '''
         Sets the estimatedWidth and estimatedHeight for a SVG. 
@@ -122,54 +457,251 @@ class blkLibrary:
         https://stackoverflow.com/questions/47682830/get-bounding-box-of-svg-drawing
         
         Need to check to make sure self.paths exists
+        
+        Per path bounding boxes are worked out in one vectorized pass (see
+        pathBBoxes) and kept in self.bboxes as an (n, 4) array of
+        xmin, xmax, ymin, ymax for later stages to reuse.
         '''
         
-        #Loop though paths derived from parseSVG Fn
-        for i, path in enumerate(self.paths):
-            if i == 0:
-                # Initialise the overall min-max with the first path
-                xmin, xmax, ymin, ymax = path.bbox()
-            else:
-                # Expand bounds to match path bounds if needed
-                p_xmin, p_xmax, p_ymin, p_ymax = path.bbox()
-                xmin = p_xmin if p_xmin < xmin else xmin
-                xmax = p_xmax if p_xmax > xmax else xmax
-                ymin = p_ymin if p_ymin < ymin else ymin
-                ymax = p_ymax if p_ymax > ymax else ymax
+        #Bounding boxes of the paths derived from parseSVG Fn
+        self.bboxes = pathBBoxes(self.paths)
+        
+        xmin = np.nanmin(self.bboxes[:, 0])
+        xmax = np.nanmax(self.bboxes[:, 1])
+        ymin = np.nanmin(self.bboxes[:, 2])
+        ymax = np.nanmax(self.bboxes[:, 3])
 
         #print(xmax-xmin, ymax-ymin)
-        self.estimatedWidth = xmax - xmin
-        self.estimatedHeight = ymax - ymin
+        self.estimatedWidth = float(xmax - xmin)
+        self.estimatedHeight = float(ymax - ymin)
         
         
+    @timedStage
     def parseSVG(self):
         '''
-        Given a valid svgPath, svg2paths will return the paths and attributes.
+        Given a valid svgPath (or svgData, see readSVGFromBytes), reads the
+        paths and attributes in a single pass (see ingestSVG). Raises
+        svgRejected if it's not an SVG or maxSVGBytes, maxPaths or maxSegments
+        is passed. Parsing stops at the first path over the limit.
         
         In the future, I hope this could include an HTML link.
 
-        Sets estimated length and width and number of paths
+        Sets the paths, their attributes and fill-rules, the root svg
+        attributes, the number of paths and a count of the elements that were
+        not converted (unsupportedElements). Rects, circles, ellipses and
+        polygons are converted straight to exact lines and arcs, stroked
+        lines and polylines to the outline of the stroke, and transforms are
+        applied (see shapeParts).
         Need to find a way to get other non-path elements
-        - text, shapes, transforms, etc.
+        - text, images, etc.
         See: https://pypi.org/project/svgelements/
 
         Should return a warning if non-paths are found. Not
         an error.
         '''
-        paths, attributes = svg2paths(self.svgPath)
+        data = self.svgData
+        if data is None and self.maxSVGBytes is not None:
+            checkSVGSize(os.path.getsize(self.svgPath), self.maxSVGBytes)
+        
+        if self.cache is not None:
+            if data is None:
+                with open(self.svgPath, 'rb') as f:
+                    data = f.read()
+            #Paths parsed by an older ingestSVG (and everything built from
+            # them) are never looked up
+            self.svgHash = self.cache.makeKey(self.cache.hashBytes(data), {'ingest': INGEST_VERSION})
+            
+            cached = self.cache.getObject(self.svgHash, 'svgattrs')
+            paths = self.cache.getPaths(self.svgHash) if cached is not None else None
+            if paths is not None:
+                #Parsed under other limits maybe
+                checkPathLimits(len(paths), paths.segmentCount(), self.maxPaths, self.maxSegments)
+                self.paths = paths
+                self.attributes, self.fillRules, self.svgAttributes, self.unsupportedElements = cached
+                self.pathCount = len(self.paths)
+                self.pathsVersion = next(pathsVersions)
+                return
+        
+        source = self.svgPath if data is None else io.BytesIO(data)
+        paths, attributes, fillRules, svgAttributes, unsupported = ingestSVG(source, self.maxPaths, self.maxSegments)
         self.paths = paths
         self.attributes = attributes
+        self.fillRules = fillRules
+        self.svgAttributes = svgAttributes
+        self.unsupportedElements = unsupported
         self.pathCount = len(paths)
+        self.pathsVersion = next(pathsVersions)
+        
+        if self.cache is not None:
+            self.cache.putPaths(self.svgHash, paths)
+            self.cache.putObject(self.svgHash, 'svgattrs', (attributes, fillRules, svgAttributes, unsupported))
+
+
+    @timedStage
+    def flattenPaths(self, tolerance):
+        '''
+        Turns every curve into lines that stay within tolerance (printed
+        millimetres) of it. Lines are a lot cheaper for OCCT to extrude and
+        cut than B-splines. Used by the coarser QUALITY_LEVELS.
+        '''
+        tol = tolerance * self.scaleBy
+        
+        self.paths = blkPaths.fromPaths(flattenPath(path, tol) for path in self.paths)
+        self.simplifiedWith = ('flattened', tolerance, self.scaleBy, self.simplifiedWith)
+        self.pathsVersion = next(pathsVersions)
+        
+        
+    @timedStage
+    def simplifyPaths(self, tolerance=None):
+        '''
+        Removes redundant segments before the paths are turned into CAD edges.
+        Run after parseSVG (and after the scale is set) and before
+        translate2Dto3D.
         
-        svgAttributes = svg2paths(self.svgPath, return_svg_attributes = True)
+        - Lines and curves shorter than the tolerance are dropped
+        - Beziers and arcs that are flat within the tolerance become lines
+        - Runs of collinear lines are merged into one line
+        
+        No point of the result is more than the tolerance off the original.
+        
+        tolerance is in printed millimetres (defaults to simplifyTolerance).
+        The SVG is printed at 1/scaleBy, so it is multiplied by scaleBy to get
+        SVG units. Path numbers don't change, a path that collapses completely
+        is left empty.
+        
+        Returns (segmentsBefore, segmentsAfter)
+        '''
+        if tolerance is None:
+            tolerance = self.simplifyTolerance
+        
+        tol = tolerance * self.scaleBy
+        
+        self.segmentsBefore = self.paths.segmentCount()
+        self.paths = blkPaths.fromPaths(simplifyPath(path, tol) for path in self.paths)
+        self.segmentsAfter = self.paths.segmentCount()
+        self.simplifiedWith = (SIMPLIFY_VERSION, tolerance, self.scaleBy)
+        self.pathsVersion = next(pathsVersions)
+        
+        return self.segmentsBefore, self.segmentsAfter
+
+
+    def neckParams(self):
+        '''
+        Parameters that change the extruded SVG (neck) solid
+        '''
+        return {'neckHeight': self.neckHeight,
+                'skipPathNumber': sorted(self.skipPathNumber),
+                'simplifiedWith': self.simplifiedWith,
+                'nestContours': self.nestContours,
+                }
+
+
+    def geometryParams(self):
+        '''
+        Parameters that change the finished block
+        '''
+        params = self.neckParams()
+        params.update({'overallTypeHeight': self.overallTypeHeight,
+                       'neckBuffer': self.neckBuffer,
+                       'filletAmount': self.filletAmount,
+                       'scaleBy': self.scaleBy,
+                       'xLenAdj': self.xLenAdj,
+                       'yLenAdj': self.yLenAdj,
+                       'xhollowPercentage': self.xhollowPercentage,
+                       'yhollowPercentage': self.yhollowPercentage,
+                       'feetCutOutPercentage': self.feetCutOutPercentage,
+                       'smoothEdges': self.smoothEdges,
+                       })
+        return params
+
 
+    def cacheKey(self, params):
+        '''
+        Returns the cache key for svgHash + params, or None if there is no cache
+        '''
+        if self.cache is None or self.svgHash is None:
+            return None
+        return self.cache.makeKey(self.svgHash, params)
+
+        
+
+    def evenOddPaths(self):
+        '''
+        Bool per path, True where the fill-rule is evenodd
+        '''
+        if self.fillRules is None:
+            return np.zeros(len(self.paths), dtype=bool)
+        return np.array([rule == 'evenodd' for rule in self.fillRules], dtype=bool)
+
+
+    def buildFaceSet(self):
+        '''
+        Converts each path into planar faces and fuses them into a single face set.
+        
+        Each path keeps its own holes: with nestContours every island of a
+        path is one face with its holes, worked out from how the contours nest
+        and the path's fill-rule. The paths are then fused in 2D with one
+        boolean call, which is far cheaper than fusing the extruded solids one
+        at a time. Faces that don't touch any other face skip the boolean.
+        
+        If parallel is set, chunks of paths are converted in a process pool and
+        the results fused with a tree reduction. See buildFaceSetParallel.
         
+        Returns a list of faces. Overlapping paths are merged into one face.
+        '''
+        keep = np.ones(len(self.paths), dtype=bool)
+        keep[[idx for idx in self.skipPathNumber if 0 <= idx < len(self.paths)]] = False
+        paths = self.paths.without(self.skipPathNumber)
+        evenOdd = self.evenOddPaths()[keep]
+        
+        if self.parallel and len(paths) >= self.parallelMinPaths:
+            return buildFaceSetParallel(paths, self.maxWorkers, evenOdd, self.nestContours)
+        
+        return fuseFaces(pathsToFaces(paths, evenOdd, self.nestContours))
+
 
+    @timedStage
     def translate2Dto3D(self):
         '''
         Loop through the paths and convert to 3D objects
+        
+        By default all the paths are built into one face set and extruded once
+        to neckHeight. Set singleExtrude to False to extrude each path and union
+        it into the base one at a time (slow for SVGs with hundreds of paths).
         '''
         
+        if self.singleExtrude:
+            neckKey = self.cacheKey(self.neckParams())
+            neck = None
+            if neckKey is not None:
+                neck = self.cache.getShape(neckKey, 'neck')
+            
+            if neck is None:
+                faces = self.buildFaceSet()
+                if not faces:
+                    return
+                
+                #One extrusion for the whole face set. The faces no longer overlap
+                # so the solids can be kept as a compound.
+                neck = (
+                    self.base
+                    .workplaneFromTagged('workFace')
+                    .newObject([cq.Compound.makeCompound(faces)])
+                    .extrude(self.neckHeight, combine=False)
+                    .val()
+                )
+                
+                if neckKey is not None:
+                    self.cache.putShape(neckKey, 'neck', neck)
+            
+            #Single final fuse, only needed if base already has a solid
+            try:
+                self.base.findSolid()
+                self.base = self.base.union(neck, clean=True)
+            except ValueError:
+                self.base = self.base.newObject([neck])
+            return
+        
         for idx, path in enumerate(self.paths):
             if idx not in self.skipPathNumber:
                 #print(idx)
@@ -181,9 +713,12 @@ class blkLibrary:
                 )
             #show_object(svgPath)
             self.base = self.base.union(svgPath, glue = True)
+            if not self.keepHistory:
+                self.dropHistory()
             
 
             
+    @timedStage
     def buildBoundingBox(self):
         '''
         This function builds a 'box' around the SVG and returns the height and width. Hopefully this will be more useful in the future when the UI can display the w/h and prompt them to scale accordingly.
@@ -199,6 +734,7 @@ class blkLibrary:
         self.centerY = bboxTemp.center.y
         
             
+    @timedStage
     def buildBody(self):
         '''
         Builds body of the type. Builds a box around the 3D SVG.
@@ -221,6 +757,7 @@ class blkLibrary:
         )
         
         
+    @timedStage
     def hollowBody(self):
         '''
         Hollowing could be done in percentage or manual width
@@ -232,21 +769,24 @@ class blkLibrary:
         
         bboxTemp = self.base.faces('<Z').val().BoundingBox()
         
-        self.hollowDepth = self.overallTypeHeight - self.neckHeight - self.neckBuffer
+        self.hollowDepth = self.scaledTypeHeight - self.neckHeight - self.scaledNeckBuffer
         
         #Calculate the x/y wall thickness
         self.xWallThickness = (self.width - (bboxTemp.xlen * self.xhollowPercentage))/2
         self.yWallThickness = (self.height - (bboxTemp.ylen * self.yhollowPercentage))/2
         
+        #Explicit origin, base may have been put back from stageMemo without
+        # the workplane it was built on
         self.base = (
             self.base.faces('<Z')
-            .workplane()
+            .workplane(origin=(self.centerX, self.centerY, 0))
             .rect(bboxTemp.xlen * self.xhollowPercentage,
                   bboxTemp.ylen * self.yhollowPercentage)
             .extrude(-1*self.hollowDepth/2, combine='cut')
         )
         
         
+    @timedStage
     def createAndCutPyramid(self):
         '''
         Creates a new pyramid body. Then removes it from the base body.
@@ -270,12 +810,17 @@ class blkLibrary:
         self.base = self.base.cut(pyramid, clean=True)
                 
             
+    @timedStage
     def cutFeet(self):
         bboxTemp = self.base.faces('>X').val().BoundingBox()
         
+        #Origin at the bottom of the body, like the hollowBody workplane
+        # it used to be projected from
+        bottom = 0.0001 - self.bodyHeight
+        
         self.base = (
             self.base.faces('>X')
-            .workplane()
+            .workplane(origin=(self.centerX, self.centerY, bottom))
             #Move to lower-left corner
             .center(-1*bboxTemp.ylen/2,0)
             .move(bboxTemp.ylen*0.18, 0)                                        #_
@@ -286,24 +831,450 @@ class blkLibrary:
             .extrude(-1*self.width, combine='cut')
         )
            
+    def cutterSizes(self):
+        '''
+        Sizes of the hollow, pyramid and feet as hollowBody,
+        createAndCutPyramid and cutFeet work them out from the finished
+        solid, but from width, height and the doMath numbers alone. Sets
+        hollowDepth and the wall thicknesses like hollowBody does.
+        '''
+        self.hollowDepth = self.scaledTypeHeight - self.neckHeight - self.scaledNeckBuffer
+        
+        hollowWidth = self.width * self.xhollowPercentage
+        hollowHeight = self.height * self.yhollowPercentage
+        self.xWallThickness = (self.width - hollowWidth)/2
+        self.yWallThickness = (self.height - hollowHeight)/2
+        
+        #Bottom of the body, buildBody extrudes down from 0.0001
+        bottom = 0.0001 - self.bodyHeight
+        
+        return {'bottom': bottom,
+                'hollowWidth': hollowWidth,
+                'hollowHeight': hollowHeight,
+                'hollowTop': bottom + self.hollowDepth/2,
+                'feetHeight': self.height * self.feetCutOutPercentage,
+                }
+        
+        
+    @timedStage
+    def buildCutter(self):
+        '''
+        The hollow, pyramid and feet as one solid, placed from cutterSizes
+        instead of selectors and BoundingBox calls on the body. Only simple
+        solids are involved, so it's quick no matter how detailed the SVG
+        is. Sets cutter, applyCutter cuts it out.
+        '''
+        sizes = self.cutterSizes()
+        bottom = sizes['bottom']
+        
+        #Hollow and pyramid as one ruled loft: straight up to the top of the
+        # hollow, then half the hollow depth up to 1/100 the size
+        hollowWidth, hollowHeight = sizes['hollowWidth'], sizes['hollowHeight']
+        sections = ((bottom, 1), (sizes['hollowTop'], 1), (sizes['hollowTop'] + self.hollowDepth/2, 0.01))
+        hollow = cq.Solid.makeLoft(
+            [cq.Wire.makePolygon(rectPoints(self.centerX, self.centerY, hollowWidth*size, hollowHeight*size, z),
+                                 close=True)
+             for z, size in sections],
+            ruled=True)
+        
+        #Trapezoid across the bottom, all the way along X
+        xmin = self.centerX - self.width/2
+        ymin = self.centerY - self.height/2
+        feetHeight = sizes['feetHeight']
+        feet = cq.Solid.extrudeLinear(
+            cq.Face.makeFromWires(cq.Wire.makePolygon([
+                cq.Vector(xmin + self.width, ymin + self.height*0.18, bottom),
+                cq.Vector(xmin + self.width, ymin + self.height*0.20, bottom + feetHeight),
+                cq.Vector(xmin + self.width, ymin + self.height*0.80, bottom + feetHeight),
+                cq.Vector(xmin + self.width, ymin + self.height*0.82, bottom),
+            ], close=True)),
+            cq.Vector(-self.width, 0, 0))
+        
+        self.cutter = hollow.fuse(feet).clean()
+        
+        
+    @timedStage
+    def buildFillet(self):
+        '''
+        Fast smoothOuterEdges. The body is a plain box before the neck is
+        fused on, so its outer edges are known: the box is made on its own,
+        the edges of its <Y, >Y, >X and <Z faces (the ones smoothOuterEdges
+        picks on the finished block) are filleted and what the fillets take
+        off is kept as filletCutter, for applyCutter to cut out along with
+        cutter. Only a box is filleted, so it takes milliseconds however
+        detailed the SVG is.
+        
+        filletAmount is scaled by doMath. filletRadius is what was used:
+        scaledFilletAmount kept under half the smallest side of the body and under
+        the wall thickness, more than that can't be filleted.
+        '''
+        self.filletCutter = None
+        self.filletRadius = 0
+        if not self.smoothEdges:
+            return
+        
+        wallThickness = min(self.width*(1 - self.xhollowPercentage), self.height*(1 - self.yhollowPercentage))/2
+        radius = min(self.scaledFilletAmount, 0.49*min(self.width, self.height, self.bodyHeight), 0.9*wallThickness)
+        if radius <= 0:
+            return
+        
+        #Same box as buildBody
+        bottom = 0.0001 - self.bodyHeight
+        box = cq.Solid.makeBox(self.width, self.height, self.bodyHeight,
+                               cq.Vector(self.centerX - self.width/2, self.centerY - self.height/2, bottom))
+        #Not the top edges, the neck sits on those and cutting along them
+        # would cut into its detail
+        edges = cq.Workplane().add(box).faces('<Y or >Y or >X or <Z').edges('not >Z').vals()
+        
+        self.filletCutter = box.cut(box.fillet(radius, edges))
+        self.filletRadius = radius
+        
+        
+    @timedStage
+    def applyCutter(self):
+        '''
+        hollowBody, createAndCutPyramid and cutFeet in one boolean: cuts
+        cutter (and filletCutter with smoothEdges) out of the body
+        '''
+        if self.filletCutter is None:
+            self.base = self.base.cut(self.cutter, clean=True)
+        else:
+            #Separate tools, they overlap along the bottom edges
+            self.base = self.newBase(self.base.val().cut(self.cutter, self.filletCutter).clean())
+        
+        
+    def filletEdges(self):
+        '''
+        Last of BLOCK_STAGES: smoothEdges without singleCut, runs
+        smoothOuterEdges on the finished block if it's set
+        '''
+        if not self.smoothEdges:
+            return
+        try:
+            self.smoothOuterEdges()
+        except Exception as e:
+            #OCC only says 'command not done'
+            raise ValueError('Filleting the finished block failed (%s: %s), '
+                             'set singleCut to fillet with buildFillet instead'
+                             % (type(e).__name__, e)) from e
+        
+        
+    @timedStage
     def smoothOuterEdges(self):
         self.base = (
             self.base.faces('<Y or >Y or >X or <Z')
             .edges()
-            .fillet(self.filletAmount)
+            .fillet(self.scaledFilletAmount)
         )
         
+    def segmentCount(self):
+        '''Total segments of all paths, counted once per pathsVersion'''
+        if self.paths is None:
+            return 0
+        if self.segmentCounts is None or self.segmentCounts[0] != self.pathsVersion:
+            self.segmentCounts = (self.pathsVersion, self.paths.segmentCount())
+        return self.segmentCounts[1]
+        
+        
+    def recordStage(self, stage, seconds, **extra):
+        '''
+        Adds a record for a stage that just ran to stageLog and metrics.
+        extra is added to the record (e.g. quality and error of a level
+        buildBlockWithin gave up on).
+        '''
+        shape = self.base.val()
+        
+        record = {'stage': stage,
+                  'seconds': seconds,
+                  'rss': currentRSS(),
+                  'peakRSS': peakRSS(),
+                  'paths': len(self.paths) if self.paths is not None else 0,
+                  'segments': self.segmentCount(),
+                  'faces': len(shape.Faces()) if isinstance(shape, cq.Shape) else 0,
+                  }
+        record.update(extra)
+        self.stageLog.append(record)
+        
+        if self.metrics is not None:
+            self.metrics.record(record)
+        
+        
+    def reportProgress(self, stage):
+        if self.progress is not None:
+            self.progress(stage)
+        
+        
+    def stageParam(self, name):
+        '''
+        Value of a parameter as a stage sees it. Lists are turned into
+        tuples so they can't change under the memo.
+        '''
+        value = getattr(self, name)
+        if isinstance(value, list):
+            value = tuple(value)
+        return value
+        
+        
+    def blockStages(self):
+        '''SINGLE_CUT_STAGES or BLOCK_STAGES, see singleCut'''
+        return SINGLE_CUT_STAGES if self.singleCut else BLOCK_STAGES
+        
+        
+    def stageSignatures(self):
+        '''
+        Stage name -> signature from the parameters it reads and the
+        signatures of the stages it depends on
+        '''
+        signatures = {}
+        for name, params, depends, outputs in self.blockStages():
+            signatures[name] = (tuple(self.stageParam(param) for param in params),
+                                tuple(signatures[dep] for dep in depends))
+        return signatures
+        
+        
+    def pendingStages(self):
+        '''Stages runStages would run, the rest come from stageMemo'''
+        signatures = self.stageSignatures()
+        return [name for name in signatures
+                if name not in self.stageMemo or self.stageMemo[name][0] != signatures[name]]
+        
+        
+    def runStages(self):
+        '''
+        Runs the stages of blockStages() in order. Each stage gets a signature
+        from the parameters it reads and the signatures of the stages it
+        depends on. If it matches the last run (stageMemo), the stored results
+        are put back instead of running the stage, so changing e.g.
+        feetCutOutPercentage only runs cutFeet (or buildCutter and
+        applyCutter) again.
+        '''
+        signatures = self.stageSignatures()
+        
+        for name, params, depends, outputs in self.blockStages():
+            signature = signatures[name]
+            
+            memo = self.stageMemo.get(name)
+            if memo is not None and memo[0] == signature:
+                for key, value in memo[1].items():
+                    if key == 'base':
+                        value = self.newBase(value)
+                    setattr(self, key, value)
+                continue
+            
+            if name == 'translate2Dto3D':
+                #The neck is the first solid, start from an empty base
+                self.base = self.newBase()
+            else:
+                self.reportProgress(name)
+            
+            getattr(self, name)()
+            
+            results = {}
+            for key in outputs:
+                #Only the shape is kept, not the workplane and its history
+                results[key] = self.base.val() if key == 'base' else getattr(self, key)
+            self.stageMemo[name] = (signature, results)
+            
+            
+    @timedStage
+    def buildBlock(self):
+        '''
+        Runs the whole solid pipeline, translate2Dto3D through filletEdges
+        (or applyCutter with singleCut).
+        
+        If a cache is set, the finished body is looked up first and none of the
+        CAD work is done on a hit. The numbers worked out along the way
+        (width, height, hollowDepth, etc.) are stored next to it.
+        
+        Otherwise the stages are run through runStages, which skips the ones
+        whose inputs haven't changed since the last buildBlock.
+        '''
+        if self.loadCachedBody():
+            return
+        
+        self.reportProgress('translate2Dto3D')
+        self.runStages()
+        self.storeCachedBody()
+        
+        
+    def loadCachedBody(self):
+        '''
+        Puts the finished body from the cache on base. Returns False if there
+        is no cache or it's not in it.
+        '''
+        bodyKey = self.cacheKey(self.geometryParams())
+        if bodyKey is None:
+            return False
+        
+        body = self.cache.getShape(bodyKey, 'body')
+        meta = self.cache.getMeta(bodyKey)
+        if body is None or meta is None:
+            return False
+        
+        self.doMath()
+        for key, value in meta.items():
+            setattr(self, key, value)
+        self.base = self.newBase(body)
+        return True
+        
+        
+    def storeCachedBody(self):
+        bodyKey = self.cacheKey(self.geometryParams())
+        if bodyKey is None:
+            return
+        
+        self.cache.putShape(bodyKey, 'body', self.base.val())
+        self.cache.putMeta(bodyKey, {'width': self.width,
+                                     'height': self.height,
+                                     'centerX': self.centerX,
+                                     'centerY': self.centerY,
+                                     'hollowDepth': self.hollowDepth,
+                                     'xWallThickness': self.xWallThickness,
+                                     'yWallThickness': self.yWallThickness,
+                                     'filletRadius': self.filletRadius,
+                                     })
+        
+        
+    def withQuality(self, level):
+        '''
+        Copy of this blkLibrary set up for one of QUALITY_LEVELS, ready to be
+        sent to a build process: paths simplified/flattened as the level
+        says, and nothing that can't be pickled (cache, metrics, callbacks).
+        
+        parallel is turned off: the build process is a daemon so it dies with
+        the server, and daemons can't start the process pool of
+        buildFaceSetParallel.
+        '''
+        name, simplifyTolerance, flattenTolerance, fillet = level
+        
+        blk = self.clone()
+        blk.cache = None
+        blk.store = None
+        blk.metrics = None
+        blk.progress = None
+        blk.previewPaths = None
+        blk.parallel = False
+        blk.smoothEdges = self.smoothEdges and fillet
+        
+        #Only the results of stages that won't run again are any use
+        pending = self.pendingStages()
+        blk.stageMemo = {stage: memo for stage, memo in self.stageMemo.items() if stage not in pending}
+        
+        if simplifyTolerance is not None or flattenTolerance is not None:
+            #Different paths, none of the stage results fit
+            blk.stageMemo = {}
+            if flattenTolerance is not None:
+                blk.flattenPaths(flattenTolerance)
+            if simplifyTolerance is not None:
+                blk.simplifyPaths(max(simplifyTolerance, self.simplifyTolerance))
+            blk.stageLog = []
+        
+        blk.quality = name
+        return blk
+        
+        
+    def buildBlockWithin(self, budget, smooth=False, levels=QUALITY_LEVELS):
+        '''
+        buildBlock with a time limit in seconds, for SVGs that could keep
+        translate2Dto3D or createAndCutPyramid busy for minutes.
+        
+        Each try runs in its own process (see budgetedBuild) so it can be
+        stopped, without parallel (see withQuality). If it runs out of time or
+        fails, the next of levels is tried with coarser paths and without
+        fillets. A quarter of the budget is kept for the last (coarsest) level,
+        the others get half of what is left before that. smoothEdges (or with
+        smooth, the slow smoothOuterEdges after the build) fillets the outer
+        edges on levels that allow it.
+        
+        Once a level had to be given up on, later builds of the same paths
+        start at the level that did finish (qualityFloor).
+        
+        Each level given up on adds a buildBlockWithin record with its
+        quality and error ('timeout' or the message) to stageLog and is
+        reported through progress.
+        
+        Returns the name of the level that was delivered (also set as
+        quality). Only a full quality body goes into the cache and stageMemo.
+        Raises buildTimeout if no level finished in time, or the error of the
+        last level if they all failed.
+        '''
+        name, simplifyTolerance, flattenTolerance, fillet = levels[0]
+        
+        #Nothing to build, no need for a process
+        if not (smooth and fillet):
+            if self.loadCachedBody():
+                self.quality = name
+                return name
+            if not self.pendingStages():
+                self.runStages()
+                self.quality = name
+                return name
+        
+        first = 0
+        if self.qualityFloor is not None and self.qualityFloor[0] == self.pathsVersion:
+            first = min(self.qualityFloor[1], len(levels) - 1)
+        
+        deadline = time.monotonic() + budget
+        reserve = budget/4 if len(levels) - first > 1 else 0
+        lastError = None
+        
+        for i, level in enumerate(levels):
+            if i < first:
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            attemptBudget = remaining if i == len(levels) - 1 else (remaining - reserve)/2
+            
+            blk = self.withQuality(level)
+            start = time.monotonic()
+            try:
+                state = runBudgeted(blk, smooth and level[3], attemptBudget, self.reportProgress)
+            except (buildTimeout, budgetedBuildError) as e:
+                #In stageLog and metrics like a stage, the caller decides
+                # whether to tell anyone
+                lastError = e
+                self.recordStage('buildBlockWithin', time.monotonic() - start, quality=level[0],
+                                 error='timeout' if isinstance(e, buildTimeout) else str(e))
+                self.reportProgress('%s quality %s' % (level[0], 'ran out of time' if isinstance(e, buildTimeout)
+                                                       else 'failed'))
+                continue
+            
+            for record in state.pop('stageLog'):
+                record['quality'] = level[0]
+                self.stageLog.append(record)
+                if self.metrics is not None:
+                    self.metrics.record(record)
+            
+            memo = state.pop('stageMemo')
+            self.base = self.newBase(state.pop('base'))
+            for key, value in state.items():
+                setattr(self, key, value)
+            self.quality = level[0]
+            if i > 0 and isinstance(lastError, buildTimeout):
+                self.qualityFloor = (self.pathsVersion, i)
+            
+            if blk.pathsVersion == self.pathsVersion:
+                self.stageMemo.update(memo)
+                if not (smooth and level[3]):
+                    self.storeCachedBody()
+            
+            return level[0]
+        
+        if isinstance(lastError, budgetedBuildError):
+            raise lastError
+        raise buildTimeout('No quality level finished within %gs' % budget)
+        
+        
+    @timedStage
     def exportSVG(self, folder=None, svgName=None, **kwargs):
         '''
         Look at exporting TJS. Made for ThreeJS
         Doc: https://cadquery.readthedocs.io/en/latest/importexport.html?highlight=Export%20SVG
-        '''
         
-        if svgName == None:
-            svgName = 'svgs/' + str(uuid.uuid4()) + '.svg'
-
-        if folder != None:
-            svgName = folder + svgName
+        Without a name and with a store set, the SVG goes to the store and
+        its file name there is returned (folder isn't used).
+        '''
         
         #Default options
         opts = {
@@ -328,6 +1299,16 @@ class blkLibrary:
             
         #print(opts)
         
+        if svgName == None and self.store is not None:
+            key = self.store.writeNamed('svg', lambda name: exporters.export(self.base, name, opt=opts))
+            return self.store.fileNameFor(key, 'svg')
+        
+        if svgName == None:
+            svgName = 'svgs/' + str(uuid.uuid4()) + '.svg'
+
+        if folder != None:
+            svgName = folder + svgName
+        
         exporters.export(
             self.base,
             svgName,
@@ -336,14 +1317,212 @@ class blkLibrary:
         
         return svgName
         
+        
+    def previewPathData(self):
+        '''
+        Returns the SVG path data of every path. Worked out once per set of
+        paths (pathsVersion) and kept, the preview only joins them.
+        '''
+        if self.previewPaths is None or self.previewPaths[0] != self.pathsVersion:
+            self.previewPaths = (self.pathsVersion, [path.d() for path in self.paths])
+        return self.previewPaths[1]
+        
+        
+    @timedStage
+    def previewSVG(self):
+        '''
+        Fast 2D preview of the block, drawn straight from the parsed paths and
+        the parameters without any CAD work.
+        
+        Left is the top view: the SVG, the body outline (xLenAdj/yLenAdj) and
+        the hollow (dashed). Right is a section looking along X, lined up with
+        the top view: neck, body, hollow, pyramid and the feet cut out. Mirrors
+        the numbers buildBlock would work out, but doesn't change any of them.
+        
+        Returns the SVG as a string.
+        '''
+        if self.bboxes is None:
+            self.bboxes = pathBBoxes(self.paths)
+        
+        keep = np.ones(len(self.paths), dtype=bool)
+        keep[[idx for idx in self.skipPathNumber if idx < len(keep)]] = False
+        bboxes = self.bboxes[keep]
+        
+        #Same numbers as buildBoundingBox and doMath
+        xmin, xmax = np.nanmin(bboxes[:, 0]), np.nanmax(bboxes[:, 1])
+        ymin, ymax = np.nanmin(bboxes[:, 2]), np.nanmax(bboxes[:, 3])
+        centerX, centerY = (xmin + xmax)/2, (ymin + ymax)/2
+        width = (xmax - xmin) * self.xLenAdj
+        height = (ymax - ymin) * self.yLenAdj
+        
+        overallTypeHeight = self.overallTypeHeight * self.scaleBy
+        neckBuffer = self.neckBuffer * self.scaleBy
+        bodyHeight = overallTypeHeight - self.neckHeight
+        hollowDepth = overallTypeHeight - self.neckHeight - neckBuffer
+        
+        hollowWidth = width * self.xhollowPercentage
+        hollowHeight = height * self.yhollowPercentage
+        
+        left, top = centerX - width/2, centerY - height/2
+        gap = 0.1 * max(width, height)
+        
+        #Section: z goes to the right, starting at the top of the neck
+        sectionLeft = left + width + gap
+        def zToX(z):
+            return sectionLeft + self.neckHeight - z
+        bottom = -1*bodyHeight
+        
+        stroke = 'stroke="black" vector-effect="non-scaling-stroke"'
+        outline = 'fill="none" ' + stroke
+        cut = 'fill="white" ' + stroke
+        
+        parts = []
+        
+        #Top view
+        parts.append('<rect x="%g" y="%g" width="%g" height="%g" %s/>'
+                     % (left, top, width, height, outline))
+        parts.append('<rect x="%g" y="%g" width="%g" height="%g" %s stroke-dasharray="4 3" stroke-opacity="0.5"/>'
+                     % (centerX - hollowWidth/2, centerY - hollowHeight/2,
+                        hollowWidth, hollowHeight, outline))
+        pathData = self.previewPathData()
+        parts.append('<path fill-rule="evenodd" fill="black" d="%s"/>'
+                     % ' '.join(d for d, k in zip(pathData, keep) if k))
+        
+        #Section: body, then the neck over the y ranges the paths cover
+        parts.append('<rect x="%g" y="%g" width="%g" height="%g" fill="lightgrey" %s/>'
+                     % (zToX(0), top, bodyHeight, height, stroke))
+        for y0, y1 in mergeIntervals(bboxes[:, 2], bboxes[:, 3]):
+            parts.append('<rect x="%g" y="%g" width="%g" height="%g" fill="black"/>'
+                         % (zToX(self.neckHeight), y0, self.neckHeight, y1 - y0))
+        
+        #Hollow and pyramid (hollowBody, createAndCutPyramid)
+        hollowTop = bottom + hollowDepth/2
+        parts.append('<rect x="%g" y="%g" width="%g" height="%g" %s/>'
+                     % (zToX(hollowTop), centerY - hollowHeight/2,
+                        hollowDepth/2, hollowHeight, cut))
+        pyramid = [(hollowTop, centerY - hollowHeight/2),
+                   (hollowTop + hollowDepth/2, centerY - hollowHeight/200),
+                   (hollowTop + hollowDepth/2, centerY + hollowHeight/200),
+                   (hollowTop, centerY + hollowHeight/2)]
+        parts.append('<polygon points="%s" %s/>'
+                     % (' '.join('%g,%g' % (zToX(z), y) for z, y in pyramid), cut))
+        
+        #Feet (cutFeet), measured along the side face
+        feetHeight = height * self.feetCutOutPercentage
+        feet = [(bottom, top + height*0.18),
+                (bottom + feetHeight, top + height*0.20),
+                (bottom + feetHeight, top + height*0.80),
+                (bottom, top + height*0.82)]
+        parts.append('<polygon points="%s" %s/>'
+                     % (' '.join('%g,%g' % (zToX(z), y) for z, y in feet), cut))
+        
+        pad = 0.05 * max(width, height)
+        viewBox = (left - pad, top - pad,
+                   width + gap + self.neckHeight + bodyHeight + 2*pad, height + 2*pad)
+        
+        return ('<svg xmlns="%s" viewBox="%g %g %g %g" width="100%%">'
+                % ((SVG_NAMESPACE,) + viewBox)
+                + ''.join(parts) + '</svg>')
+        
+        
+    def tessellate(self, axis='XYZ', lod=0):
+        '''
+        Meshes the block at the printed size.
+        
+        The tolerances come from stlLinearTolerance/stlAngularTolerance, so a
+        block built at scaleBy 1000 isn't meshed 1000x finer than needed. The
+        scale is then applied to the vertices in memory, only on the axes
+        listed in axis. A higher lod gives a coarser mesh (see lodFactor).
+        
+        Returns (vertices, triangles) as NumPy arrays, (n, 3) float and
+        (m, 3) int.
+        '''
+        coarser = self.lodFactor ** lod
+        vertices, triangles = meshShape(self.base.val(),
+                                        self.stlLinearTolerance * self.scaleBy * coarser,
+                                        min(self.stlAngularTolerance * coarser, 1.0))
+        
+        if self.scaleBy != 1.0:
+            for i, name in enumerate('XYZ'):
+                if name in axis.upper():
+                    vertices[:, i] /= self.scaleBy
+        
+        return vertices, triangles
+        
+        
+    @timedStage
+    def stlToBuffer(self, axis='XYZ'):
+        '''
+        Returns the binary STL in a BytesIO (rewound), e.g. for Flask's send_file
+        '''
+        buf = io.BytesIO()
+        writeSTL(buf, *self.tessellate(axis))
+        buf.seek(0)
+        return buf
+        
+        
+    @timedStage
+    def glbToBuffer(self, lod=0, axis='XYZ'):
+        '''
+        Returns the block as binary glTF in a BytesIO (rewound). Meant for the
+        three.js preview, which is a lot lighter than the HLR exportSVG.
+        '''
+        buf = io.BytesIO()
+        writeGLB(buf, *self.tessellate(axis, lod))
+        buf.seek(0)
+        return buf
+        
+        
+    @timedStage
+    def exportGLB(self, glbName=None, lod=0, axis='XYZ'):
+        '''
+        Same as exportSTL, but binary glTF (.glb). Written to 'glbs/' if a
+        name (or nothing) is given, glbName can also be an open binary file.
+        '''
+        if hasattr(glbName, 'write'):
+            writeGLB(glbName, *self.tessellate(axis, lod))
+            return glbName
+        
+        if glbName == None and self.store is not None:
+            key = self.store.write('glb', lambda f: writeGLB(f, *self.tessellate(axis, lod)))
+            return self.store.fileNameFor(key, 'glb')
+        
+        if glbName == None:
+            glbName = str(uuid.uuid4()) + '.glb'
+        
+        if glbName[-4:] != '.glb':
+            glbName = glbName + '.glb'
+        
+        glbName = 'glbs/' + glbName
+        
+        with open(glbName, 'wb') as f:
+            writeGLB(f, *self.tessellate(axis, lod))
+        
+        return glbName
+        
+        
+    @timedStage
     def exportSTL(self, stlName=None, axis='XYZ'):
         '''
         Scales the STL if self.scaleBy is other than 1.
         
         If scaling, axis to scale can be selected.
         
-        If no name is given, one will be generated.
+        If no name is given, one will be generated, or with a store set the
+        STL is written to the store. stlName can also be an open binary
+        file-like object, then nothing is written to disk.
+        
+        The scale is applied to the mesh in memory (see tessellate), no temp
+        files are written. Returns the file name (or the file object).
         '''
+        if hasattr(stlName, 'write'):
+            writeSTL(stlName, *self.tessellate(axis))
+            return stlName
+        
+        if stlName == None and self.store is not None:
+            key = self.store.write('stl', lambda f: writeSTL(f, *self.tessellate(axis)))
+            return self.store.fileNameFor(key, 'stl')
+        
         if stlName == None:
             stlName = str(uuid.uuid4()) + '.stl'
         
@@ -354,127 +1533,1639 @@ class blkLibrary:
         #Need to remove in the future. Push to stl folder
         stlName = 'stls/' + stlName
         
+        with open(stlName, 'wb') as f:
+            writeSTL(f, *self.tessellate(axis))
         
-        if self.scaleBy != 1.0:
-            
-            tempUUID = str(uuid.uuid4()) + '.stl'
-            exporters.export(self.base, tempUUID)
-            
-            #Load STL
-            tempMesh = mesh.Mesh.from_file(tempUUID)
-
-            #Scale
-            tempMesh.vectors = tempMesh.vectors/self.scaleBy
-
-            # Export the scaled STL file to 'output.stl'
-            tempMesh.save(stlName)
-            
-            #Delete tempUUID
-            
-        else:
-            exporters.export(self.base, stlName)
+        return stlName
 
             
-######################################################################
-#  A proof of concept adding a svg path into a cadQuery Workspace
-#  object.
-#
-#  This file is in the public domain.
-#
-#  Dov Grobgeld <dov.grobgeld@gmail.com>
-#  2024-03-10 Sun
-######################################################################
+def currentRSS():
+    '''Resident set size of this process in bytes (Linux), else the peak'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return peakRSS()
 
+def peakRSS():
+    '''Peak resident set size of this process in bytes'''
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Linux reports KB, macOS bytes
+    return peak if sys.platform == 'darwin' else peak*1024
 
-def tpl(cplx):
-    '''Convert a complex number to a tuple'''
-    return (cplx.real,cplx.imag)
+def meshShape(shape, tolerance, angularTolerance=0.1):
+    '''
+    Tessellates a cq Shape and returns (vertices, triangles) as NumPy arrays.
+    
+    Same result as Shape.tessellate, but the nodes are read straight into
+    arrays instead of a Vector per node, which was most of the time spent.
+    '''
+    #OCCT keeps the mesh of an earlier call if it was finer, drop it so a
+    # coarser tolerance actually gives a coarser mesh
+    BRepTools.Clean_s(shape.wrapped)
+    BRepMesh_IncrementalMesh(shape.wrapped, tolerance, True, angularTolerance, True)
+    
+    vertices = []
+    triangles = []
+    offset = 0
+    
+    explorer = TopExp_Explorer(shape.wrapped, TopAbs_FACE)
+    while explorer.More():
+        face = TopoDS.Face_s(explorer.Current())
+        explorer.Next()
+        
+        loc = TopLoc_Location()
+        poly = BRep_Tool.Triangulation_s(face, loc)
+        if poly is None:
+            continue
+        
+        nodes = np.array([poly.Node(i).Coord() for i in range(1, poly.NbNodes() + 1)],
+                         dtype=np.float64).reshape(-1, 3)
+        if not loc.IsIdentity():
+            trsf = loc.Transformation()
+            matrix = np.array([[trsf.Value(row, col) for col in range(1, 5)]
+                               for row in range(1, 4)])
+            nodes = nodes @ matrix[:, :3].T + matrix[:, 3]
+        
+        faceTriangles = np.array([poly.Triangle(i).Get() for i in range(1, poly.NbTriangles() + 1)],
+                                 dtype=np.int64).reshape(-1, 3) - 1 + offset
+        if face.Orientation() == TopAbs_REVERSED:
+            faceTriangles = faceTriangles[:, [0, 2, 1]]
+        
+        vertices.append(nodes)
+        triangles.append(faceTriangles)
+        offset += len(nodes)
+    
+    if not vertices:
+        return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int64)
+    
+    return np.vstack(vertices), np.vstack(triangles)
+
+#Binary STL record: normal, 3 vertices, attribute byte count
+STL_DTYPE = np.dtype([('normal', '<f4', (3,)),
+                      ('vertices', '<f4', (3, 3)),
+                      ('attr', '<u2')])
+
+def stlRecords(vertices, triangles):
+    '''
+    Binary STL records (STL_DTYPE) for a mesh, with the face normals filled in
+    '''
+    tri = vertices[triangles]
+    normals = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    normals = np.divide(normals, lengths, out=np.zeros_like(normals), where=lengths > 0)
+    
+    data = np.zeros(len(tri), dtype=STL_DTYPE)
+    data['normal'] = normals
+    data['vertices'] = tri
+    return data
+
+def writeSTLHeader(fileObj, count, header=b'pressBlock3D'):
+    '''Writes the 80 byte header and the triangle count of a binary STL'''
+    fileObj.write(header[:80].ljust(80, b' '))
+    fileObj.write(struct.pack('<I', count))
+
+def writeSTL(fileObj, vertices, triangles, header=b'pressBlock3D', chunkSize=65536):
+    '''
+    Writes a binary STL to an open file-like object. Written in chunks so a
+    big mesh doesn't need a second full copy in memory.
+    '''
+    writeSTLHeader(fileObj, len(triangles), header)
+    
+    for i in range(0, len(triangles), chunkSize):
+        fileObj.write(stlRecords(vertices, triangles[i:i + chunkSize]).tobytes())
+
+def vertexNormals(vertices, triangles):
+    '''
+    Area weighted vertex normals. Shape.tessellate doesn't share vertices
+    between faces, so edges of the block stay sharp.
+    '''
+    tri = vertices[triangles]
+    faceNormals = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+    
+    normals = np.zeros_like(vertices)
+    for i in range(3):
+        np.add.at(normals, triangles[:, i], faceNormals)
+    
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    return np.divide(normals, lengths, out=np.zeros_like(normals), where=lengths > 0)
+
+def meshToGLB(vertices, triangles):
+    '''
+    Packs a mesh into binary glTF bytes.
+    
+    - Normals are quantized to normalized bytes (KHR_mesh_quantization)
+    - Vertices with the same position and quantized normal are merged and
+      triangles that collapse because of it are dropped
+    - Indices are 16 bit when they fit
+    
+    The model is Z up, the node is rotated so it shows up Y up in glTF viewers.
+    '''
+    positions = np.ascontiguousarray(vertices, dtype='<f4')
+    normals = np.zeros((len(positions), 4), dtype=np.int8)
+    normals[:, :3] = np.round(vertexNormals(vertices, triangles) * 127)
+    
+    #Deduplicate on the 16 bytes of position + normal
+    rows = np.hstack([positions.view(np.uint8).reshape(-1, 12),
+                      normals.view(np.uint8)])
+    _, first, inverse = np.unique(rows.view('V16').ravel(),
+                                  return_index=True, return_inverse=True)
+    positions, normals = positions[first], normals[first]
+    
+    triangles = inverse.ravel()[triangles]
+    keep = ((triangles[:, 0] != triangles[:, 1]) &
+            (triangles[:, 1] != triangles[:, 2]) &
+            (triangles[:, 0] != triangles[:, 2]))
+    triangles = triangles[keep]
+    
+    indexType, indexComponent = (('<u2', 5123) if len(positions) < 65536
+                                 else ('<u4', 5125))
+    indices = triangles.astype(indexType).ravel()
+    
+    chunks = [positions.tobytes(), normals.tobytes(), indices.tobytes()]
+    bufferViews = []
+    offset = 0
+    for data, stride, target in zip(chunks, (12, 4, None), (34962, 34962, 34963)):
+        view = {'buffer': 0, 'byteOffset': offset, 'byteLength': len(data), 'target': target}
+        if stride is not None:
+            view['byteStride'] = stride
+        bufferViews.append(view)
+        offset += len(data) + (-len(data)) % 4
+    binary = b''.join(data + b'\0' * ((-len(data)) % 4) for data in chunks)
+    
+    gltf = {
+        'asset': {'version': '2.0', 'generator': 'pressBlock3D'},
+        'extensionsUsed': ['KHR_mesh_quantization'],
+        'extensionsRequired': ['KHR_mesh_quantization'],
+        'scene': 0,
+        'scenes': [{'nodes': [0]}],
+        'nodes': [{'mesh': 0, 'rotation': [-sqrt(0.5), 0, 0, sqrt(0.5)]}],
+        'meshes': [{'primitives': [{'attributes': {'POSITION': 0, 'NORMAL': 1},
+                                    'indices': 2, 'material': 0}]}],
+        'materials': [{'pbrMetallicRoughness': {'baseColorFactor': [0.8, 0.8, 0.8, 1.0],
+                                                'metallicFactor': 0.0,
+                                                'roughnessFactor': 0.8}}],
+        'buffers': [{'byteLength': len(binary)}],
+        'bufferViews': bufferViews,
+        'accessors': [
+            {'bufferView': 0, 'componentType': 5126, 'count': len(positions), 'type': 'VEC3',
+             'min': positions.min(axis=0).tolist() if len(positions) else [0, 0, 0],
+             'max': positions.max(axis=0).tolist() if len(positions) else [0, 0, 0]},
+            {'bufferView': 1, 'componentType': 5120, 'normalized': True,
+             'count': len(normals), 'type': 'VEC3'},
+            {'bufferView': 2, 'componentType': indexComponent, 'count': len(indices),
+             'type': 'SCALAR'},
+        ],
+    }
+    
+    jsonChunk = json.dumps(gltf, separators=(',', ':')).encode()
+    jsonChunk += b' ' * ((-len(jsonChunk)) % 4)
+    
+    glb = io.BytesIO()
+    glb.write(struct.pack('<4sII', b'glTF', 2, 12 + 8 + len(jsonChunk) + 8 + len(binary)))
+    glb.write(struct.pack('<I4s', len(jsonChunk), b'JSON'))
+    glb.write(jsonChunk)
+    glb.write(struct.pack('<I4s', len(binary), b'BIN\0'))
+    glb.write(binary)
+    return glb.getvalue()
+
+def writeGLB(fileObj, vertices, triangles):
+    '''Writes binary glTF to an open file-like object'''
+    fileObj.write(meshToGLB(vertices, triangles))
+
+SVG_NAMESPACE = 'http://www.w3.org/2000/svg'
+
+#Elements converted to paths, in the order svg2paths returns them
+SHAPE_TAGS = ('path', 'polyline', 'polygon', 'line', 'ellipse', 'circle', 'rect')
+
+#Elements that don't draw anything themselves, so nothing is lost by skipping them
+STRUCTURAL_TAGS = {'svg', 'g', 'defs', 'title', 'desc', 'metadata', 'style',
+                   'a', 'linearGradient', 'radialGradient', 'stop'}
+
+class svgRejected(Exception):
+    '''Raised for input that is not an SVG or is over one of the limits'''
+    pass
+
+def checkSVGSize(size, maxBytes):
+    if maxBytes is not None and size > maxBytes:
+        raise svgRejected('SVG is %.1f MB, the limit is %.1f MB' % (size/2**20, maxBytes/2**20))
+
+def checkSVGBytes(data, maxBytes=None):
+    '''
+    Cheap checks on raw SVG data before it is parsed: the size, and that it
+    looks like XML at all. Whether the root is <svg> is checked by ingestSVG on
+    its first element.
+    '''
+    checkSVGSize(len(data), maxBytes)
+    
+    head = data[:1024]
+    if head.startswith(b'\xef\xbb\xbf'):
+        head = head[3:]
+    if not head.lstrip().startswith(b'<'):
+        raise svgRejected('Not an SVG file')
+
+def checkPathLimits(pathCount, segmentCount, maxPaths=None, maxSegments=None):
+    if maxPaths is not None and pathCount > maxPaths:
+        raise svgRejected('SVG has more than %d paths' % maxPaths)
+    if maxSegments is not None and segmentCount > maxSegments:
+        raise svgRejected('SVG has more than %d path segments' % maxSegments)
+
+def splitTag(tag):
+    '''Splits an ElementTree tag into (namespace, name)'''
+    if tag[0] == '{':
+        ns, name = tag[1:].split('}', 1)
+        return ns, name
+    return '', tag
+
+#Presentation attributes that shapes inherit from the groups around them
+INHERITED_STYLES = ('fill-rule', 'stroke', 'stroke-width', 'stroke-linecap',
+                    'stroke-linejoin', 'stroke-miterlimit')
+
+#User units (px) per unit, https://www.w3.org/TR/css-values-3/#absolute-lengths
+LENGTH_UNITS = {'': 1.0, 'px': 1.0, 'pt': 96/72, 'pc': 16.0, 'in': 96.0,
+                'cm': 96/2.54, 'mm': 96/25.4, 'q': 96/101.6}
+
+NUMBER = r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+LENGTH_RE = re.compile(r'\s*(' + NUMBER + r')\s*([a-zA-Z]*)\s*$')
+NUMBER_RE = re.compile(NUMBER)
+
+def elementStyle(attrib, inherited):
+    '''
+    The INHERITED_STYLES of an element: what it inherits from its parent,
+    then its own attributes, then its style attribute (which wins, like in
+    CSS). inherit leaves the parent's value.
+    '''
+    style = dict(inherited)
+    items = [(name, attrib[name]) for name in INHERITED_STYLES if name in attrib]
+    items += [item.split(':', 1) for item in attrib.get('style', '').split(';') if ':' in item]
+    for name, value in items:
+        name, value = name.strip(), value.strip()
+        if name in INHERITED_STYLES and value != 'inherit':
+            style[name] = value
+    return style
+
+def elementTransform(attrib, matrix):
+    '''
+    matrix (3x3, None for none) with the transform of the element applied
+    after it
+    '''
+    transform = attrib.get('transform')
+    if not transform or not transform.strip():
+        return matrix
+    own = parse_transform(transform)
+    return own if matrix is None else matrix @ own
+
+def svgLength(value, default=None):
+    '''
+    A length attribute in user units. Percentages and anything else that
+    can't be worked out without the viewport give None.
+    '''
+    if value is None or value.strip() == 'auto':
+        return default
+    match = LENGTH_RE.match(value)
+    if match is None or match.group(2).lower() not in LENGTH_UNITS:
+        return None
+    return float(match.group(1)) * LENGTH_UNITS[match.group(2).lower()]
+
+def packParts(codes, points):
+    '''codes and points (complex) lists as the arrays pathParts returns'''
+    return (np.array(codes, dtype=np.uint8),
+            np.array(points, dtype=complex).reshape(-1).view(np.float64).reshape(-1, 2))
+
+def lineParts(vertices, close):
+    '''codes and points of lines through vertices (complex)'''
+    if close and len(vertices) > 1 and vertices[-1] != vertices[0]:
+        vertices = vertices + [vertices[0]]
+    codes = [LINE]*(len(vertices) - 1)
+    points = [p for a, b in zip(vertices, vertices[1:]) for p in (a, b)]
+    return codes, points
+
+def ellipseParts(cx, cy, rx, ry, sweep=1):
+    '''
+    A whole ellipse as two exact arcs (svgpathtools, and SVG, can't do one
+    arc that ends where it starts). sweep 1 runs along increasing angles,
+    which is a positive area the way nestContours works it out.
+    '''
+    left, right = complex(cx - rx, cy), complex(cx + rx, cy)
+    radius = complex(rx, ry)
+    #Start, radius, (rotation, large_arc + 2*sweep), end. See blkPaths.
+    flags = complex(0, 2*sweep)
+    return [ARC, ARC], [left, radius, flags, right, right, radius, flags, left]
+
+def rectParts(attrib):
+    '''
+    A rect as four lines, or lines and exact arcs with rx/ry, which are
+    clamped to half the width/height like SVG does. None if a size can't be
+    worked out.
+    '''
+    x, y = svgLength(attrib.get('x'), 0.0), svgLength(attrib.get('y'), 0.0)
+    w, h = svgLength(attrib.get('width'), 0.0), svgLength(attrib.get('height'), 0.0)
+    rx, ry = svgLength(attrib.get('rx'), 'auto'), svgLength(attrib.get('ry'), 'auto')
+    if None in (x, y, w, h, rx, ry):
+        return None
+    if w <= 0 or h <= 0:
+        return [], []
+    
+    #auto (not given) takes the other one
+    rx, ry = (rx if rx != 'auto' else ry), (ry if ry != 'auto' else rx)
+    rx = min(max(rx, 0.0), w/2) if rx != 'auto' else 0.0
+    ry = min(max(ry, 0.0), h/2) if ry != 'auto' else 0.0
+    if rx == 0 or ry == 0:
+        return lineParts([complex(x, y), complex(x + w, y), complex(x + w, y + h), complex(x, y + h)], True)
+    
+    #Clockwise on screen like svgpathtools' rect2pathd, an arc after each side
+    radius = complex(rx, ry)
+    flags = complex(0, 2)
+    corners = [(complex(x + rx, y), complex(x + w - rx, y), complex(x + w, y + ry)),
+               (complex(x + w, y + ry), complex(x + w, y + h - ry), complex(x + w - rx, y + h)),
+               (complex(x + w - rx, y + h), complex(x + rx, y + h), complex(x, y + h - ry)),
+               (complex(x, y + h - ry), complex(x, y + ry), complex(x + rx, y))]
+    codes, points = [], []
+    for start, end, arcEnd in corners:
+        if start != end:
+            codes.append(LINE)
+            points.extend((start, end))
+        codes.append(ARC)
+        points.extend((end, radius, flags, arcEnd))
+    return codes, points
+
+def orientedPositive(vertices):
+    '''vertices (complex), reversed if their shoelace area is negative'''
+    area = sum((a.conjugate()*b).imag for a, b in zip(vertices, vertices[1:] + vertices[:1]))
+    return vertices if area >= 0 else vertices[::-1]
+
+def strokeParts(vertices, style):
+    '''
+    Outline of a stroked line or polyline through vertices (complex) as
+    closed pieces: a rectangle per segment, a piece per join (miter, bevel
+    or round) and the caps (butt, square or round). The pieces overlap and
+    all run the same way, so with nonzero their union is the stroke, see
+    nestContours. Built in the element's own coordinates, so transforms
+    scale the stroke too.
+    '''
+    width = svgLength(style.get('stroke-width'), 1.0)
+    if not width or width <= 0:
+        return [], []
+    half = width/2
+    cap = style.get('stroke-linecap', 'butt')
+    join = style.get('stroke-linejoin', 'miter')
+    try:
+        miterLimit = max(float(style.get('stroke-miterlimit', 4)), 1.0)
+    except ValueError:
+        miterLimit = 4.0
+    
+    #Zero length segments have no direction
+    points = [p for i, p in enumerate(vertices) if i == 0 or p != vertices[i - 1]]
+    codes, outline = [], []
+    
+    def addPolygon(polygon):
+        polygon = orientedPositive(polygon)
+        more = lineParts(polygon, True)
+        codes.extend(more[0])
+        outline.extend(more[1])
+    
+    def addCircle(center):
+        more = ellipseParts(center.real, center.imag, half, half)
+        codes.extend(more[0])
+        outline.extend(more[1])
+    
+    if len(points) < 2:
+        #A dot, only drawn with round or square caps
+        if points and cap == 'round':
+            addCircle(points[0])
+        elif points and cap == 'square':
+            p = points[0]
+            addPolygon([p + complex(-half, -half), p + complex(half, -half),
+                        p + complex(half, half), p + complex(-half, half)])
+        return codes, outline
+    
+    directions = [(b - a)/abs(b - a) for a, b in zip(points, points[1:])]
+    for k, (a, b) in enumerate(zip(points, points[1:])):
+        d = directions[k]
+        normal = d*1j*half
+        if cap == 'square':
+            a = a - d*half if k == 0 else a
+            b = b + d*half if k == len(directions) - 1 else b
+        addPolygon([a + normal, b + normal, b - normal, a - normal])
+    
+    for k in range(1, len(points) - 1):
+        d1, d2 = directions[k - 1], directions[k]
+        cross = (d1.conjugate()*d2).imag
+        dot = (d1.conjugate()*d2).real
+        if join == 'round':
+            addCircle(points[k])
+            continue
+        if abs(cross) < 1e-12:
+            continue
+        #Corners on the outside of the turn
+        side = -1j if cross > 0 else 1j
+        p1 = points[k] + d1*side*half
+        p2 = points[k] + d2*side*half
+        #Miter length over stroke width is 1/sin(half the angle between the
+        # segments), which is 1/cos(half the turn)
+        miterRatio = 1/sqrt(max((1 + dot)/2, 1e-24))
+        if join in ('miter', 'miter-clip', 'arcs') and miterRatio <= miterLimit:
+            bisector = (d1*side + d2*side)/abs(d1*side + d2*side)
+            tip = points[k] + bisector*half*miterRatio
+            addPolygon([points[k], p1, tip, p2])
+        else:
+            addPolygon([points[k], p1, p2])
+    
+    if cap == 'round':
+        addCircle(points[0])
+        addCircle(points[-1])
+    return codes, outline
+
+def isStroked(style):
+    return style.get('stroke', 'none') not in ('none', 'transparent')
+
+def listPoints(value):
+    '''The points attribute of a polyline or polygon as complex numbers'''
+    numbers = [float(n) for n in NUMBER_RE.findall(value or '')]
+    return [complex(x, y) for x, y in zip(numbers[0::2], numbers[1::2])]
+
+def shapeParts(tag, attrib, style):
+    '''
+    codes and points (see pathParts) of a shape element, made straight from
+    its attributes: rects as lines (and exact arcs for rounded corners),
+    circles and ellipses as exact arcs, polygons as lines. Stroked lines and
+    polylines become the outline of their stroke (see strokeParts), without
+    a stroke they are open lines like before and don't make a face.
+    
+    Returns None when the shape can't be worked out (e.g. a percentage size).
+    '''
+    if tag == 'path':
+        return pathParts(parse_path(attrib.get('d', '')))
+    elif tag == 'rect':
+        parts = rectParts(attrib)
+    elif tag in ('circle', 'ellipse'):
+        cx, cy = svgLength(attrib.get('cx'), 0.0), svgLength(attrib.get('cy'), 0.0)
+        if tag == 'circle':
+            rx = ry = svgLength(attrib.get('r'), 0.0)
+        else:
+            rx, ry = svgLength(attrib.get('rx'), 'auto'), svgLength(attrib.get('ry'), 'auto')
+            rx, ry = (rx if rx != 'auto' else ry), (ry if ry != 'auto' else rx)
+            if rx == 'auto':
+                rx = ry = 0.0
+        if None in (cx, cy, rx, ry):
+            return None
+        parts = ellipseParts(cx, cy, rx, ry) if rx > 0 and ry > 0 else ([], [])
+    elif tag == 'polygon':
+        parts = lineParts(listPoints(attrib.get('points')), True)
+    elif tag in ('polyline', 'line'):
+        if tag == 'line':
+            ends = [svgLength(attrib.get(name), 0.0) for name in ('x1', 'y1', 'x2', 'y2')]
+            if None in ends:
+                return None
+            vertices = [complex(ends[0], ends[1]), complex(ends[2], ends[3])]
+        else:
+            vertices = listPoints(attrib.get('points'))
+        if isStroked(style):
+            parts = strokeParts(vertices, style)
+        else:
+            parts = lineParts(vertices, False)
+    if parts is None:
+        return None
+    return packParts(*parts)
+
+def transformParts(codes, points, matrix):
+    '''
+    Applies an SVG transform (3x3 matrix) to codes and points (see
+    pathParts). Arcs stay exact: the ellipse of an arc under an affine
+    transform is another ellipse, its radii and rotation come from the SVD
+    of the transformed axes. A mirroring transform flips the sweep.
+    '''
+    linear = np.asarray(matrix, dtype=float)[:2, :2]
+    offset = np.asarray(matrix, dtype=float)[:2, 2]
+    
+    counts = POINT_COUNTS[codes]
+    segmentOffsets = np.cumsum(counts) - counts
+    isPosition = np.ones(len(points), dtype=bool)
+    arcs = segmentOffsets[codes == ARC]
+    isPosition[arcs + 1] = False
+    isPosition[arcs + 2] = False
+    
+    points = points.copy()
+    points[isPosition] = points[isPosition] @ linear.T + offset
+    
+    if len(arcs):
+        rx, ry = points[arcs + 1, 0], points[arcs + 1, 1]
+        phi = np.radians(points[arcs + 2, 0])
+        flags = points[arcs + 2, 1].astype(int)
+        
+        #Axes of each ellipse (columns), transformed, then split again
+        axes = np.empty((len(arcs), 2, 2))
+        axes[:, 0, 0], axes[:, 1, 0] = rx*np.cos(phi), rx*np.sin(phi)
+        axes[:, 0, 1], axes[:, 1, 1] = -ry*np.sin(phi), ry*np.cos(phi)
+        u, sizes, _ = np.linalg.svd(linear @ axes)
+        
+        if np.linalg.det(linear) < 0:
+            flags = flags ^ 2
+        points[arcs + 1, 0] = sizes[:, 0]
+        points[arcs + 1, 1] = sizes[:, 1]
+        points[arcs + 2, 0] = np.degrees(np.arctan2(u[:, 1, 0], u[:, 0, 0]))
+        points[arcs + 2, 1] = flags
+    
+    return codes, points
+
+def ingestSVG(source, maxPaths=None, maxSegments=None):
+    '''
+    Reads an SVG (file name or file-like object) in a single streaming pass.
+    
+    Replaces calling svg2paths (twice) and then parsing the file again with
+    minidom to look for non-path elements. Elements are dropped from the tree
+    as soon as they have been handled, so memory stays flat for big files.
+    
+    Returns (paths, attributes, fillRules, svgAttributes, unsupported) where
+    paths (a blkPaths) and attributes are in the same order svg2paths returns
+    them. Each shape is packed into arrays as soon as it is read (see
+    shapeParts), so no svgpathtools objects pile up, and the transforms of
+    the shape and the groups around it are applied (see transformParts).
+    fillRules is the fill-rule of each path, inherited from the groups like
+    the stroke. svgAttributes are the attributes of the root svg element and
+    unsupported is a dict of tag -> count for the elements that were not
+    converted. Anything inside <defs> is not counted.
+    
+    Raises svgRejected if the root element isn't <svg>, the XML is broken or
+    there are more than maxPaths paths or maxSegments segments. The limits are
+    checked as each element is read, so a huge file is given up on early.
+    '''
+    shapes = {tag: [] for tag in SHAPE_TAGS}
+    svgAttributes = None
+    unsupported = {}
+    
+    parents = []
+    #(style, transform) of each open element, see elementStyle
+    inherited = []
+    defsDepth = 0
+    pathCount = 0
+    segmentCount = 0
+    
+    try:
+        for event, elem in ET.iterparse(source, events=('start', 'end')):
+            ns, tag = splitTag(elem.tag)
+            
+            if event == 'start':
+                if not parents and tag != 'svg':
+                    raise svgRejected('Not an SVG file, the root element is <%s>' % tag)
+                if tag == 'svg' and svgAttributes is None:
+                    svgAttributes = dict(elem.attrib)
+                elif tag == 'defs':
+                    defsDepth += 1
+                parents.append(elem)
+                style, matrix = inherited[-1] if inherited else ({}, None)
+                #The root's own transform is left to the viewer, like before
+                if len(parents) > 1:
+                    matrix = elementTransform(elem.attrib, matrix)
+                inherited.append((elementStyle(elem.attrib, style), matrix))
+                continue
+            
+            parents.pop()
+            style, matrix = inherited.pop()
+            
+            if ns not in ('', SVG_NAMESPACE):
+                pass
+            elif tag in shapes:
+                attrib = dict(elem.attrib)
+                parts = shapeParts(tag, attrib, style)
+                if parts is None:
+                    if defsDepth == 0:
+                        unsupported[tag] = unsupported.get(tag, 0) + 1
+                else:
+                    if matrix is not None:
+                        parts = transformParts(*parts, matrix)
+                    pathCount += 1
+                    segmentCount += len(parts[0])
+                    checkPathLimits(pathCount, segmentCount, maxPaths, maxSegments)
+                    rule = style.get('fill-rule')
+                    #A stroke outline is always the union of its pieces
+                    if tag in ('line', 'polyline') and isStroked(style):
+                        rule = 'nonzero'
+                    shapes[tag].append((parts, attrib, 'evenodd' if rule == 'evenodd' else 'nonzero'))
+            elif tag == 'defs':
+                defsDepth -= 1
+            elif tag not in STRUCTURAL_TAGS and defsDepth == 0:
+                unsupported[tag] = unsupported.get(tag, 0) + 1
+            
+            #Done with it. Drop it so the tree never grows.
+            elem.clear()
+            if parents:
+                parents[-1].remove(elem)
+    except ET.ParseError as e:
+        raise svgRejected('Not a valid SVG: %s' % e)
+    
+    parts = []
+    attributes = []
+    fillRules = []
+    for tag in SHAPE_TAGS:
+        for part, attrib, rule in shapes[tag]:
+            parts.append(part)
+            attributes.append(attrib)
+            fillRules.append(rule)
+    
+    return blkPaths.fromParts(parts), attributes, fillRules, svgAttributes or {}, unsupported
+
+def mergeIntervals(lo, hi):
+    '''
+    Merges overlapping [lo, hi] intervals. NaNs (empty paths) are dropped.
+    Returns a list of (lo, hi) sorted by lo.
+    '''
+    ok = ~(np.isnan(lo) | np.isnan(hi))
+    order = np.argsort(lo[ok])
+    lo, hi = lo[ok][order], hi[ok][order]
+    
+    merged = []
+    for start, end in zip(lo.tolist(), hi.tolist()):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(interval) for interval in merged]
+
+
+def quadraticRoots(a, b, c):
+    '''
+    Real roots of a*t^2 + b*t + c for arrays of coefficients. Returns two
+    arrays, NaN where there is no root. Falls back to the linear case when
+    a is ~0.
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        linear = np.abs(a) < 1e-12
+        disc = b*b - 4*a*c
+        sq = np.sqrt(np.where(disc >= 0, disc, np.nan))
+        r1 = np.where(linear, -c/b, (-b + sq)/(2*a))
+        r2 = np.where(linear, np.nan, (-b - sq)/(2*a))
+    return r1, r2
+
+def pathBBoxes(paths):
+    '''
+    Bounding box of every path, same values as path.bbox() but done in batch.
+    
+    Works on the arrays of a blkPaths (a list of svgpathtools paths is packed
+    first). Interior extrema of the Beziers come from the roots of their
+    derivatives and arcs are handled analytically from their center form, so
+    there is no per-segment Python code at all.
+    
+    Returns an (n, 4) array of xmin, xmax, ymin, ymax. Empty paths are NaN.
+    '''
+    if not isinstance(paths, blkPaths):
+        paths = blkPaths.fromPaths(paths)
+    
+    cp = paths.complexPoints()
+    segmentOwners = paths.segmentOwners()
+    starts = paths.segmentOffsets[:-1]
+    
+    def gather(code, count):
+        #Points (one column each) and owning path of the segments with code
+        mask = paths.codes == code
+        idx = starts[mask]
+        return cp[idx[:, None] + np.arange(count)], segmentOwners[mask]
+    
+    #Candidate points (complex) and which path they belong to
+    points = []
+    pointOwners = []
+    
+    def addCandidates(pts, idx):
+        keep = ~np.isnan(pts)
+        points.append(pts[keep])
+        pointOwners.append(np.broadcast_to(idx, pts.shape)[keep])
+    
+    pts, lineIdx = gather(LINE, 2)
+    if len(pts):
+        addCandidates(pts, lineIdx[:, None])
+    
+    pts, quadIdx = gather(QUADRATIC, 3)
+    if len(pts):
+        idx = quadIdx[:, None]
+        addCandidates(pts[:, [0, 2]], idx)
+        
+        P0, P1, P2 = pts[:, 0], pts[:, 1], pts[:, 2]
+        denom = P0 - 2*P1 + P2
+        candidates = []
+        for part in (np.real, np.imag):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = (part(P0) - part(P1))/part(denom)
+            t = np.where((t > 0) & (t < 1), t, np.nan)
+            candidates.append((1-t)**2*P0 + 2*(1-t)*t*P1 + t**2*P2)
+        addCandidates(np.stack(candidates, axis=1), idx)
+    
+    pts, cubicIdx = gather(CUBIC, 4)
+    if len(pts):
+        idx = cubicIdx[:, None]
+        addCandidates(pts[:, [0, 3]], idx)
+        
+        P0, P1, P2, P3 = pts[:, 0], pts[:, 1], pts[:, 2], pts[:, 3]
+        #Derivative is 3*(a*t^2 + b*t + c)
+        a = -P0 + 3*P1 - 3*P2 + P3
+        b = 2*(P0 - 2*P1 + P2)
+        c = P1 - P0
+        candidates = []
+        for part in (np.real, np.imag):
+            for t in quadraticRoots(part(a), part(b), part(c)):
+                t = np.where((t > 0) & (t < 1), t, np.nan)
+                candidates.append((1-t)**3*P0 + 3*(1-t)**2*t*P1
+                                  + 3*(1-t)*t**2*P2 + t**3*P3)
+        addCandidates(np.stack(candidates, axis=1), idx)
+    
+    pts, arcIdx = gather(ARC, 4)
+    if len(pts):
+        idx = arcIdx[:, None]
+        addCandidates(pts[:, [0, 3]], idx)
+        
+        #Start, radius, (rotation, flags), end. See blkPaths.
+        flags = pts[:, 2].imag.astype(int)
+        phi = np.radians(pts[:, 2].real)
+        cx, cy, theta1, deltaTheta, rx, ry = arcs_endpoint_to_center(
+            pts[:, 0], pts[:, 3], flags & 1 == 1, flags & 2 == 2, pts[:, 1], phi)
+        center = cx + 1j*cy
+        theta = np.degrees(theta1)
+        delta = np.degrees(deltaTheta)
+        
+        #Angles (degrees) where dx/dtheta = 0 and dy/dtheta = 0, plus 180
+        thetaX = np.degrees(np.arctan2(-ry*np.sin(phi), rx*np.cos(phi)))
+        thetaY = np.degrees(np.arctan2(ry*np.cos(phi), rx*np.sin(phi)))
+        angles = np.stack([thetaX, thetaX + 180, thetaY, thetaY + 180], axis=1)
+        
+        #Only keep the angles the arc actually sweeps through
+        swept = np.where(delta[:, None] >= 0,
+                         np.mod(angles - theta[:, None], 360),
+                         np.mod(theta[:, None] - angles, 360))
+        angles = np.where(swept <= np.abs(delta)[:, None], np.radians(angles), np.nan)
+        
+        x = (rx*np.cos(phi))[:, None]*np.cos(angles) - (ry*np.sin(phi))[:, None]*np.sin(angles)
+        y = (rx*np.sin(phi))[:, None]*np.cos(angles) + (ry*np.cos(phi))[:, None]*np.sin(angles)
+        addCandidates(center[:, None] + x + 1j*y, idx)
+    
+    bboxes = np.full((len(paths), 4), np.nan)
+    if not points:
+        return bboxes
+    
+    points = np.concatenate(points)
+    owners = np.concatenate(pointOwners)
+    
+    xmin = np.full(len(paths), np.inf)
+    xmax = np.full(len(paths), -np.inf)
+    ymin = np.full(len(paths), np.inf)
+    ymax = np.full(len(paths), -np.inf)
+    np.minimum.at(xmin, owners, points.real)
+    np.maximum.at(xmax, owners, points.real)
+    np.minimum.at(ymin, owners, points.imag)
+    np.maximum.at(ymax, owners, points.imag)
+    
+    bboxes[:] = np.stack([xmin, xmax, ymin, ymax], axis=1)
+    bboxes[~np.isfinite(bboxes)] = np.nan
+    return bboxes
+
+#Points each curve is sampled with for the contour nesting tests, lines use
+# just their start point
+CURVE_SAMPLES = 8
+
+def contourSpans(paths):
+    '''
+    Splits every path of a blkPaths into its closed subpaths (contours) the
+    same way addSvgPath does: a contour ends at the first segment that ends
+    exactly where the contour started. Segments left over at the end of a
+    path never make a wire, so they aren't a contour either.
+    
+    Returns (owners, starts, ends) arrays: the path of each contour and its
+    segments, starts:ends (segment numbers of the whole blkPaths).
+    '''
+    cp = paths.complexPoints()
+    segStarts = cp[paths.segmentOffsets[:-1]].tolist()
+    segEnds = cp[paths.segmentOffsets[1:] - 1].tolist()
+    pathOffsets = paths.pathOffsets.tolist()
+    
+    owners, starts, ends = [], [], []
+    for i in range(len(paths)):
+        first = None
+        for k in range(pathOffsets[i], pathOffsets[i + 1]):
+            if first is None:
+                first = k
+            if segEnds[k] == segStarts[first]:
+                owners.append(i)
+                starts.append(first)
+                ends.append(k + 1)
+                first = None
+    
+    return (np.array(owners, dtype=np.int64), np.array(starts, dtype=np.int64),
+            np.array(ends, dtype=np.int64))
+
+def sampleContours(paths, starts, ends, samples=CURVE_SAMPLES):
+    '''
+    Polygons through the contours starts:ends (see contourSpans), done in
+    batch: lines add their start point, curves samples points along them.
+    Close enough to tell which contour is inside which, not for geometry.
+    
+    Returns (points, offsets), contour i is points[offsets[i]:offsets[i+1]]
+    (complex, not closed). Needs at least one contour.
+    '''
+    counts = ends - starts
+    segs = np.arange(counts.sum()) + np.repeat(starts - np.cumsum(counts) + counts, counts)
+    codes = paths.codes[segs]
+    
+    sampleCounts = np.where(codes == LINE, 1, samples)
+    total = sampleCounts.sum()
+    first = np.cumsum(sampleCounts) - sampleCounts
+    t = (np.arange(total) - np.repeat(first, sampleCounts))/np.repeat(sampleCounts, sampleCounts)
+    
+    cp = paths.complexPoints()
+    idx = np.repeat(paths.segmentOffsets[segs], sampleCounts)
+    code = np.repeat(codes, sampleCounts)
+    points = cp[idx].copy()
+    
+    mask = code == QUADRATIC
+    if mask.any():
+        tt, i = t[mask], idx[mask]
+        points[mask] = (1-tt)**2*cp[i] + 2*(1-tt)*tt*cp[i + 1] + tt**2*cp[i + 2]
+    
+    mask = code == CUBIC
+    if mask.any():
+        tt, i = t[mask], idx[mask]
+        points[mask] = ((1-tt)**3*cp[i] + 3*(1-tt)**2*tt*cp[i + 1]
+                        + 3*(1-tt)*tt**2*cp[i + 2] + tt**3*cp[i + 3])
+    
+    mask = code == ARC
+    if mask.any():
+        tt, i = t[mask], idx[mask]
+        #Start, radius, (rotation, flags), end. See blkPaths.
+        flags = cp[i + 2].imag.astype(int)
+        phi = np.radians(cp[i + 2].real)
+        cx, cy, theta1, deltaTheta, rx, ry = arcs_endpoint_to_center(
+            cp[i], cp[i + 3], flags & 1 == 1, flags & 2 == 2, cp[i + 1], phi)
+        theta = theta1 + tt*deltaTheta
+        x = rx*np.cos(theta)
+        y = ry*np.sin(theta)
+        points[mask] = (cx + np.cos(phi)*x - np.sin(phi)*y) + 1j*(cy + np.sin(phi)*x + np.cos(phi)*y)
+    
+    offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+    np.cumsum(np.add.reduceat(sampleCounts, np.cumsum(counts) - counts), out=offsets[1:])
+    return points, offsets
+
+def pointsInPolygon(points, polygon):
+    '''Even-odd test of complex points against a polygon (complex, not closed)'''
+    a = polygon
+    b = np.roll(polygon, -1)
+    px = points.real[:, None]
+    py = points.imag[:, None]
+    crosses = (a.imag > py) != (b.imag > py)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = a.real + (py - a.imag)*(b.real - a.real)/(b.imag - a.imag)
+    return (crosses & (px < x)).sum(axis=1) % 2 == 1
+
+def nestContours(paths, evenOdd=None, spans=None):
+    '''
+    Works out how the contours of each path nest, so every filled island can
+    be built as one face with its holes instead of leaving it to
+    Face.makeFromWires, which takes the first contour as the outside and
+    every other one as a hole.
+    
+    evenOdd is a bool per path (fill-rule evenodd, see fillRule), all
+    nonzero if None. Contours whose bounding box encloses another one's (found
+    with a sweep over the boxes sorted by xmin) are checked with a point in
+    polygon test. The winding number just inside and just outside a contour
+    then says whether it is an outer boundary, a hole or not an edge of the
+    filled area at all (e.g. a second contour in the same direction with
+    nonzero). Contours that overlap without one being inside the other are
+    separate islands, fuseFaces unions them like it does separate paths.
+    
+    spans are the contourSpans of paths if already worked out.
+    
+    Returns a list with one entry per path: a list of (outer, holes) contour
+    numbers within the path (the order contourSpans finds them in), or None
+    when contours cross each other so they don't nest. With nonzero, crossing
+    contours that all run the same way (e.g. a stroke outline) are each an
+    island, their union is what gets filled.
+    '''
+    if evenOdd is None:
+        evenOdd = np.zeros(len(paths), dtype=bool)
+    
+    owners, starts, ends = contourSpans(paths) if spans is None else spans
+    islands = [[] for _ in range(len(paths))]
+    if not len(owners):
+        return islands
+    
+    points, offsets = sampleContours(paths, starts, ends)
+    
+    #Shoelace area (signed, the sign is the direction) and bbox of each contour
+    following = np.arange(1, len(points) + 1)
+    following[offsets[1:] - 1] = offsets[:-1]
+    x, y = points.real, points.imag
+    area = np.add.reduceat(x*y[following] - x[following]*y, offsets[:-1])/2
+    boxes = np.stack([np.minimum.reduceat(x, offsets[:-1]), np.maximum.reduceat(x, offsets[:-1]),
+                      np.minimum.reduceat(y, offsets[:-1]), np.maximum.reduceat(y, offsets[:-1])], axis=1)
+    
+    #Contours that enclose nothing (e.g. a line drawn there and back)
+    size = (boxes[:, 1] - boxes[:, 0])*(boxes[:, 3] - boxes[:, 2])
+    sign = np.where(np.abs(area) > 1e-9*size, np.sign(area), 0).astype(int)
+    
+    firstContour = np.searchsorted(owners, np.arange(len(paths) + 1))
+    for i in range(len(paths)):
+        lo, hi = firstContour[i], firstContour[i + 1]
+        if hi - lo == 1:
+            islands[i] = [(0, [])] if sign[lo] else []
+            continue
+        if hi == lo:
+            continue
+        
+        box = boxes[lo:hi]
+        size = np.abs(area[lo:hi])
+        order = np.argsort(box[:, 0], kind='stable')
+        sortedX = box[order, 0]
+        
+        parents = []
+        for c in range(hi - lo):
+            if not sign[lo + c]:
+                parents.append([])
+                continue
+            candidates = order[:np.searchsorted(sortedX, box[c, 0], side='right')]
+            candidates = candidates[(box[candidates, 1] >= box[c, 1]) & (box[candidates, 2] <= box[c, 2])
+                                    & (box[candidates, 3] >= box[c, 3]) & (size[candidates] > size[c])
+                                    & (sign[lo + candidates] != 0)]
+            
+            #Up to 8 points spread along the contour, they all have to agree
+            polygon = points[offsets[lo + c]:offsets[lo + c + 1]]
+            test = polygon[np.linspace(0, len(polygon), min(len(polygon), 8), endpoint=False).astype(int)]
+            inside = []
+            for d in candidates.tolist():
+                hits = pointsInPolygon(test, points[offsets[lo + d]:offsets[lo + d + 1]])
+                if hits.all():
+                    inside.append(d)
+                elif hits.any():
+                    break
+            else:
+                #No crossings
+                parents.append(inside)
+                continue
+            islands[i] = None
+            break
+        
+        if islands[i] is None:
+            pathSign = sign[lo:hi]
+            if not evenOdd[i] and len(set(pathSign[pathSign != 0].tolist())) == 1:
+                islands[i] = [(c, []) for c in np.flatnonzero(pathSign).tolist()]
+            continue
+        
+        #Winding number (or count for evenodd) just inside and just outside
+        # each contour
+        pathSign = sign[lo:hi]
+        outer = []
+        holes = []
+        for c in range(hi - lo):
+            if not pathSign[c]:
+                continue
+            if evenOdd[i]:
+                inFilled = (len(parents[c]) + 1) % 2 == 1
+                outFilled = len(parents[c]) % 2 == 1
+            else:
+                winding = pathSign[parents[c]].sum() + pathSign[c]
+                inFilled = winding != 0
+                outFilled = winding - pathSign[c] != 0
+            if inFilled and not outFilled:
+                outer.append(c)
+            elif outFilled and not inFilled:
+                holes.append(c)
+        
+        #Each hole belongs to the closest contour around it that is an edge
+        outerHoles = {c: [] for c in outer}
+        boundary = set(outer) | set(holes)
+        for c in holes:
+            around = [d for d in parents[c] if d in boundary]
+            if around:
+                closest = min(around, key=lambda d: size[d])
+                if closest in outerHoles:
+                    outerHoles[closest].append(c)
+        islands[i] = [(c, outerHoles[c]) for c in outer]
+    
+    return islands
+
+def rectPoints(centerX, centerY, width, height, z):
+    '''Corners of a rectangle at height z, for Wire.makePolygon'''
+    return [cq.Vector(centerX + dx*width/2, centerY + dy*height/2, z)
+            for dx, dy in ((-1, -1), (1, -1), (1, 1), (-1, 1))]
+
+def distanceToChord(point, a, b):
+    '''
+    Distance from point to the segment a-b and where it projects on it
+    (0 at a, 1 at b). All complex.
+    '''
+    chord = b - a
+    length2 = chord.real*chord.real + chord.imag*chord.imag
+    if length2 == 0:
+        return abs(point - a), 0.0
+    rel = point - a
+    t = (rel.real*chord.real + rel.imag*chord.imag)/length2
+    return abs(rel.real*chord.imag - rel.imag*chord.real)/sqrt(length2), t
+
+def isFlat(seg, tol):
+    '''
+    True if the curve stays within tol of the straight line between its ends
+    '''
+    if isinstance(seg, svgpathtools.CubicBezier):
+        #Curve lies in the hull of its control points
+        checks = (seg.control1, seg.control2)
+    elif isinstance(seg, svgpathtools.QuadraticBezier):
+        checks = (seg.control,)
+    elif isinstance(seg, svgpathtools.Arc):
+        if abs(seg.delta) > 180:
+            return False
+        checks = (seg.point(0.25), seg.point(0.5), seg.point(0.75))
+    else:
+        return True
+
+    for point in checks:
+        d, t = distanceToChord(point, seg.start, seg.end)
+        if d > tol or t < 0 or t > 1:
+            return False
+    return True
+
+def withEnds(seg, start, end):
+    '''Copy of a segment with new end points'''
+    if isinstance(seg, svgpathtools.CubicBezier):
+        return svgpathtools.CubicBezier(start, seg.control1, seg.control2, end)
+    elif isinstance(seg, svgpathtools.QuadraticBezier):
+        return svgpathtools.QuadraticBezier(start, seg.control, end)
+    elif isinstance(seg, svgpathtools.Arc):
+        return svgpathtools.Arc(start, seg.radius, seg.rotation, seg.large_arc, seg.sweep, end)
+    return svgpathtools.Line(start, end)
+
+def chordError(points, a, b):
+    '''
+    Largest distance from points to the segment a-b (not the line through
+    it, points past the ends count from the end). All complex.
+    '''
+    worst = 0.0
+    for point in points:
+        d, t = distanceToChord(point, a, b)
+        if t < 0:
+            d = abs(point - a)
+        elif t > 1:
+            d = abs(point - b)
+        worst = max(worst, d)
+    return worst
+
+def subpathArea(segs):
+    '''
+    Area of a closed run of segments, from the end points and a few points
+    along each curve
+    '''
+    points = []
+    for seg in segs:
+        points.append(seg.start)
+        if not isinstance(seg, svgpathtools.Line):
+            points.extend(seg.point(t) for t in (0.25, 0.5, 0.75))
+    area = 0.0
+    for a, b in zip(points, points[1:] + points[:1]):
+        area += a.real*b.imag - b.real*a.imag
+    return abs(area)/2
 
-def angle_between(u,v):
-    '''Find the angle between the vectors u an v'''
-    ux,uy = u
-    vx,vy = v
-    sign = 1 if ux*vy-uy*vx > 0 else -1
-    arg = (ux*vx+uy*vy)/(sqrt(ux*ux+uy*uy)*sqrt(vx*vx+vy*vy))
-    return sign*acos(arg)
+def simplifySubpath(segs, tol):
+    '''
+    Simplifies one continuous run of segments. The first start point and
+    the last end point never move, so closed subpaths stay closed.
+    
+    Every original point a segment takes over when short segments are
+    collapsed or lines merged is kept with it, and a merge is only done if
+    all of them stay within tol. So the result is never more than tol off,
+    however many segments are merged (like Douglas-Peucker).
+    '''
+    out = []
+    #Original points taken over by each segment of out
+    absorbed = []
+    pendingStart = None
+    pendingPoints = []
+    
+    for seg in segs:
+        points = []
+        if pendingStart is not None:
+            points = pendingPoints + [seg.start]
+            seg = withEnds(seg, pendingStart, seg.end)
+            pendingStart = None
+            pendingPoints = []
+        
+        #Degenerate. Collapse it onto the previous segment, unless that would
+        # close the previous segment on itself or move it more than tol.
+        if abs(seg.end - seg.start) < tol and isFlat(seg, tol):
+            if not out:
+                pendingStart = seg.start
+                pendingPoints = points + [seg.end]
+                continue
+            prev = out[-1]
+            if prev.start != seg.end:
+                moved = absorbed[-1] + points + [prev.end]
+                if isinstance(prev, svgpathtools.Line):
+                    error = chordError(moved, prev.start, seg.end)
+                else:
+                    error = max(abs(point - seg.end) for point in moved)
+                if error <= tol:
+                    out[-1] = withEnds(prev, prev.start, seg.end)
+                    absorbed[-1] = moved
+                    continue
+        
+        if not isinstance(seg, svgpathtools.Line) and isFlat(seg, tol):
+            points = points + [seg.point(t) for t in (0.25, 0.5, 0.75)]
+            seg = svgpathtools.Line(seg.start, seg.end)
+        
+        #Merge with the previous line if the shared point, and every point
+        # both lines took over, is on the new chord
+        if isinstance(seg, svgpathtools.Line) and out and isinstance(out[-1], svgpathtools.Line):
+            prev = out[-1]
+            d, t = distanceToChord(prev.end, prev.start, seg.end)
+            merged = absorbed[-1] + [prev.end] + points
+            if d <= tol and 0 < t < 1 and chordError(merged, prev.start, seg.end) <= tol:
+                out[-1] = svgpathtools.Line(prev.start, seg.end)
+                absorbed[-1] = merged
+                continue
+        
+        out.append(seg)
+        absorbed.append(points)
+    
+    #Closed shape made of less than three lines has no area left. Only
+    # dropped if it had none to begin with, otherwise kept as it was.
+    if len(out) < 3 and all(isinstance(seg, svgpathtools.Line) for seg in out):
+        if segs and segs[0].start == segs[-1].end:
+            return list(segs) if subpathArea(segs) > 0 else []
+    
+    return out
 
-# Implementation of https://www.w3.org/TR/SVG/implnote.html#ArcConversionCenterToEndpoint
-def arc_endpoint_to_center(
+def simplifyPath(path, tol):
+    '''
+    Simplification pass for a single svgpathtools path. See
+    blkLibrary.simplifyPaths. Returns a new Path.
+    '''
+    #Split where addSvgPath closes a shape, or where the path jumps
+    subpaths = []
+    subpathStart = None
+    for seg in path:
+        if subpathStart is None or subpaths[-1][-1].end != seg.start:
+            subpaths.append([])
+            subpathStart = seg.start
+        subpaths[-1].append(seg)
+        if seg.end == subpathStart:
+            subpathStart = None
+    
+    segs = []
+    for subpath in subpaths:
+        segs.extend(simplifySubpath(subpath, tol))
+    
+    return svgpathtools.Path(*segs)
+
+def flattenSegment(seg, tol, depth=0):
+    '''
+    Lines within tol of a segment, found by halving it until each half is
+    flat
+    '''
+    if isinstance(seg, svgpathtools.Line):
+        return [seg]
+    if depth >= 12 or isFlat(seg, tol):
+        return [svgpathtools.Line(seg.start, seg.end)]
+    
+    first, second = seg.split(0.5)
+    return flattenSegment(first, tol, depth + 1) + flattenSegment(second, tol, depth + 1)
+
+def flattenPath(path, tol):
+    '''All segments of a path as lines (list), see flattenSegment'''
+    lines = []
+    for seg in path:
+        lines.extend(flattenSegment(seg, tol))
+    return lines
+
+def contourWires(paths, starts, ends):
+    '''
+    The wire of every contour (see contourSpans), made straight from the
+    blkPaths arrays with Edge.makeLine/makeBezier/makeEllipse, one exact
+    edge per segment. Same wires as addSvgPath makes, lines shorter than
+    0.001 are skipped and a gap left at the end is closed with a line, but
+    without a Workplane (and its Plane) for every segment.
+    
+    Returns a list with a wire per contour, None if it has no edges.
+    '''
+    arcs, _ = arc_table(paths)
+    arcRows = (np.cumsum(paths.codes == ARC) - 1).tolist()
+    cp = paths.complexPoints().tolist()
+    codes = paths.codes.tolist()
+    segmentOffsets = paths.segmentOffsets.tolist()
+    
+    def vector(point):
+        return cq.Vector(point.real, point.imag, 0)
+    
+    wires = []
+    for first, last in zip(starts.tolist(), ends.tolist()):
+        edges = []
+        for k in range(first, last):
+            i = segmentOffsets[k]
+            code = codes[k]
+            if code == LINE:
+                d = cp[i + 1] - cp[i]
+                if abs(d.real) < 0.001 and abs(d.imag) < 0.001:
+                    continue
+                edges.append(cq.Edge.makeLine(vector(cp[i]), vector(cp[i + 1])))
+            elif code == CUBIC or code == QUADRATIC:
+                edges.append(cq.Edge.makeBezier([vector(p) for p in cp[i:i + POINT_COUNTS[code]]]))
+            else:
+                #Like ellipseArc: made around the start point, then moved so it
+                # starts there
+                x_radius, y_radius, rotation_angle, angle1, angle2 = arcs[arcRows[k]]
+                sense = 1
+                if angle2 < angle1:
+                    angle1, angle2 = angle2, angle1
+                    sense = -1
+                start = vector(cp[i])
+                rotation = np.radians(rotation_angle)
+                e = cq.Edge.makeEllipse(x_radius, y_radius, start, cq.Vector(0, 0, 1),
+                                        cq.Vector(cos(rotation), sin(rotation), 0), angle1, angle2, sense)
+                edges.append(e.translate(start.sub(e.startPoint())))
+        
+        if not edges:
+            wires.append(None)
+            continue
+        gap = edges[0].startPoint().sub(edges[-1].endPoint())
+        if gap.Length > 1e-6:
+            edges.append(cq.Edge.makeLine(edges[-1].endPoint(), edges[0].startPoint()))
+        wires.append(cq.Wire.assembleEdges(edges))
+    return wires
+
+def pathsToFaces(paths, evenOdd=None, nest=True):
+    '''
+    Converts a blkPaths (or a list of svgpathtools paths) into planar faces
+    on the XY plane. Holes inside a single path are kept as inner wires.
+    
+    With nest set, every island of a path becomes one face with its own
+    holes, following the path's fill-rule (evenOdd, see nestContours).
+    Paths whose contours cross each other, and all paths without nest, go to
+    wiresToFaces (first contour outside, the rest holes).
+    '''
+    if not isinstance(paths, blkPaths):
+        paths = blkPaths.fromPaths(paths)
+    
+    spans = contourSpans(paths)
+    wires = contourWires(paths, spans[1], spans[2])
+    islands = nestContours(paths, evenOdd, spans) if nest else None
+    firstContour = np.searchsorted(spans[0], np.arange(len(paths) + 1)).tolist()
+    
+    faces = []
+    for i in range(len(paths)):
+        pathWires = wires[firstContour[i]:firstContour[i + 1]]
+        
+        if islands is None or islands[i] is None:
+            #Nothing closed left (e.g. a coarse simplify flattened it to two lines)
+            pathWires = [wire for wire in pathWires if wire is not None]
+            if pathWires:
+                faces.extend(wiresToFaces(pathWires))
+            continue
+        
+        for outer, holes in islands[i]:
+            if pathWires[outer] is None:
+                continue
+            holeWires = [pathWires[h] for h in holes if pathWires[h] is not None]
+            faces.extend(cq.Face.makeFromWires(pathWires[outer], holeWires).Faces())
+    return faces
+
+def overlappingBoxes(boxes):
+    '''
+    Which of the (n, 4) xmin, xmax, ymin, ymax boxes touch or overlap at
+    least one other box. Sweeps over the boxes sorted by xmin, so only boxes
+    that overlap in x are compared. Returns a bool array.
+    '''
+    order = np.argsort(boxes[:, 0], kind='stable')
+    sortedBoxes = boxes[order]
+    ends = np.searchsorted(sortedBoxes[:, 0], sortedBoxes[:, 1], side='right')
+    
+    overlaps = np.zeros(len(boxes), dtype=bool)
+    for k in range(len(boxes)):
+        others = sortedBoxes[k + 1:ends[k]]
+        hits = (others[:, 2] <= sortedBoxes[k, 3]) & (others[:, 3] >= sortedBoxes[k, 2])
+        if hits.any():
+            overlaps[k] = True
+            overlaps[k + 1 + np.flatnonzero(hits)] = True
+    
+    result = np.zeros(len(boxes), dtype=bool)
+    result[order] = overlaps
+    return result
+
+def fuseFaces(faces):
+    '''
+    Fuses a list of faces with a single boolean call and merges coplanar
+    pieces back together. Faces whose bounding box doesn't touch any other
+    face's can't be merged with anything, they are left out of the boolean.
+    Returns a list of faces.
+    '''
+    if len(faces) < 2:
+        return faces
+    
+    boxes = np.array([[bb.xmin, bb.xmax, bb.ymin, bb.ymax] for bb in (face.BoundingBox() for face in faces)])
+    overlaps = overlappingBoxes(boxes)
+    
+    apart = [face for face, overlap in zip(faces, overlaps) if not overlap]
+    touching = [face for face, overlap in zip(faces, overlaps) if overlap]
+    if len(touching) > 1:
+        touching = touching[0].fuse(*touching[1:]).clean().Faces()
+    return apart + touching
+
+def shapeToBrep(shape):
+    '''Serialize a cq Shape to BREP bytes'''
+    buf = io.BytesIO()
+    shape.exportBrep(buf)
+    return buf.getvalue()
+
+def brepToShape(data):
+    '''Read a cq Shape back from BREP bytes'''
+    return cq.Shape.importBrep(io.BytesIO(data))
+
+def pathsToBrep(paths, evenOdd=None, nest=True):
+    '''
+    Process pool worker. Builds and fuses the faces for a chunk of paths and
+    returns them as BREP bytes (None if the chunk has no closed paths).
+    '''
+    faces = fuseFaces(pathsToFaces(paths, evenOdd, nest))
+    if not faces:
+        return None
+    return shapeToBrep(cq.Compound.makeCompound(faces))
+
+def fuseBreps(breps):
+    '''
+    Process pool worker. Fuses a pair of BREP face sets into one.
+    '''
+    if len(breps) == 1:
+        return breps[0]
+    shapes = [brepToShape(b) for b in breps]
+    return shapeToBrep(shapes[0].fuse(*shapes[1:]).clean())
+
+def buildFaceSetParallel(paths, maxWorkers=None, evenOdd=None, nest=True):
+    '''
+    Same result as fuseFaces(pathsToFaces(paths, evenOdd, nest)), but the paths are split in
+    chunks (a couple per worker) and converted in a process pool. Chunks are
+    slices of the blkPaths arrays, so they pickle as a few arrays. Workers
+    return BREP bytes. The chunk results are then fused pairwise, level by
+    level, in the same pool instead of one long chain.
+    '''
+    if maxWorkers is None:
+        maxWorkers = os.cpu_count() or 1
+    
+    chunkCount = min(len(paths), maxWorkers * 2)
+    chunkSize = -(-len(paths) // chunkCount)
+    chunks = [paths[i:i + chunkSize] for i in range(0, len(paths), chunkSize)]
+    if evenOdd is None:
+        evenOdd = np.zeros(len(paths), dtype=bool)
+    evenOddChunks = [evenOdd[i:i + chunkSize] for i in range(0, len(paths), chunkSize)]
+    
+    with ProcessPoolExecutor(max_workers=maxWorkers) as pool:
+        breps = [b for b in pool.map(pathsToBrep, chunks, evenOddChunks, [nest]*len(chunks))
+                 if b is not None]
+        
+        #Tree reduction
+        while len(breps) > 1:
+            pairs = [breps[i:i + 2] for i in range(0, len(breps), 2)]
+            breps = list(pool.map(fuseBreps, pairs))
+    
+    if not breps:
+        return []
+    
+    return brepToShape(breps[0]).Faces()
+
+class buildTimeout(Exception):
+    pass
+
+class budgetedBuildError(Exception):
+    '''A build process failed, the message is the error it raised'''
+    pass
+
+#Attributes the stages set, sent back from a build process
+STAGE_OUTPUTS = sorted({key for stage in BLOCK_STAGES + SINGLE_CUT_STAGES for key in stage[3]} - {'base'})
+
+#Only one thread at a time changes PYTHONPATH to start the forkserver
+buildServerLock = threading.Lock()
+
+def budgetContext():
+    '''
+    Build processes are started from a forkserver that has this module (and
+    cadquery) loaded already, so they start quickly and don't inherit the
+    threads of the web server. Spawn where there is no forkserver.
+    
+    Starts the forkserver if it isn't running.
+    '''
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(['svgBlockLib'])
+    
+    #The forkserver doesn't get sys.path before it preloads, it finds this
+    # module through PYTHONPATH. Only set while it starts, the build
+    # processes get sys.path from this process anyway.
+    folder = os.path.dirname(os.path.abspath(__file__))
+    with buildServerLock:
+        oldPath = os.environ.get('PYTHONPATH')
+        paths = [path for path in (oldPath or '').split(os.pathsep) if path]
+        os.environ['PYTHONPATH'] = os.pathsep.join([folder] + [path for path in paths if path != folder])
+        try:
+            multiprocessing.forkserver.ensure_running()
+        finally:
+            if oldPath is None:
+                del os.environ['PYTHONPATH']
+            else:
+                os.environ['PYTHONPATH'] = oldPath
+    return context
+
+def startBuildServer():
+    '''
+    Starts the forkserver (and its import of cadquery) now, so the first
+    budgeted build doesn't pay for it
+    '''
+    #Not from a build process that is importing the main module again
+    if multiprocessing.parent_process() is not None:
+        return
+    
+    budgetContext()
+
+def budgetedBuild(conn, blk, smooth):
+    '''
+    Runs in a build process. Sends ('progress', stage) before each stage and
+    then ('done', state) with the body and what the stages worked out, or
+    ('error', message).
+    '''
+    cq.Workplane.addSvgPath = addSvgPath
+    blk.progress = lambda stage: conn.send(('progress', stage))
+    ran = blk.pendingStages()
+    
+    try:
+        blk.buildBlock()
+        if smooth:
+            blk.smoothOuterEdges()
+    except Exception as e:
+        conn.send(('error', '%s: %s' % (type(e).__name__, e)))
+        return
+    
+    state = {key: getattr(blk, key) for key in STAGE_OUTPUTS}
+    #The parent already has the results of the stages that were skipped
+    memo = {stage: blk.stageMemo[stage] for stage in ran}
+    state.update(base=blk.base.val(), stageMemo=memo, stageLog=blk.stageLog)
+    conn.send(('done', state))
+
+def runBudgeted(blk, smooth, budget, progress):
+    '''
+    Builds blk in a new process (see budgetedBuild) and returns its state.
+    progress is called with each stage as it starts. The process is killed
+    if it takes more than budget seconds (raises buildTimeout) or if
+    progress raises. A failed build raises budgetedBuildError.
+    '''
+    context = budgetContext()
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=budgetedBuild, args=(sender, blk, smooth), daemon=True)
+    process.start()
+    sender.close()
+    
+    deadline = time.monotonic() + budget
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not receiver.poll(remaining):
+                raise buildTimeout('Build took more than %.1fs' % budget)
+            
+            try:
+                kind, value = receiver.recv()
+            except EOFError:
+                process.join(1)
+                raise budgetedBuildError('Build process died (exit code %s)' % process.exitcode)
+            
+            if kind == 'progress':
+                progress(value)
+            elif kind == 'error':
+                raise budgetedBuildError(value)
+            else:
+                return value
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+        receiver.close()
+
+
+######################################################################
+#  A proof of concept adding a svg path into a cadQuery Workspace
+#  object.
+#
+#  This file is in the public domain.
+#
+#  Dov Grobgeld <dov.grobgeld@gmail.com>
+#  2024-03-10 Sun
+######################################################################
+
+
+def tpl(cplx):
+    '''Convert a complex number to a tuple'''
+    return (cplx.real,cplx.imag)
+
+# Implementation of https://www.w3.org/TR/SVG/implnote.html#ArcConversionEndpointToCenter
+def arcs_endpoint_to_center(
     start,
     end,
     flag_a,
     flag_s,
     radius,
     phi):
-    #print('Fn: Arc_endpoint_to_center')
-    '''Convert a endpoint elliptical arc description to a center description'''
-    rx,ry = radius.real,radius.imag
-    x1,y1 = start.real,start.imag
-    x2,y2 = end.real,end.imag
-
-    cosphi = cos(phi)
-    sinphi = sin(phi)
-    rx2 = rx*rx
-    ry2 = ry*ry
+    '''
+    Converts a whole batch of endpoint elliptical arc descriptions to center
+    descriptions at once.
+
+    start, end and radius are complex arrays, flag_a/flag_s bool arrays and
+    phi the rotation in radians. Radii that are too small to reach the end
+    point are scaled up as described in
+    https://www.w3.org/TR/SVG/implnote.html#ArcCorrectionOutOfRangeRadii
+    so this never takes the sqrt of a negative number.
+
+    Returns arrays cx, cy, theta1, delta_theta, rx, ry (angles in radians,
+    rx/ry are the corrected radii).
+    '''
+    start = np.asarray(start, dtype=complex)
+    end = np.asarray(end, dtype=complex)
+    radius = np.asarray(radius, dtype=complex)
+    phi = np.asarray(phi, dtype=float)
+    flag_a = np.asarray(flag_a, dtype=bool)
+    flag_s = np.asarray(flag_s, dtype=bool)
+
+    rx = np.abs(radius.real)
+    ry = np.abs(radius.imag)
+    cosphi = np.cos(phi)
+    sinphi = np.sin(phi)
 
     # Step 1. Compute x1p,y1p
-    x1p,y1p = (np.array([[cosphi,sinphi],
-                   [-sinphi,cosphi]])
-         @ np.array([x1-x2, y1-y2])*0.5).flatten()
+    half = (start - end)*0.5
+    x1p = cosphi*half.real + sinphi*half.imag
+    y1p = -sinphi*half.real + cosphi*half.imag
     x1p2 = x1p*x1p
     y1p2 = y1p*y1p
 
-    # Step 2: Compute (cx', cy')
-    cxyp = sqrt((rx2*ry2 - rx2*y1p2 - ry2*x1p2)
-              / (rx2*y1p2 + ry2*x1p2)) * np.array([rx*y1p/ry,-ry*x1p/rx])
-
-    if flag_a == flag_s:
-        cxyp = -cxyp
+    # Correct out of range radii
+    lam = x1p2/(rx*rx) + y1p2/(ry*ry)
+    scale = np.sqrt(np.maximum(lam, 1.0))
+    rx = rx*scale
+    ry = ry*scale
+    rx2 = rx*rx
+    ry2 = ry*ry
 
-    cxp,cyp = cxyp.flatten()
+    # Step 2: Compute (cx', cy'). Clamp tiny negatives from rounding.
+    num = np.maximum(rx2*ry2 - rx2*y1p2 - ry2*x1p2, 0.0)
+    den = rx2*y1p2 + ry2*x1p2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coef = np.where(den > 0, np.sqrt(num/den), 0.0)
+    coef = np.where(flag_a == flag_s, -coef, coef)
+    cxp = coef*rx*y1p/ry
+    cyp = -coef*ry*x1p/rx
 
     # Step 3: compute (cx,cy) from (cx',cy')
-    cx,cy = (cosphi*cxp - sinphi * cyp + 0.5*(x1+x2),
-           sinphi*cxp + cosphi * cyp + 0.5*(y1+y2))
+    mid = (start + end)*0.5
+    cx = cosphi*cxp - sinphi*cyp + mid.real
+    cy = sinphi*cxp + cosphi*cyp + mid.imag
 
     # Step 4: compute theta1 and deltatheta
-    theta1 = angle_between((1,0), ((x1p-cxp)/rx, (y1p-cyp)/ry))
-    delta_theta = fmod(angle_between(((x1p-cxp)/rx,(y1p-cyp)/ry),
-                                   ((-x1p-cxp)/rx, (-y1p-cyp)/ry)),2*pi)
+    ux, uy = (x1p - cxp)/rx, (y1p - cyp)/ry
+    vx, vy = (-x1p - cxp)/rx, (-y1p - cyp)/ry
+    theta1 = np.arctan2(uy, ux)
+    delta_theta = np.arctan2(ux*vy - uy*vx, ux*vx + uy*vy)
 
     # Choose the right edge according to the flags
-    if not flag_s and delta_theta > 0:
-        delta_theta -= 2*pi
-    elif flag_s and delta_theta < 0:
-        delta_theta += 2*pi
-    
-    return (cx,cy), theta1, delta_theta
+    delta_theta = np.where(~flag_s & (delta_theta > 0), delta_theta - 2*pi, delta_theta)
+    delta_theta = np.where(flag_s & (delta_theta < 0), delta_theta + 2*pi, delta_theta)
 
-def compare_complex(num1, num2, tolerance):
-    """
-    Compares two complex numbers using a given tolerance for both the real and imaginary parts.
+    return cx, cy, theta1, delta_theta, rx, ry
 
-    :param num1: The first complex number to be compared.
-    :param num2: The second complex number to be compared.
-    :param tolerance: The tolerance to use when comparing the real and imaginary parts of the numbers.
+def arc_table(paths):
+    '''
+    Collects every Arc in paths (a blkPaths, or svgpathtools paths that are
+    packed first) and converts all of them in one call to
+    arcs_endpoint_to_center.
 
-    :return: True if the real and imaginary parts of the two complex numbers are within the given tolerance, False otherwise.
-    """
-    # Check that the input is valid
-    if not (isinstance(num1, complex) and isinstance(num2, complex)):
-        raise ValueError("Both inputs must be complex numbers")
+    Returns (table, offsets). table has one row per arc, in order, with
+    x_radius, y_radius, rotation_angle, angle1, angle2 (degrees) ready for
+    ellipseArc. The arcs of paths[i] are table[offsets[i]:offsets[i+1]].
+    '''
+    if not isinstance(paths, blkPaths):
+        paths = blkPaths.fromPaths(paths)
 
-    # Check that the tolerance is valid
-    if not (isinstance(tolerance, float) or isinstance(tolerance, int)):
-        raise ValueError("Tolerance must be a number")
+    isArc = paths.codes == ARC
+    arcCounts = np.zeros(len(paths.codes) + 1, dtype=np.int64)
+    np.cumsum(isArc, out=arcCounts[1:])
+    offsets = arcCounts[paths.pathOffsets].tolist()
 
-    # Check that the real and imaginary parts of the two complex numbers are within the given tolerance
-    if abs(num1.real - num2.real) < tolerance and abs(num1.imag - num2.imag) < tolerance:
-        return True
+    if not isArc.any():
+        return np.empty((0, 5)), offsets
 
-    return False
+    # Start, radius, (rotation, flags), end. See blkPaths.
+    idx = paths.segmentOffsets[:-1][isArc]
+    cp = paths.complexPoints()
+    rotation = cp[idx + 2].real
+    flags = cp[idx + 2].imag.astype(int)
+    # rotation is kept in degrees, like svgpathtools does
+    cx, cy, theta1, delta_theta, rx, ry = arcs_endpoint_to_center(
+        cp[idx], cp[idx + 3], flags & 1 == 1, flags & 2 == 2, cp[idx + 1], np.radians(rotation))
 
-def addSvgPath(self, path):
+    table = np.stack([rx, ry, rotation,
+                      np.degrees(theta1), np.degrees(theta1 + delta_theta)], axis=1)
+    return table, offsets
+
+def addSvgPath(self, path, arcs=None):
     '''
     Add the svg path object to the current workspace
     The p in path below is each movement in the path, where the movement
@@ -484,58 +3175,75 @@ def addSvgPath(self, path):
 
     All p's are translated using bezier, ellipseArc commands and added
     to res (I assume res = result).
+
+    path is a pathView of a blkPaths (an svgpathtools path is packed first).
+    The segments are read straight from its arrays, no segment objects are
+    made. arcs is the precomputed arc_table for this path. If not given, it
+    is worked out here in one batch for all arcs of the path.
     '''
 
     #print('Start Path')
 
+    if not isinstance(path, pathView):
+        path = blkPaths.fromPaths([path])[0]
+
+    if arcs is None:
+        arcs, _ = arc_table(path.paths[path.index:path.index + 1])
+
+    points = path.complexPoints().tolist()
+
     res = self
     path_start = None
     arc_id = 0
-    for p in path:
+    i = 0
+    for code in path.codes.tolist():
+        #Points of this segment, see blkPaths
+        p = points[i:i + POINT_COUNTS[code]]
+        i += POINT_COUNTS[code]
+        start, end = p[0], p[-1]
+
         #print('path element to add: ',p)
         if path_start is None:
-            path_start = p.start
-        res = res.moveTo(*tpl(p.start))
+            path_start = start
+        res = res.moveTo(start.real, start.imag)
 
         # Support the four svgpathtools different objects
-        if isinstance(p, svgpathtools.CubicBezier):
-            coords = (tpl(p.start), tpl(p.control1), tpl(p.control2), tpl(p.end))
-            res = res.bezier(coords)
-        elif isinstance(p, svgpathtools.QuadraticBezier):
-            coords = (tpl(p.start), tpl(p.control), tpl(p.end))
-            res = res.bezier(coords)
-            pass
-        elif isinstance(p, svgpathtools.Arc):
-            arc_id += 1
-            center,theta1,delta_theta = arc_endpoint_to_center(
-                p.start,
-                p.end,
-                p.large_arc,
-                p.sweep,
-                p.radius,
-                p.rotation)
-
-            res = res.ellipseArc(
-                x_radius = p.radius.real,
-                y_radius = p.radius.imag,
-                rotation_angle=degrees(p.rotation),
-                angle1= degrees(theta1),
-                angle2=degrees(theta1+delta_theta))
-        elif isinstance(p, svgpathtools.Line):   
+        if code == LINE:
             #Check to see if start and end points are the same - 0.001
-            samePoint = compare_complex(p.start, p.end, 0.001)
-            if samePoint:
-                #res = res.lineTo(p.end.real, p.end.imag)
+            d = end - start
+            if abs(d.real) < 0.001 and abs(d.imag) < 0.001:
                 pass
                 #print('Start and End are the same - skipping')
             else:
                 #print('Adding line')
-                res = res.lineTo(p.end.real, p.end.imag)
+                res = res.lineTo(end.real, end.imag)
+        elif code == CUBIC or code == QUADRATIC:
+            coords = [tpl(point) for point in p]
+            res = res.bezier(coords)
+        elif code == ARC:
+            x_radius, y_radius, rotation_angle, angle1, angle2 = arcs[arc_id]
+            arc_id += 1
+
+            #ellipseArc always takes the counter clockwise part from angle1
+            # to angle2. A negative sweep is the same part from angle2 to
+            # angle1, reversed (sense=-1) so it still starts at p.start.
+            if angle2 > angle1:
+                sense = 1
+            else:
+                angle1, angle2 = angle2, angle1
+                sense = -1
 
+            res = res.ellipseArc(
+                x_radius = x_radius,
+                y_radius = y_radius,
+                rotation_angle = rotation_angle,
+                angle1 = angle1,
+                angle2 = angle2,
+                sense = sense)
         else:
             print('Some other path type')
 
-        if path_start == p.end:
+        if path_start == end:
             path_start = None
             res = res.close()
     